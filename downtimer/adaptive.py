@@ -0,0 +1,125 @@
+import logging
+import threading
+
+from db_adapters import AdapterWrapper, INSTANCE, SERVICE
+
+logger = logging.getLogger(__name__)
+
+# scheduler job kind probing each kind of sample's target
+JOB_KINDS = {INSTANCE: 'ping', SERVICE: 'http'}
+# intervals of healthy targets are only changed when they move this much
+REBALANCE_TOLERANCE = 0.1
+
+
+class AdaptiveRate(AdapterWrapper):
+    '''
+    Adapts how often every target is probed to its state.
+
+    A target which failed a probe is probed every `fast_interval` seconds
+    until `recovery` probes in a row succeed, so that the start and end of
+    outages are measured precisely. To keep the total within `budget`
+    probes per second, failing targets may use half of it, and healthy
+    targets are probed less often than their base interval, but at least
+    once every `max_interval` seconds. A budget of 0 means no limit.
+    Failing targets are never probed less often than healthy ones would
+    be without a budget.
+    '''
+    def __init__(self, adapter, scheduler, intervals, fast_interval=0.2,
+                 max_interval=10, budget=0, recovery=3):
+        self.adapter = adapter
+        self.scheduler = scheduler
+        self.intervals = intervals
+        self.fast_interval = fast_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self.recovery = recovery
+        self.failing = {}
+        self.healthy = set()
+        self.factor = 1.0
+        self.current_fast_interval = fast_interval
+        self.lock = threading.Lock()
+
+    def healthy_interval(self, kind):
+        base = self.intervals[kind]
+        return max(base, min(base * self.factor, self.max_interval))
+
+    def failing_interval(self, kind):
+        return min(self.current_fast_interval, self.intervals[kind])
+
+    def observe(self, sample_kind, target, failed):
+        kind = JOB_KINDS[sample_kind]
+        key = (kind, target)
+        interval = None
+        with self.lock:
+            if failed:
+                if key not in self.failing:
+                    self.healthy.discard(key)
+                    interval = self.failing_interval(kind)
+                self.failing[key] = 0
+            elif key in self.failing:
+                self.failing[key] += 1
+                if self.failing[key] >= self.recovery:
+                    del self.failing[key]
+                    self.healthy.add(key)
+                    interval = self.healthy_interval(kind)
+            elif key not in self.healthy:
+                self.healthy.add(key)
+                interval = self.healthy_interval(kind)
+        if interval is not None:
+            self.scheduler.set_interval(key, interval)
+
+    def rebalance(self):
+        '''Splits the budget anew between failing and healthy targets.'''
+        with self.lock:
+            for key in list(self.healthy) + list(self.failing):
+                if self.scheduler.interval(key) is None:
+                    self.healthy.discard(key)
+                    self.failing.pop(key, None)
+            failing = list(self.failing)
+            healthy = list(self.healthy)
+            if not self.budget:
+                return
+            fast_interval = max(self.fast_interval,
+                                len(failing) / (self.budget / 2.0))
+            fast_load = sum(1.0 / min(fast_interval, self.intervals[kind])
+                            for kind, _ in failing)
+            base_load = sum(1.0 / self.intervals[kind] for kind, _ in healthy)
+            # more failing targets than half the budget takes at their base
+            # interval still leave healthy ones the other half
+            factor = max(1.0, base_load / max(self.budget - fast_load,
+                                              self.budget / 2.0))
+            changed = abs(factor - self.factor) > \
+                REBALANCE_TOLERANCE * self.factor
+            self.factor = factor
+            fast_changed = fast_interval != self.current_fast_interval
+            self.current_fast_interval = fast_interval
+
+        if changed:
+            logger.info('Probing healthy targets %.1f times less often to '
+                        'stay within %g probes/s', factor, self.budget)
+            for key in healthy:
+                self.scheduler.set_interval(key,
+                                            self.healthy_interval(key[0]))
+        if fast_changed:
+            for key in failing:
+                self.scheduler.set_interval(key,
+                                            self.failing_interval(key[0]))
+
+    def store_instance_status(self, address, total_time, exit_code, value,
+                              timestamp=None, rtt=None, interval=None):
+        # the interval the sample was probed at, before observe() changes it
+        interval = interval or self.scheduler.interval(
+            (JOB_KINDS[INSTANCE], address))
+        self.adapter.store_instance_status(address, total_time, exit_code,
+                                           value, timestamp, rtt=rtt,
+                                           interval=interval)
+        self.observe(INSTANCE, address, int(exit_code) != 0)
+
+    def store_service_status(self, endpoint, address, status_code, timeout,
+                             value, timestamp=None, interval=None):
+        interval = interval or self.scheduler.interval(
+            (JOB_KINDS[SERVICE], endpoint))
+        self.adapter.store_service_status(endpoint, address, status_code,
+                                          timeout, value, timestamp,
+                                          interval=interval)
+        self.observe(SERVICE, endpoint, status_code not in (200, 300))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+'''
+Measures how downtimer copes with growing numbers of targets, without
+OpenStack. For every scale a fresh process probes local fake targets for
+a while and reports probes per second, scheduling lag, rows written per
+second, CPU use, peak RSS, and how long importing main and starting up
+took:
+
+    python benchmark.py --scales 10,100,1000 --duration 30 --backend sql
+
+HTTP targets are served by a fake server in a separate process; every
+tenth of them is slow, failing or flapping. Ping targets are loopback
+addresses, every tenth one an unroutable TEST-NET address. Without the
+permission to open ICMP sockets `ping` is run, or with --fake-ping a
+stand-in script which answers after 0.8 seconds like ping -c 5 -i 0.2.
+'''
+
+import argparse
+import BaseHTTPServer
+import json
+import multiprocessing
+import os
+import resource
+import SocketServer
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+SLOW_DELAY = 0.3
+FLAP_PERIOD = 20
+
+CONFIG_TEMPLATE = '''[DEFAULT]
+log_level=WARNING
+log_file={directory}/downtimer.log
+log_format=%%(asctime)s %%(message)s
+pid_file={directory}/downtimer.pid
+report_file={directory}/downtimer.report
+
+[global]
+mode=benchmark
+ping_engine={ping_engine}
+
+[static]
+ips=127.0.0.1
+
+[database]
+adapter={backend}
+host=sqlite:///{directory}/downtimer.db
+
+[influxdb]
+name=benchmark
+
+[live]
+socket=
+
+[metrics]
+port=0
+
+[profiler]
+directory=
+'''
+
+FAKE_PING = '''#!/bin/sh
+sleep 0.8
+echo "5 packets transmitted, 5 received, 0% packet loss, time 801ms"
+'''
+
+
+class FakeEndpointHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    /ok-N/, /slow-N/, /fail-N/ and /flap-N/ answer 200 at once, 200
+    after a delay, always 503, and 200 or 503 every other FLAP_PERIOD.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        behaviour = self.path.strip('/').split('-')[0]
+        status = 200
+        if behaviour == 'slow':
+            time.sleep(SLOW_DELAY)
+        elif behaviour == 'fail':
+            status = 503
+        elif behaviour == 'flap' and int(time.time() / FLAP_PERIOD) % 2:
+            status = 503
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_HEAD
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeEndpointServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def serve_endpoints(port_queue):
+    server = FakeEndpointServer(('127.0.0.1', 0), FakeEndpointHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def http_path(i):
+    return ('slow', 'fail', 'flap')[i % 10] if i % 10 < 3 else 'ok'
+
+
+def ping_address(i):
+    if i % 10 == 9:
+        return '192.0.2.%d' % (i % 254 + 1)
+    return '127.%d.%d.%d' % (1 + i // 65025, i // 255 % 255, i % 255 + 1)
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def run_scale(targets, duration, http_share):
+    loading = time.time()
+    import main
+    imported = time.time()
+    from db_adapters import DBAdapter
+
+    class MemoryAdapter(DBAdapter):
+        def __init__(self, config):
+            self.stored = 0
+            self.target_tags = {}
+
+        def store_instance_status(self, *args, **kwargs):
+            self.stored += 1
+
+        def store_service_status(self, *args, **kwargs):
+            self.stored += 1
+
+    class Benchmark(main.Downtimer):
+        def handle_benchmark(self):
+            http_targets = int(targets * http_share)
+            for i in range(http_targets):
+                self.add_service_target(
+                    'fake-%d' % i, 'http://127.0.0.1:%d/%s-%d/' %
+                    (port, http_path(i), i))
+            for i in range(targets - http_targets):
+                self.add_ping_target(ping_address(i))
+
+    main.adapters['memory'] = MemoryAdapter
+    serving = time.time()
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_endpoints,
+                                     args=(port_queue,))
+    server.daemon = True
+    server.start()
+    port = port_queue.get()
+    serving = time.time() - serving
+
+    downtimer = Benchmark()
+    backend = downtimer.db_adapter
+    while hasattr(backend, 'adapter'):
+        backend = backend.adapter
+    downtimer.start_pipeline()
+    downtimer.handle_benchmark()
+    # the fake server doesn't count as startup
+    startup = time.time() - loading - serving
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+    downtimer.scheduler.start()
+    time.sleep(duration)
+    elapsed = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    stats = downtimer.scheduler.stats()
+    runs = sum(kind['runs'] for kind in stats.values())
+    lags = [kind['max_lag'] for kind in stats.values()] or [0.0]
+    mean_lag = (sum(kind['total_lag'] for kind in stats.values()) /
+                runs if runs else 0.0)
+    if hasattr(backend, 'writer'):
+        written = backend.writer.stats()['written']
+    else:
+        written = getattr(backend, 'stored', 0)
+    result = {
+        'targets': targets,
+        'probes_per_sec': runs / elapsed,
+        'mean_lag_ms': mean_lag * 1e3,
+        'max_lag_ms': max(lags) * 1e3,
+        'missed': sum(kind['missed'] for kind in stats.values()),
+        'overrun': sum(kind['overrun'] for kind in stats.values()),
+        'rows_per_sec': written / elapsed,
+        'cpu_percent': 100.0 * (after.ru_utime + after.ru_stime -
+                                usage.ru_utime - usage.ru_stime) / elapsed,
+        'rss_mb': rss_kb() / 1024.0,
+        'max_rss_mb': after.ru_maxrss / 1024.0,
+        'import_ms': (imported - loading) * 1e3,
+        'startup_ms': startup * 1e3,
+    }
+    server.terminate()
+    return result
+
+
+def install_fake_ping(directory):
+    path = os.path.join(directory, 'ping')
+    with open(path, 'w') as f:
+        f.write(FAKE_PING)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ['PATH'] = directory + os.pathsep + os.environ['PATH']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark downtimer '
+                                                 'against local fake targets')
+    parser.add_argument('--scales', default='10,100,1000,10000',
+                        help='comma separated numbers of targets')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to probe at every scale')
+    parser.add_argument('--backend', choices=('memory', 'sql'),
+                        default='memory',
+                        help='count samples in memory or write them to '
+                             'SQLite')
+    parser.add_argument('--http-share', type=float, default=0.5,
+                        help='share of the targets which are HTTP endpoints')
+    parser.add_argument('--ping-engine', choices=('native', 'subprocess'),
+                        default='native')
+    parser.add_argument('--fake-ping', action='store_true',
+                        help='run a stand-in for ping subprocesses')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        # probes print their results
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        result = run_scale(args.run, args.duration, args.http_share)
+        stdout.write(json.dumps(result) + '\n')
+        stdout.flush()
+        # don't wait for the probing threads
+        os._exit(0)
+
+    directory = tempfile.mkdtemp(prefix='downtimer-benchmark-')
+    config = os.path.join(directory, 'conf.ini')
+    with open(config, 'w') as f:
+        f.write(CONFIG_TEMPLATE.format(directory=directory,
+                                       backend=args.backend,
+                                       ping_engine=args.ping_engine))
+    if args.fake_ping:
+        install_fake_ping(directory)
+    env = dict(os.environ, DOWNTIMER_CONFIG=config)
+
+    columns = ('targets', 'probes_per_sec', 'mean_lag_ms', 'max_lag_ms',
+               'missed', 'overrun', 'rows_per_sec', 'cpu_percent', 'rss_mb',
+               'max_rss_mb', 'import_ms', 'startup_ms')
+    print(' '.join('%14s' % column for column in columns))
+    for scale in args.scales.split(','):
+        # a process per scale, so that RSS and threads don't carry over
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--run', scale,
+             '--duration', str(args.duration),
+             '--http-share', str(args.http_share)],
+            env=env, cwd=directory)
+        result = json.loads(output.splitlines()[-1])
+        print(' '.join('%14.1f' % result[column] for column in columns))
+        sys.stdout.flush()
+    print('Logs and databases are kept in %s' % directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import calendar
+import logging
+import threading
+
+from datetime import datetime
+
+from db_adapters import AdapterWrapper, INSTANCE, SERVICE
+
+logger = logging.getLogger(__name__)
+
+
+class Run(object):
+    '''
+    Samples of one target in the same state and heartbeat slot, probed at
+    the same interval: the fields of the first of them, their number and
+    their summed loss.
+    '''
+    __slots__ = ('state', 'slot', 'interval', 'timestamp', 'fields',
+                 'samples', 'lost')
+
+    def __init__(self, state, slot, interval, timestamp, fields, samples,
+                 lost):
+        self.state = state
+        self.slot = slot
+        self.interval = interval
+        self.timestamp = timestamp
+        self.fields = fields
+        self.samples = samples
+        self.lost = lost
+
+
+class ChangeOnlyWriter(AdapterWrapper):
+    '''
+    Writes a row only when a target changes state, and otherwise once per
+    heartbeat: samples in the same state within a slot of `heartbeat`
+    seconds, aligned to multiples of it, are summed into one row dated
+    from the first of them with a `samples` count. The state of a ping
+    is its exit code and whether it lost `loss_threshold` percent or
+    more, of an HTTP check its status code. A new probe interval starts
+    a new row too.
+
+    Counts over windows aligned to the heartbeat, like those of the
+    rollups and of hourly reports, are the same as with a row per
+    sample, and every state change keeps its exact time. Other windows
+    split the rows they cut as if the samples were evenly spread over
+    them (see DBAdapter.split_rows), which is exact while the probes
+    keep their interval. Latencies of
+    all but the first sample of a row are dropped; the latency sketches
+    see them before they get here. Behind a spool, the samples of a run
+    are committed only once it is written (see SpoolAdapter).
+    '''
+    def __init__(self, adapter, heartbeat=60, loss_threshold=20.0):
+        self.adapter = adapter
+        self.heartbeat = heartbeat
+        self.loss_threshold = loss_threshold
+        self.runs = {}
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.samples = 0
+
+    def slot(self, timestamp):
+        epoch = calendar.timegm(timestamp.timetuple()) + \
+            timestamp.microsecond / 1e6
+        return int(epoch // self.heartbeat)
+
+    def store_instance_status(self, address, total_time, exit_code, value,
+                              timestamp=None, samples=1, rtt=None,
+                              interval=None):
+        state = (int(exit_code),
+                 float(value) >= self.loss_threshold * samples)
+        self.add(INSTANCE, address, state, timestamp,
+                 (total_time, exit_code), samples, interval, float(value))
+
+    def store_service_status(self, endpoint, address, status_code, timeout,
+                             value, timestamp=None, samples=1,
+                             interval=None):
+        self.add(SERVICE, endpoint, status_code, timestamp,
+                 (address, status_code, timeout, value), samples, interval)
+
+    def add(self, kind, target, state, timestamp, fields, samples, interval,
+            lost=0.0):
+        timestamp = timestamp or datetime.utcnow()
+        slot = self.slot(timestamp)
+        with self.lock:
+            self.samples += samples
+            run = self.runs.get((kind, target))
+            if run is not None and run.state == state and \
+                    run.slot == slot and run.interval == interval:
+                run.samples += samples
+                run.lost += lost
+                return
+            if run is not None:
+                self.write(kind, target, run)
+            self.runs[(kind, target)] = Run(state, slot, interval, timestamp,
+                                            fields, samples, lost)
+
+    def write(self, kind, target, run):
+        '''Saves a run as one row, called with the lock held.'''
+        self.rows += 1
+        if kind == INSTANCE:
+            total_time, exit_code = run.fields
+            self.adapter.store_instance_status(target, total_time, exit_code,
+                                               run.lost, run.timestamp,
+                                               run.samples,
+                                               interval=run.interval)
+        else:
+            address, status_code, timeout, value = run.fields
+            self.adapter.store_service_status(target, address, status_code,
+                                              timeout, value, run.timestamp,
+                                              run.samples,
+                                              interval=run.interval)
+
+    def flush(self, now=None):
+        '''Saves the runs of finished heartbeat slots, or all without `now`.'''
+        current = None if now is None else self.slot(now)
+        with self.lock:
+            for key, run in self.runs.items():
+                if current is None or run.slot < current:
+                    self.write(key[0], key[1], self.runs.pop(key))
+
+    def held_since(self):
+        with self.lock:
+            return min([run.timestamp for run in self.runs.values()] or
+                       [None])
+
+    def flush_finished(self):
+        self.flush(datetime.utcnow())
+
+    def close(self):
+        self.flush()
+        logger.info('Wrote %d rows for %d samples', self.rows, self.samples)
+        self.adapter.close()
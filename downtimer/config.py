@@ -1,7 +1,38 @@
 import ConfigParser
+import os
 import socket
 
 CONFIG_FILE = "/etc/downtimer/conf.ini"
+_config = None
+
+
+def get_option(conf, section, option, default, convert=str):
+    try:
+        return convert(conf.get(section, option))
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
+
+
+class CloudConfig(object):
+    '''
+    One cloud and region to discover targets in, from the [openstack]
+    section or an [openstack:<name>] section. Options missing from the
+    latter are taken from [openstack].
+    '''
+    def __init__(self, conf, section):
+        def option(name, default=None):
+            return get_option(conf, section, name,
+                              get_option(conf, 'openstack', name, default))
+
+        self.name = section.partition(':')[2] or 'default'
+        self.auth_url = option('endpoint')
+        self.user = option('user')
+        self.password = option('password')
+        self.endpoint_interface = option('interface', 'public')
+        self.region = option('region')
+        # cloud and region tags of the samples of its targets
+        self.tags = {'cloud': option('cloud', self.name),
+                     'region': self.region or ''}
 
 
 class Config(object):
@@ -17,6 +48,49 @@ class Config(object):
 
         self.mode = conf.get('global', 'mode')
 
+        # native sends ICMP echoes from one socket, subprocess forks `ping`
+        self.ping_engine = get_option(conf, 'global', 'ping_engine',
+                                      'native')
+        self.http_pool_size = get_option(conf, 'global', 'http_pool_size',
+                                         4, int)
+        self.dns_ttl = get_option(conf, 'global', 'dns_ttl', 60, int)
+
+        # seconds between probes of each kind of target and number of
+        # threads running blocking probes (HTTP checks, ping subprocesses)
+        self.ping_interval = get_option(conf, 'scheduler', 'ping_interval',
+                                        2.0, float)
+        self.http_interval = get_option(conf, 'scheduler', 'http_interval',
+                                        2.0, float)
+        self.scheduler_workers = get_option(conf, 'scheduler', 'workers',
+                                            32, int)
+        # failing targets are probed every fast_interval seconds, healthy
+        # ones less often (up to max_interval) to stay within budget
+        # probes per second
+        self.adaptive = get_option(conf, 'scheduler', 'adaptive',
+                                   'False') in ('1', 'True', 'true')
+        self.fast_interval = get_option(conf, 'scheduler', 'fast_interval',
+                                        0.2, float)
+        self.max_interval = get_option(conf, 'scheduler', 'max_interval',
+                                       10.0, float)
+        self.probe_budget = get_option(conf, 'scheduler', 'budget', 0.0,
+                                       float)
+        self.recovery_probes = get_option(conf, 'scheduler', 'recovery', 3,
+                                          int)
+
+        # targets are split by consistent hashing between `processes`
+        # worker processes on each of the `nodes`, this host being `node`
+        self.shard_processes = get_option(conf, 'sharding', 'processes', 1,
+                                          int)
+        self.shard_node = get_option(conf, 'sharding', 'node',
+                                     socket.gethostname())
+        self.shard_nodes = get_option(conf, 'sharding', 'nodes',
+                                      [self.shard_node],
+                                      lambda nodes: [node.strip() for node
+                                                     in nodes.split(',')])
+        if self.shard_node not in self.shard_nodes:
+            raise AttributeError('Node %s is not listed in nodes option '
+                                 'in config file' % self.shard_node)
+
         if self.mode == 'static':
             ips_str = conf.get('static', 'ips')
             if not ips_str:
@@ -31,12 +105,69 @@ class Config(object):
                                          'to ips option in config file' % ip)
 
         elif self.mode == 'openstack':
-            self.auth_url = conf.get('openstack', 'endpoint')
-            self.user = conf.get('openstack', 'user')
-            self.password = conf.get('openstack', 'password')
+            self.clouds = [CloudConfig(conf, 'openstack')]
+            self.clouds.extend(CloudConfig(conf, section)
+                               for section in sorted(conf.sections())
+                               if section.startswith('openstack:'))
+            # seconds between looking for new and removed targets (0 turns
+            # it off) and between full listings of floating ips
+            self.discovery_interval = get_option(
+                conf, 'openstack', 'discovery_interval', 300.0, float)
+            self.resync_interval = get_option(
+                conf, 'openstack', 'resync_interval', 3600.0, float)
+            self.discovery_page_size = get_option(
+                conf, 'openstack', 'page_size', 500, int)
+            # the endpoint catalogs are fetched at most once per catalog_ttl
+            self.catalog_ttl = get_option(conf, 'openstack', 'catalog_ttl',
+                                          900.0, float)
 
         self.db_adapter = conf.get('database', 'adapter')
         self.db_host = conf.get('database', 'host')
+        # samples are written in batches by a background thread
+        self.batch_size = get_option(conf, 'database', 'batch_size', 500,
+                                     int)
+        self.flush_interval = get_option(conf, 'database', 'flush_interval',
+                                         1.0, float)
+        self.buffer_size = get_option(conf, 'database', 'buffer_size',
+                                      100000, int)
+        # seconds between saving per target running totals
+        self.rollup_interval = get_option(conf, 'database',
+                                          'rollup_interval', 10.0, float)
+        # changes writes a row per state change and heartbeat seconds
+        # instead of per sample; pings losing loss_threshold percent or
+        # more are in another state than those losing less
+        self.write_mode = get_option(conf, 'database', 'write_mode', 'full')
+        self.heartbeat = get_option(conf, 'database', 'heartbeat', 60, int)
+        self.loss_threshold = get_option(conf, 'database', 'loss_threshold',
+                                         20.0, float)
+
+        # probes append samples to a local spool in this directory which
+        # is replayed into the database, empty turns it off
+        self.spool_dir = get_option(conf, 'spool', 'directory', '')
+        self.spool_segment_size = get_option(conf, 'spool', 'segment_size',
+                                             4, int) << 20
+        self.spool_max_size = get_option(conf, 'spool', 'max_size', 256,
+                                         int) << 20
+
+        # recent samples of every target are kept in memory and served
+        # as JSON on a UNIX socket, empty socket turns serving off
+        self.live_status = get_option(conf, 'live', 'enabled',
+                                      'False') in ('1', 'True', 'true')
+        # minutes of samples kept, the longest a status query covers
+        self.live_window = get_option(conf, 'live', 'window', 10, float)
+        self.status_socket = get_option(conf, 'live', 'socket', '')
+
+        # Prometheus metrics of the probes are served over HTTP on this
+        # address and port, port 0 turns it off
+        self.metrics_address = get_option(conf, 'metrics', 'address',
+                                          '127.0.0.1')
+        self.metrics_port = get_option(conf, 'metrics', 'port', 0, int)
+
+        # SIGUSR2 starts and stops sampling the daemon's stacks every
+        # interval seconds, written to a file in directory when stopped
+        self.profile_dir = get_option(conf, 'profiler', 'directory', '')
+        self.profile_interval = get_option(conf, 'profiler', 'interval',
+                                           0.005, float)
 
         if self.db_adapter == 'influx':
             self.db_port = conf.get('influxdb', 'port')
@@ -50,10 +181,41 @@ class Config(object):
             except Exception:
                 # 4444 is a default udp port for InfluxDBClient
                 self.udp_port = 4444
+            self.use_gzip = get_option(conf, 'influxdb', 'gzip', 'True') in \
+                true_vars
+            # report queries fetch this many series per request
+            self.series_page_size = get_option(conf, 'influxdb',
+                                               'series_page_size', 1000, int)
+
+        # samples are turned into outages once a target failed
+        # down_threshold probes in a row, until up_threshold good ones
+        self.detect_outages = get_option(conf, 'outages', 'enabled',
+                                         'True') in ('1', 'True', 'true')
+        self.outage_down_threshold = get_option(conf, 'outages',
+                                                'down_threshold', 2, int)
+        self.outage_up_threshold = get_option(conf, 'outages',
+                                              'up_threshold', 2, int)
+
+        # latency quantile sketches per target and bucket of seconds
+        self.latency_sketches = get_option(conf, 'sketches', 'enabled',
+                                           'True') in ('1', 'True', 'true')
+        self.sketch_bucket = get_option(conf, 'sketches', 'bucket', 300, int)
+        self.sketch_accuracy = get_option(conf, 'sketches', 'accuracy', 0.01,
+                                          float)
+
         # Set the database name
         try:
             self.db_name = conf.get('influxdb', 'name')
         except ConfigParser.NoOptionError:
             self.db_name = 'endpoints'
 
-CONF = Config(CONFIG_FILE)
+
+def get_config():
+    '''
+    The configuration, parsed on first use from the file named by the
+    DOWNTIMER_CONFIG environment variable or CONFIG_FILE.
+    '''
+    global _config
+    if _config is None:
+        _config = Config(os.environ.get('DOWNTIMER_CONFIG', CONFIG_FILE))
+    return _config
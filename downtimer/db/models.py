@@ -1,10 +1,14 @@
 import sqlalchemy as sa
 from oslo_utils import uuidutils
-from sqlalchemy import create_engine
+from datetime import datetime
+from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+# MySQL drops the fractional part of DATETIME columns unless asked to keep it
+Timestamp = sa.DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql')
+
 
 class HasId(object):
     """id mixin, add to subclasses that have an id."""
@@ -15,21 +19,104 @@ class HasId(object):
 
 class Service(Base, HasId):
     __tablename__ = 'services'
+    # covers the per endpoint aggregation of the report
+    __table_args__ = (
+        sa.Index('ix_services_endpoint_status_code', 'endpoint',
+                 'status_code'),
+        sa.Index('ix_services_timestamp', 'timestamp'),
+    )
 
     endpoint = sa.Column(sa.String(255))
     address = sa.Column(sa.String(255))
     status_code = sa.Column(sa.Integer)
     timeout = sa.Column(sa.Float)
     elapsed_time = sa.Column(sa.Float)
+    timestamp = sa.Column(Timestamp, default=datetime.utcnow)
+    cloud = sa.Column(sa.String(64))
+    region = sa.Column(sa.String(64))
+    # samples the row stands for, NULL in rows written before it existed
+    samples = sa.Column(sa.Integer)
+    # seconds the samples stand for and those the target was down in
+    seconds = sa.Column(sa.Float)
+    down_seconds = sa.Column(sa.Float)
 
 
 class Instance(Base, HasId):
     __tablename__ = 'instances'
+    # covers the per address aggregation of the report
+    __table_args__ = (
+        sa.Index('ix_instances_address_packet_loss', 'address',
+                 'packet_loss'),
+        sa.Index('ix_instances_timestamp', 'timestamp'),
+    )
 
     address = sa.Column(sa.String(255))
     total_time = sa.Column(sa.Float)
     exit_code = sa.Column(sa.Integer)
     packet_loss = sa.Column(sa.Float)
+    timestamp = sa.Column(Timestamp, default=datetime.utcnow)
+    cloud = sa.Column(sa.String(64))
+    region = sa.Column(sa.String(64))
+    samples = sa.Column(sa.Integer)
+    seconds = sa.Column(sa.Float)
+    down_seconds = sa.Column(sa.Float)
+
+
+class Outage(Base, HasId):
+    """A period during which a target was considered down."""
+    __tablename__ = 'outages'
+    __table_args__ = (
+        sa.Index('ix_outages_start', 'start'),
+    )
+
+    kind = sa.Column(sa.String(16))
+    target = sa.Column(sa.String(255))
+    start = sa.Column(Timestamp)
+    end = sa.Column(Timestamp)
+    duration = sa.Column(sa.Float)
+    worst_status = sa.Column(sa.Float)
+
+
+class Sketch(Base, HasId):
+    """Latency sketch of one target over one time bucket."""
+    __tablename__ = 'sketches'
+    __table_args__ = (
+        sa.Index('ix_sketches_start', 'start'),
+    )
+
+    kind = sa.Column(sa.String(16))
+    target = sa.Column(sa.String(255))
+    start = sa.Column(Timestamp)
+    sketch = sa.Column(sa.Text)
+
+
+class Rollup(Base):
+    """Running totals of the samples stored for one target."""
+    __tablename__ = 'rollups'
+
+    kind = sa.Column(sa.String(16), primary_key=True)
+    target = sa.Column(sa.String(255), primary_key=True)
+    total = sa.Column(sa.Integer)
+    failed = sa.Column(sa.Integer)
+    lost = sa.Column(sa.Float)
+    seconds = sa.Column(sa.Float)
+    down_seconds = sa.Column(sa.Float)
+    state = sa.Column(sa.Integer)
+    last_change = sa.Column(sa.DateTime)
+
 
-engine = create_engine('sqlite:///downtimer.db')
-Base.metadata.create_all(engine)
+def create_schema(engine):
+    """
+    Creates the tables and indexes which don't exist yet, and adds the
+    columns which were added to the models since a table was created.
+    """
+    Base.metadata.create_all(engine)
+    inspector = sa.inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in
+                       inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name,
+                    column.type.compile(engine.dialect)))
@@ -1,230 +1,290 @@
-import influxdb
+import calendar
+import logging
+import math
+import threading
+import time
 
 from datetime import datetime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
-from db.models import Base, Service, Instance
-import logging
+# longest pause between attempts to write a batch that failed
+MAX_BACKOFF = 30
+
+INSTANCE = 'instance'
+SERVICE = 'service'
+INFLUX_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+INFLUX_PRECISE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# samples fetched at a time by iter_samples
+SAMPLE_CHUNK_SIZE = 50000
+# target name and the counters of a status which split_rows() adjusts
+STATUS_FIELDS = {INSTANCE: ('address', 'attempts', 'failed', 'lost_pkts'),
+                 SERVICE: ('service', 'total_uptime', 'srv_downtime', None)}
+
+
+def to_epoch(timestamp):
+    return calendar.timegm(timestamp.timetuple()) + \
+        timestamp.microsecond / 1e6
+
+
+def sample_times(start, samples, step, since=None, until=None):
+    '''
+    Epochs of the samples of a row, `samples` of them `step` seconds
+    apart from `start` on, which fall within [since, until).
+    '''
+    first, end = 0, samples
+    # times are kept to the microsecond
+    if since is not None:
+        first = max(first, int(math.ceil((since - start) / step - 1e-6)))
+    if until is not None:
+        end = min(end, int(math.ceil((until - start) / step - 1e-6)))
+    return [start + i * step for i in range(first, end)]
+
+
+class RollupCounters(object):
+    '''
+    Per target running totals: number of probes, failed probes, lost
+    packets, the seconds the probes stand for and how many of them the
+    target was down (see DBAdapter.weigh), current state and the time it
+    last changed. They're updated as samples are stored, so a report
+    needs a single row per target.
+    '''
+    FIELDS = ('kind', 'target', 'total', 'failed', 'lost', 'seconds',
+              'down_seconds', 'state', 'last_change')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.targets = {}
+        self.dirty = set()
+
+    def load(self, rows):
+        with self.lock:
+            for row in rows:
+                key = (row['kind'], row['target'])
+                # rows saved before the seconds were kept start from 0
+                self.targets[key] = dict(
+                    row, seconds=row.get('seconds') or 0.0,
+                    down_seconds=row.get('down_seconds') or 0.0)
+
+    def add(self, kind, target, failed, lost=0.0, timestamp=None,
+            samples=1, seconds=0.0, down_seconds=0.0):
+        key = (kind, target)
+        state = int(failed)
+        timestamp = timestamp or datetime.utcnow()
+        with self.lock:
+            rollup = self.targets.get(key)
+            if rollup is None:
+                rollup = self.targets[key] = {
+                    'kind': kind, 'target': target, 'total': 0,
+                    'failed': 0, 'lost': 0.0, 'seconds': 0.0,
+                    'down_seconds': 0.0, 'state': None,
+                    'last_change': None}
+            rollup['total'] += samples
+            rollup['failed'] += state * samples
+            rollup['lost'] += lost
+            rollup['seconds'] += seconds
+            rollup['down_seconds'] += down_seconds
+            if rollup['state'] != state:
+                rollup['state'] = state
+                rollup['last_change'] = timestamp
+            self.dirty.add(key)
+
+    def pop_dirty(self):
+        with self.lock:
+            rows = [dict(self.targets[key]) for key in self.dirty]
+            self.dirty = set()
+        return rows
+
+    def get(self, kind):
+        with self.lock:
+            return [dict(rollup) for key, rollup in self.targets.items()
+                    if key[0] == kind]
 
 
 class DBAdapter(object):
-    def store_instance_status(self, address, total_time, exit_code, value):
+    '''
+    The storing adapters take a `samples` count: a row may stand for that
+    many samples of the same state, with `value` the packet loss summed
+    over them (see changes.ChangeOnlyWriter). `rtt` is the slowest
+    round trip of a ping in ms, or None if nothing came back; `total_time`
+    also counts the spacing of the echo requests. They store no `rtt`.
+
+    `interval` is the number of seconds the target was probed every when
+    the samples were taken, by default the base interval of its kind in
+    `self.intervals`. Availability is the share of those seconds the
+    target was up, so that fast probes of a failing target don't count
+    more than the slow ones of a healthy target.
+    '''
+    def store_instance_status(self, address, total_time, exit_code, value,
+                              timestamp=None, samples=1, rtt=None,
+                              interval=None):
         pass
 
     def store_service_status(self, endpoint, address, status_code, timeout,
-                             value):
+                             value, timestamp=None, samples=1,
+                             interval=None):
         pass
 
-    def get_instance_statuses(self):
+    def weigh(self, kind, failed, lost, samples, interval):
+        '''
+        Seconds which `samples` samples probed every `interval` seconds
+        stand for and how many of them the target was down: the share of
+        lost packets `lost` summed over them of a ping, all of a failed
+        HTTP check.
+        '''
+        interval = interval or self.intervals[kind]
+        if kind == INSTANCE:
+            return samples * interval, lost * interval
+        return samples * interval, samples * interval * int(failed)
+
+    def split_rows(self, kind, statuses, rows, since, until):
+        '''
+        Window statuses count a row of several samples as a whole, by the
+        time of its first sample. Corrects `statuses` for `rows`, tuples
+        of (target, epoch, samples, failed, lost, seconds, down_seconds)
+        which the window [since, until), given as epochs, may cut; the
+        samples of a row are taken as spread evenly over its seconds.
+        '''
+        name, total, failures, loss = STATUS_FIELDS[kind]
+        targets = dict((status[name], status) for status in statuses)
+        for target, start, samples, failed, lost, seconds, down_seconds \
+                in rows:
+            counted = samples if (since is None or start >= since) and \
+                (until is None or start < until) else 0
+            inside = len(sample_times(start, samples, seconds / samples,
+                                      since, until))
+            if inside == counted:
+                continue
+            status = targets.get(target)
+            if status is None:
+                status = targets[target] = {name: target, total: 0,
+                                            failures: 0, 'duration': 0.0,
+                                            'downtime': 0.0}
+                if loss:
+                    status[loss] = 0.0
+                statuses.append(status)
+            share = (inside - counted) / float(samples)
+            status[total] += inside - counted
+            status[failures] += (inside - counted) * int(failed)
+            if loss:
+                status[loss] += lost * share
+            status['duration'] += seconds * share
+            status['downtime'] += down_seconds * share
+
+    def get_instance_statuses(self, since=None, until=None):
+        '''
+        Per address lost packets, probes, and the seconds the probes
+        stand for as duration and those lost as downtime.
+        '''
         pass
 
-    def get_service_statuses(self):
+    def get_service_statuses(self, since=None, until=None):
+        '''
+        Per endpoint failed and all checks as srv_downtime and
+        total_uptime, and the seconds they stand for as downtime and
+        duration.
+        '''
         pass
 
+    def store_outage(self, outage):
+        pass
 
-class InfluxDBAdapter(DBAdapter):
-    def __init__(self, config):
-        self.logger = logging.getLogger('InfluxDBAdapter')
-        self.db_url = 'http://{host}:{port}/write?db={name}'.format(
-            host=config.db_host,
-            port=config.db_port,
-            name=config.db_name
-        )
-        self.client = influxdb.InfluxDBClient(config.db_host, config.db_port,
-                                              use_udp=config.use_udp,
-                                              udp_port=config.udp_port,
-                                              database=config.db_name)
-
-    def store_instance_status(self, address, total_time, exit_code, value):
-        current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-        json_body = [
-            {
-                "measurement": "floating_ip_pings",
-                "tags": {
-                    "address": address
-                },
-                "time": current_time,
-                "fields": {
-                    "total_time": total_time,
-                    "exit_code": exit_code,
-                    "value": value
-                }
-            }
-        ]
-        self.client.write_points(json_body)
+    def get_outages(self, since=None, until=None):
+        return []
+
+    def tag_target(self, kind, target, tags):
+        '''
+        Labels the samples of the target stored from now on, e.g. with the
+        cloud and region it was discovered in.
+        '''
+        self.target_tags[(kind, target)] = dict(tags)
+
+    def get_tags(self, kind, target):
+        return self.target_tags.get((kind, target), {})
+
+    def get_target_tags(self, kind):
+        '''Tags of the stored targets of one kind by target.'''
+        return dict((target, tags) for (tag_kind, target), tags
+                    in self.target_tags.items()
+                    if tag_kind == kind)
+
+    def store_sketches(self, rows):
+        '''
+        Saves latency sketches: dicts of kind, target, start of the time
+        bucket and the serialized sketch. Rows of the same target and
+        bucket add up, they never replace each other.
+        '''
+        pass
 
-    def store_service_status(self, endpoint, address, status_code, timeout,
-                             value):
-        current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-        json_body = [
-            {
-                "measurement": "service_response",
-                "tags": {
-                    "service_name": endpoint,
-                    "address": address
-                },
-                "time": current_time,
-                "fields": {
-                    "status_code": float(status_code),
-                    "timeout": float(timeout),
-                    "value": float(value)
-                }
-            }
-        ]
-
-        self.client.write_points(json_body)
-
-    def get_instance_statuses(self):
-        tags_resp = self.client.query('show tag values from floating_ip_pings '
-                                      'with key=address;')
-        addresses = [item['value'] for item in
-                     tags_resp[(u'floating_ip_pings', None)]]
-        total_ping = self.client.query('select count(value) from '
-                                       'floating_ip_pings group by address;')
-
-        try:
-            bad_ping_exit_code = self.client.query(
-                'select sum(value) from floating_ip_pings'
-                ' where exit_code <> 0 group by address;'
-            )
-        except influxdb.exceptions.InfluxDBClientError:
-            bad_ping_exit_code = 0
-
-        try:
-            partially_lost_ping = self.client.query(
-                'select sum(value) from floating_ip_pings'
-                ' where exit_code = 0 group by address;'
-            )
-        except influxdb.exceptions.InfluxDBClientError:
-            partially_lost_ping = 0
-
-        statuses = []
-
-        for address in addresses:
-            key = ('floating_ip_pings', {'address': address})
-            try:
-                value = total_ping[key].next()
-                pkts_total = value['count']
-            except:
-                self.logger.warn("There's no records about address", address)
-                continue
+    def get_sketches(self, since=None, until=None):
+        '''Sketch rows of the buckets starting within [since, until).'''
+        return []
+
+    def iter_samples(self, kind, since=None, until=None):
+        '''
+        Raw samples of one kind within [since, until) as lists of
+        (target, epoch seconds, failed, seconds it stands for, seconds
+        down) tuples, at most SAMPLE_CHUNK_SIZE at a time, in time order
+        of their rows. The samples of a row are spread evenly over its
+        seconds and share its down seconds.
+        '''
+        return iter([])
+
+    def close(self):
+        pass
 
-            try:
-                value = bad_ping_exit_code[key].next()
-                failed_ping = value['sum']
-            except:
-                failed_ping = 0
+    def retry_failed_writes(self):
+        '''Keep the samples of failed writes queued instead of dropping.'''
+        pass
 
+    def pending(self):
+        '''Number of samples stored but not written to the database yet.'''
+        return 0
+
+    def held_since(self):
+        '''
+        Time of the oldest sample stored but held back in memory, not
+        handed to the database yet, or None.
+        '''
+        return None
+
+    def start_rollups(self, interval):
+        self.rollups = RollupCounters()
+        self.rollups.load(self.load_rollups())
+        self.rollup_interval = interval
+        worker = threading.Thread(target=self._rollup_loop)
+        worker.daemon = True
+        worker.start()
+
+    def _rollup_loop(self):
+        while True:
+            time.sleep(self.rollup_interval)
             try:
-                value = partially_lost_ping[key].next()
-                lost_ping = value['sum']
-            except:
-                lost_ping = 0
-
-            failed = (failed_ping + lost_ping) / 100.0
-
-            statuses.append({'address': address, 'lost_pkts': failed,
-                             'attempts': pkts_total})
-
-        return statuses
-
-    def get_service_statuses(self):
-        services_ref = self.client.query('show tag values from '
-                                         'service_response '
-                                         'with key = service_name')
-        service_to_track = [x['value'] for x in
-                            services_ref[('service_response', None)]]
+                self.flush_rollups()
+            except Exception as e:
+                logging.getLogger('DBAdapter').error(
+                    'Failed to save rollups: %s', e)
 
-        total_srv = self.client.query('select count(value) from '
-                                      'service_response '
-                                      'group by service_name;')
-        bad_srv = self.client.query(
-            'select count(value) from service_response where '
-            'status_code <> 200 and status_code <> 300 '
-            'group by service_name;')
+    def flush_rollups(self):
+        rows = self.rollups.pop_dirty()
+        if rows:
+            self.save_rollups(rows)
 
-        services = []
+    def load_rollups(self):
+        return []
 
-        for service in service_to_track:
-            key = ('service_response', {'service_name': service})
-            try:
-                value = total_srv[key].next()
-                total_uptime = value['count']
-            except:
-                self.logger.warn("There's no records for service", service)
-                continue
+    def save_rollups(self, rows):
+        pass
 
-            try:
-                value = bad_srv[key].next()
-                srv_downtime = value['count']
-            except:
-                srv_downtime = 0
-
-            services.append({'service': service, 'srv_downtime': srv_downtime,
-                             'total_uptime': total_uptime})
-
-        return services
-
-
-class SQLDBAdapter(DBAdapter):
-    def __init__(self, config):
-        self.logger = logging.getLogger('SQLDBAdapter')
-        self.engine = create_engine(config.db_host)
-        Base.metadata.bind = self.engine
-        self.DBSession = sessionmaker()
-        self.DBSession.bind = self.engine
-
-    def store_instance_status(self, address, total_time, exit_code,
-                              packet_loss):
-        instance = Instance(address=address,
-                            total_time=total_time,
-                            exit_code=exit_code,
-                            packet_loss=packet_loss)
-        session = self.DBSession()
-        session.add(instance)
-        session.commit()
 
-    def store_service_status(self, endpoint, address, status_code, timeout,
-                             elapsed_time):
-        service = Service(endpoint=endpoint,
-                          address=address,
-                          status_code=status_code,
-                          timeout=timeout,
-                          elapsed_time=elapsed_time)
-        session = self.DBSession()
-        session.add(service)
-        session.commit()
-
-    def get_instance_statuses(self):
-        session = self.DBSession()
-        instance_data = session.query(Instance).all()
-        data = {}
-        for instance in instance_data:
-            if instance.address in data:
-                record = data[instance.address]
-                record['lost_pkts'] += instance.packet_loss / 100.0
-                record['attempts'] += 1
-            else:
-                data[instance.address] = {
-                    'address': instance.address,
-                    'lost_pkts': instance.packet_loss / 100.0,
-                    'attempts': 1}
-        return list(data.values())
-
-    def get_service_statuses(self):
-        session = self.DBSession()
-        service_data = session.query(Service).all()
-        data = {}
-        for service in service_data:
-            if service.endpoint in data:
-                record = data[service.endpoint]
-                if service.status_code not in (200, 300):
-                    record['srv_downtime'] += 1
-                record['total_uptime'] += 1
-            else:
-                srv_downtime = 0 if service.status_code in (200, 300) else 1
-                data[service.endpoint] = {'service': service.endpoint,
-                                          'srv_downtime': srv_downtime,
-                                          'total_uptime': 1}
-        return list(data.values())
+class AdapterWrapper(object):
+    '''
+    Base of the adapters which sit in front of another one, set as
+    `self.adapter`: whatever a wrapper doesn't define itself, typically
+    everything but the store_* methods and close, is looked up on the
+    wrapped adapter, so the whole chain answers reads and new methods.
+    '''
+    def __getattr__(self, name):
+        if name == 'adapter':
+            # not set yet, don't recurse
+            raise AttributeError(name)
+        return getattr(self.adapter, name)
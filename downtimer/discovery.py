@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+from urlparse import urlparse
+import logging
+
+from neutronclient.common import exceptions as neutron_exc
+
+from scheduler import monotonic
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_EXTENSION = 'standard-attr-timestamp'
+CHANGED_SINCE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# incremental queries overlap by this much to allow for clock skew
+CLOCK_SKEW = timedelta(seconds=60)
+
+
+class ServiceCatalog(object):
+    '''
+    Base urls of the services of a cloud by service name.
+
+    All services and all endpoints with the wanted interface (and region)
+    are fetched with one request each and joined locally, instead of
+    looking up the endpoint of every service separately. The result is
+    cached for `ttl` seconds.
+    '''
+    def __init__(self, keystone, interface='public', region=None, ttl=900):
+        self.keystone = keystone
+        self.interface = interface
+        self.region = region
+        self.ttl = ttl
+        self.cached = None
+        self.expires = None
+
+    def services(self):
+        if self.cached is not None and monotonic() < self.expires:
+            return dict(self.cached)
+
+        started = monotonic()
+        names = dict((service.id, service.name)
+                     for service in self.keystone.services.list())
+        endpoints = self.keystone.endpoints.list(interface=self.interface,
+                                                 region_id=self.region)
+        services = {}
+        for endpoint in endpoints:
+            name = names.get(endpoint.service_id)
+            if name is None or name in services:
+                continue
+            url = urlparse(endpoint.url)
+            services[name] = '{0}://{1}'.format(url.scheme, url.netloc)
+        logger.debug('Fetched %d %s endpoints in %.2f seconds',
+                     len(services), self.interface, monotonic() - started)
+
+        self.cached = services
+        self.expires = monotonic() + self.ttl
+        return dict(services)
+
+
+class FloatingIPWatcher(object):
+    '''
+    Keeps track of the active floating ips of a cloud.
+
+    Where Neutron supports the changed_since filter, polls only fetch the
+    floating ips updated since the previous poll. Deleted ones don't show
+    up in such queries, so every `resync_interval` seconds the active ones
+    are listed again. Listings are paginated and fetch two fields only.
+    '''
+    def __init__(self, neutron, page_size=500, resync_interval=3600):
+        self.neutron = neutron
+        self.page_size = page_size
+        self.resync_interval = resync_interval
+        self.active = set()
+        self.last_poll = None
+        self.last_resync = None
+        self.incremental = self._supports_changed_since()
+
+    def _supports_changed_since(self):
+        try:
+            self.neutron.show_extension(TIMESTAMP_EXTENSION)
+            return True
+        except neutron_exc.NotFound:
+            logger.info('Neutron has no %s extension, every discovery will '
+                        'list all floating ips', TIMESTAMP_EXTENSION)
+            return False
+
+    def _resync_due(self):
+        return (not self.incremental or self.last_resync is None or
+                monotonic() - self.last_resync >= self.resync_interval)
+
+    def _list(self, **filters):
+        return self.neutron.list_floatingips(
+            limit=self.page_size, fields=['floating_ip_address', 'status'],
+            **filters)['floatingips']
+
+    def poll(self):
+        '''Returns the floating ips (added, removed) since the last poll.'''
+        started = datetime.utcnow()
+        if self._resync_due():
+            self.last_resync = monotonic()
+            active = set(fip['floating_ip_address']
+                         for fip in self._list(status='ACTIVE'))
+        else:
+            active = set(self.active)
+            since = (self.last_poll - CLOCK_SKEW).strftime(
+                CHANGED_SINCE_FORMAT)
+            for fip in self._list(changed_since=since):
+                if fip['status'] == 'ACTIVE':
+                    active.add(fip['floating_ip_address'])
+                else:
+                    active.discard(fip['floating_ip_address'])
+        self.last_poll = started
+
+        added = active - self.active
+        removed = self.active - active
+        self.active = active
+        return added, removed
@@ -0,0 +1,145 @@
+import logging
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import (HTTPConnection,
+                                                  HTTPSConnection)
+from requests.packages.urllib3.connectionpool import (HTTPConnectionPool,
+                                                      HTTPSConnectionPool)
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+# number of hosts whose connection pools are kept
+HOST_POOLS = 100
+
+
+class DNSCache(object):
+    '''
+    Caches socket.getaddrinfo results for `ttl` seconds so that checking
+    an endpoint every couple of seconds doesn't resolve its name each time.
+    Only the connections of a CachedDNSAdapter use it.
+    '''
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self._getaddrinfo = socket.getaddrinfo
+
+    def getaddrinfo(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        result = self._getaddrinfo(*args, **kwargs)
+        with self.lock:
+            self.entries[key] = (now + self.ttl, result)
+        return result
+
+    def resolve(self, host, port):
+        '''First address of host to connect to.'''
+        return self.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+
+    def forget(self, host, port):
+        with self.lock:
+            self.entries.pop(((host, port, 0, socket.SOCK_STREAM), ()), None)
+
+
+class CachedDNSConnection(object):
+    '''
+    Mixin of urllib3 connections which connect to the address of their
+    host from `dns_cache`. The host name is still the one sent in the
+    Host header and used for TLS. A failed connect drops the cached
+    address, so the next one resolves the name again.
+    '''
+    dns_cache = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        self._dns_host = self.dns_cache.resolve(host, self.port)
+        try:
+            return super(CachedDNSConnection, self)._new_conn()
+        except Exception:
+            self.dns_cache.forget(host, self.port)
+            raise
+        finally:
+            self._dns_host = host
+
+
+class CachedDNSAdapter(HTTPAdapter):
+    '''
+    Transport adapter whose connection pools resolve names through a
+    DNSCache, so the cache only applies to the session it's mounted on
+    and not to the rest of the process.
+    '''
+    def __init__(self, dns_cache, **kwargs):
+        self.pool_classes = {}
+        for scheme, pool, connection in (
+                ('http', HTTPConnectionPool, HTTPConnection),
+                ('https', HTTPSConnectionPool, HTTPSConnection)):
+            connection = type(connection.__name__,
+                              (CachedDNSConnection, connection),
+                              {'dns_cache': dns_cache})
+            self.pool_classes[scheme] = type(pool.__name__, (pool,),
+                                             {'ConnectionCls': connection})
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.pool_classes
+
+
+class HTTPChecker(object):
+    '''
+    Checks every registered endpoint with a shared requests.Session,
+    keeping up to `pool_size` keep-alive connections per host. Checks are
+    blocking jobs of the shared scheduler, which bounds how many of them
+    run at once and skips an endpoint whose previous check still runs.
+    '''
+    def __init__(self, db_adapter, scheduler, pool_size=4, period=2,
+                 dns_ttl=60):
+        self.db_adapter = db_adapter
+        self.scheduler = scheduler
+        self.period = period
+        self.session = requests.Session()
+        if dns_ttl:
+            adapter = CachedDNSAdapter(DNSCache(dns_ttl),
+                                       pool_connections=HOST_POOLS,
+                                       pool_maxsize=pool_size)
+        else:
+            adapter = HTTPAdapter(pool_connections=HOST_POOLS,
+                                  pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.targets = {}
+        self.lock = threading.Lock()
+
+    def add_target(self, endpoint, address):
+        with self.lock:
+            self.targets[endpoint] = address
+        self.scheduler.add(('http', endpoint), lambda: self.check(endpoint),
+                           self.period, kind='http', blocking=True)
+
+    def remove_target(self, endpoint):
+        self.scheduler.remove(('http', endpoint))
+        with self.lock:
+            self.targets.pop(endpoint, None)
+
+    def check(self, endpoint):
+        with self.lock:
+            address = self.targets.get(endpoint)
+        if address is None:
+            return
+        address, status_code, timeout, elapsed = utils.check_endpoint(
+            endpoint, address, http=self.session)
+        with self.lock:
+            if endpoint in self.targets:
+                self.targets[endpoint] = address
+        self.db_adapter.store_service_status(endpoint, address, status_code,
+                                             timeout, elapsed)
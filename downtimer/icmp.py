@@ -0,0 +1,262 @@
+import logging
+import os
+import select
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+import instrumentation
+import utils
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+logger = logging.getLogger(__name__)
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def build_echo_request(ident, seq, payload=b'downtimer'):
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = checksum(header + payload)
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, csum, ident, seq)
+    return header + payload
+
+
+def parse_echo_reply(packet, raw):
+    '''
+    Returns (ident, seq) of an echo reply or None for any other packet.
+    Raw sockets deliver the IP header too, datagram ones start with ICMP.
+    '''
+    if raw:
+        if len(packet) < 20:
+            return None
+        packet = packet[(ord(packet[0:1]) & 0x0f) * 4:]
+    if len(packet) < 8:
+        return None
+    icmp_type, code, _, ident, seq = struct.unpack('!BBHHH', packet[:8])
+    if icmp_type != ICMP_ECHO_REPLY:
+        return None
+    return ident, seq
+
+
+def open_socket():
+    '''
+    Prefers an unprivileged ICMP datagram socket (net.ipv4.ping_group_range)
+    and falls back to a raw one. Returns (socket, raw) or raises socket.error.
+    '''
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_ICMP)
+        raw = False
+    except socket.error:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                             socket.IPPROTO_ICMP)
+        raw = True
+    sock.setblocking(0)
+    return sock, raw
+
+
+class ICMPProber(object):
+    '''
+    Probes every registered address from a single ICMP socket.
+
+    Each probe mirrors `ping -i 0.2 -c 5 -W 1`: `count` echo requests are
+    sent to the target `interval` seconds apart and replies are awaited
+    for `timeout` seconds after the last one. All sends are short jobs on
+    the shared scheduler, which starts a probe of every target each
+    `period` seconds. Replies are matched by source address and sequence
+    number, since the kernel rewrites the identifier of unprivileged
+    datagram sockets. A probe due while the previous one of the address
+    still awaits its replies is skipped and counted as an overrun.
+    '''
+    def __init__(self, db_adapter, scheduler, count=5, interval=0.2,
+                 timeout=1, period=2):
+        self.db_adapter = db_adapter
+        self.scheduler = scheduler
+        self.count = count
+        self.interval = interval
+        self.timeout = timeout
+        self.period = period
+        self.sock, self.raw = open_socket()
+        self.ident = os.getpid() & 0xffff
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.sent = {}
+        self.replies = {}
+        self.probing = set()
+
+    def add_target(self, address):
+        self.scheduler.add(('ping', address), lambda: self.probe(address),
+                           self.period, kind='ping')
+
+    def remove_target(self, address):
+        self.scheduler.remove(('ping', address))
+
+    def start(self):
+        worker = threading.Thread(target=self._receive_loop)
+        worker.daemon = True
+        worker.start()
+
+    def _next_seq(self):
+        self.seq = (self.seq + 1) & 0xffff
+        return self.seq
+
+    def _receive_loop(self):
+        while True:
+            readable, _, _ = select.select([self.sock], [], [], 1)
+            if not readable:
+                continue
+            try:
+                packet, peer = self.sock.recvfrom(1024)
+            except socket.error:
+                continue
+            received_at = time.time()
+            reply = parse_echo_reply(packet, self.raw)
+            if reply is None:
+                continue
+            ident, seq = reply
+            if self.raw and ident != self.ident:
+                continue
+            key = (peer[0], seq)
+            with self.lock:
+                if key in self.sent and key not in self.replies:
+                    self.replies[key] = received_at - self.sent[key]
+
+    def probe(self, address):
+        # only the dispatcher thread touches `probing`
+        if address in self.probing:
+            self.scheduler.record_overrun('ping')
+            return
+        self.probing.add(address)
+        self.send(address, [])
+
+    def send(self, address, seqs):
+        with self.lock:
+            seq = self._next_seq()
+            self.sent[(address, seq)] = time.time()
+        seqs.append(seq)
+        try:
+            self.sock.sendto(build_echo_request(self.ident, seq),
+                             (address, 0))
+            instrumentation.count('icmp.echo_sent')
+        except socket.error as e:
+            logger.debug('Failed to send echo to %s: %s', address, e)
+            instrumentation.count('icmp.echo_send_errors')
+
+        if len(seqs) < self.count:
+            self.scheduler.call_later(self.interval, self.send, address,
+                                      seqs)
+        else:
+            self.scheduler.call_later(self.timeout, self.finish, address,
+                                      seqs)
+
+    def finish(self, address, seqs):
+        with self.lock:
+            keys = [(address, seq) for seq in seqs]
+            rtts = [self.replies.pop(key, None) for key in keys]
+            for key in keys:
+                self.sent.pop(key, None)
+        self.probing.discard(address)
+        rtts = [rtt for rtt in rtts if rtt is not None]
+        for rtt in rtts:
+            instrumentation.observe('probe.icmp_rtt', rtt)
+
+        total_time, exit_code, packet_loss, rtt = self.summarize(rtts)
+        self.db_adapter.store_instance_status(address, total_time,
+                                              exit_code, packet_loss, rtt=rtt)
+
+    def summarize(self, rtts):
+        '''
+        Converts the replies of one probe into the values `utils.parse_ping`
+        extracts from the ping output: elapsed time in ms, exit code and
+        packet loss percentage, all as strings, and the slowest round trip
+        in ms.
+        '''
+        if not rtts:
+            return '1000', '1', '100', None
+        packet_loss = 100 * (self.count - len(rtts)) // self.count
+        total_time = int((self.count - 1) * self.interval * 1000 +
+                         max(rtts) * 1000)
+        return str(total_time), '0', str(packet_loss), max(rtts) * 1000
+
+
+class SubprocessProber(object):
+    '''
+    Fallback of ICMPProber when no ICMP socket can be opened: every probe
+    runs `ping` with the same options. The dispatcher of the scheduler
+    starts the processes without waiting for them and polls them once
+    they should be done, so pings take no thread each however many
+    targets there are. A probe due while the previous ping of the address
+    still runs is skipped and counted as an overrun.
+    '''
+    def __init__(self, db_adapter, scheduler, count=5, interval=0.2,
+                 timeout=1, period=2, poll_interval=0.1):
+        self.db_adapter = db_adapter
+        self.scheduler = scheduler
+        self.count = count
+        self.interval = interval
+        self.timeout = timeout
+        self.period = period
+        self.poll_interval = poll_interval
+        # a ping that outlives this is hung and killed
+        self.deadline = (count - 1) * interval + timeout + 5
+        self.running = set()
+
+    def add_target(self, address):
+        self.scheduler.add(('ping', address), lambda: self.probe(address),
+                           self.period, kind='ping')
+
+    def remove_target(self, address):
+        self.scheduler.remove(('ping', address))
+
+    def start(self):
+        pass
+
+    def probe(self, address):
+        # only the dispatcher thread touches `running`
+        if address in self.running:
+            self.scheduler.record_overrun('ping')
+            return
+        try:
+            process = subprocess.Popen(
+                ['ping', '-i', str(self.interval), '-c', str(self.count),
+                 '-W', str(self.timeout), address],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True)
+        except OSError as e:
+            logger.warning('Failed to run ping %s: %s', address, e)
+            self.db_adapter.store_instance_status(address, '1000', '1',
+                                                  '100')
+            return
+        self.running.add(address)
+        self.scheduler.call_later((self.count - 1) * self.interval,
+                                  self.reap, address, process, time.time())
+
+    def reap(self, address, process, started):
+        if process.poll() is None:
+            if time.time() - started < self.deadline:
+                self.scheduler.call_later(self.poll_interval, self.reap,
+                                          address, process, started)
+                return
+            process.kill()
+            process.wait()
+        # the summary fits into the pipe, so ping never blocked on it
+        output = process.stdout.read()
+        process.stdout.close()
+        self.running.discard(address)
+        instrumentation.observe('probe.ping_subprocess',
+                                time.time() - started)
+        total_time, exit_code, packet_loss, rtt = utils.parse_ping(
+            output, process.returncode)
+        self.db_adapter.store_instance_status(address, total_time,
+                                              exit_code, packet_loss, rtt=rtt)
@@ -0,0 +1,690 @@
+import calendar
+import gzip
+import influxdb
+import logging
+import StringIO
+import threading
+import time
+
+from datetime import datetime, timedelta
+from influxdb.line_protocol import make_lines
+
+from db_adapters import (DBAdapter, INFLUX_PRECISE_TIME_FORMAT,
+                         INFLUX_TIME_FORMAT, INSTANCE, MAX_BACKOFF,
+                         SAMPLE_CHUNK_SIZE, SERVICE, sample_times, to_epoch)
+from instrumentation import timed, timer
+
+# measurement and target tag of the samples of each kind
+MEASUREMENTS = {INSTANCE: ('floating_ip_pings', 'address'),
+                SERVICE: ('service_response', 'service_name')}
+# aggregates from which _samples() counts the samples of a group
+SAMPLE_COUNTS = ('count(value) as points, count(samples) as counted, '
+                 'sum(samples) as samples')
+# fields of the samples of each kind, with their target tag first
+SAMPLE_FIELDS = {INSTANCE: 'address, exit_code, value, samples, seconds, '
+                           'down_seconds',
+                 SERVICE: 'service_name, status_code, samples, seconds, '
+                          'down_seconds'}
+# aggregates of the seconds a group stands for, see _seconds()
+WEIGHTS = ('sum(seconds) as seconds, sum(down_seconds) as down_seconds, '
+           'count(seconds) as weighed')
+# keeps every datagram below the usual ethernet MTU
+UDP_PAYLOAD_LIMIT = 1400
+
+
+class InfluxWriteBuffer(object):
+    '''
+    Collects points from the probe threads and writes them to InfluxDB
+    from a background thread as soon as `batch_size` points are buffered
+    or the oldest one is `flush_interval` seconds old. Points are sent as
+    line protocol, gzipped over HTTP or packed into datagrams over UDP.
+    When more than `max_size` points are waiting new ones are dropped.
+    Points that failed to be written are dropped too, unless `retry` is
+    set, in which case they are written again after a pause.
+    '''
+    def __init__(self, client, database, batch_size=500, flush_interval=1,
+                 max_size=100000, use_gzip=True, retry=False):
+        self.logger = logging.getLogger('InfluxWriteBuffer')
+        self.client = client
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.use_gzip = use_gzip
+        self.retry = retry
+        self.points = []
+        self.first_point_time = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.buffered = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.in_flight = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._flush_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.flush()
+        self.logger.info('Buffered %(buffered)d points, flushed '
+                         '%(flushed)d, dropped %(dropped)d', self.stats())
+
+    def stats(self):
+        return {'buffered': self.buffered, 'flushed': self.flushed,
+                'dropped': self.dropped,
+                'pending': len(self.points) + self.in_flight}
+
+    def add(self, point):
+        with self.condition:
+            if len(self.points) >= self.max_size:
+                self.dropped += 1
+                return
+            if not self.points:
+                self.first_point_time = time.time()
+            self.points.append(point)
+            self.buffered += 1
+            if len(self.points) >= self.batch_size:
+                self.condition.notify()
+
+    def _flush_loop(self):
+        backoff = self.flush_interval
+        while True:
+            with self.condition:
+                while self.running and not self._due():
+                    self.condition.wait(self._time_left())
+                if not self.running:
+                    return
+            if self.flush():
+                backoff = self.flush_interval
+                continue
+            # don't hammer a database which is failing
+            deadline = time.time() + backoff
+            with self.condition:
+                while self.running and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def _due(self):
+        return (len(self.points) >= self.batch_size or
+                (self.points and self._time_left() <= 0))
+
+    def _time_left(self):
+        if not self.points:
+            return self.flush_interval
+        return self.first_point_time + self.flush_interval - time.time()
+
+    def flush(self):
+        '''Writes the buffered points, returns False if a write failed.'''
+        with self.condition:
+            points, self.points = self.points, []
+            self.in_flight = len(points)
+        try:
+            for i in range(0, len(points), self.batch_size):
+                batch = points[i:i + self.batch_size]
+                try:
+                    self.write(batch)
+                    self.flushed += len(batch)
+                except Exception as e:
+                    self.logger.error('Failed to write %d points: %s',
+                                      len(batch), e)
+                    if not self.retry:
+                        self.dropped += len(batch)
+                        continue
+                    with self.condition:
+                        if not self.points:
+                            self.first_point_time = time.time()
+                        self.points[:0] = points[i:]
+                    return False
+            return True
+        finally:
+            self.in_flight = 0
+
+    @timed('db.influx.write')
+    def write(self, points):
+        lines = make_lines({'points': points}).encode('utf-8')
+        if self.client.use_udp:
+            for datagram in self.pack_datagrams(lines):
+                self.client.udp_socket.sendto(
+                    datagram, (self.client._host, self.client.udp_port))
+            return
+
+        headers = dict(self.client._headers)
+        headers['Content-type'] = 'application/octet-stream'
+        if self.use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+            lines = self.compress(lines)
+        self.client.request(url='write', method='POST',
+                            params={'db': self.database}, data=lines,
+                            expected_response_code=204, headers=headers)
+
+    @staticmethod
+    def compress(data):
+        out = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write(data)
+        return out.getvalue()
+
+    @staticmethod
+    def pack_datagrams(lines):
+        datagram = []
+        size = 0
+        for line in lines.splitlines(True):
+            if datagram and size + len(line) > UDP_PAYLOAD_LIMIT:
+                yield ''.join(datagram)
+                datagram = []
+                size = 0
+            datagram.append(line)
+            size += len(line)
+        if datagram:
+            yield ''.join(datagram)
+
+
+class InfluxDBAdapter(DBAdapter):
+    def __init__(self, config):
+        self.logger = logging.getLogger('InfluxDBAdapter')
+        self.db_url = 'http://{host}:{port}/write?db={name}'.format(
+            host=config.db_host,
+            port=config.db_port,
+            name=config.db_name
+        )
+        self.client = influxdb.InfluxDBClient(config.db_host, config.db_port,
+                                              use_udp=config.use_udp,
+                                              udp_port=config.udp_port,
+                                              database=config.db_name)
+        self.buffer = InfluxWriteBuffer(
+            self.client, config.db_name,
+            batch_size=config.batch_size,
+            flush_interval=config.flush_interval,
+            max_size=config.buffer_size,
+            use_gzip=config.use_gzip)
+        self.buffer.start()
+        self.series_page_size = config.series_page_size
+        # cloud and region of the targets by kind and target
+        self.target_tags = {}
+        self.intervals = {INSTANCE: config.ping_interval,
+                          SERVICE: config.http_interval}
+        # points of several samples span at most a heartbeat
+        self.heartbeat = config.heartbeat
+        self.start_rollups(config.rollup_interval)
+
+    @timed('db.influx.store_instance_status')
+    def store_instance_status(self, address, total_time, exit_code, value,
+                              timestamp=None, samples=1, rtt=None,
+                              interval=None):
+        now = timestamp or datetime.utcnow()
+        current_time = now.strftime(INFLUX_PRECISE_TIME_FORMAT)
+        failed = int(exit_code) != 0
+        lost = float(value) / 100.0
+        seconds, down_seconds = self.weigh(INSTANCE, failed, lost, samples,
+                                           interval)
+        self.rollups.add(INSTANCE, address, failed, lost, now, samples,
+                         seconds, down_seconds)
+        self.buffer.add({
+            "measurement": "floating_ip_pings",
+            "tags": dict(self.get_tags(INSTANCE, address),
+                         address=address),
+            "time": current_time,
+            "fields": {
+                "total_time": total_time,
+                "exit_code": exit_code,
+                "value": value,
+                "samples": samples,
+                "seconds": seconds,
+                "down_seconds": down_seconds
+            }
+        })
+
+    @timed('db.influx.store_service_status')
+    def store_service_status(self, endpoint, address, status_code, timeout,
+                             value, timestamp=None, samples=1,
+                             interval=None):
+        now = timestamp or datetime.utcnow()
+        current_time = now.strftime(INFLUX_PRECISE_TIME_FORMAT)
+        failed = status_code not in (200, 300)
+        seconds, down_seconds = self.weigh(SERVICE, failed, 0.0, samples,
+                                           interval)
+        self.rollups.add(SERVICE, endpoint, failed, 0.0, now, samples,
+                         seconds, down_seconds)
+        self.buffer.add({
+            "measurement": "service_response",
+            "tags": dict(self.get_tags(SERVICE, endpoint),
+                         service_name=endpoint, address=address),
+            "time": current_time,
+            "fields": {
+                "status_code": float(status_code),
+                "timeout": float(timeout),
+                "value": float(value),
+                "samples": samples,
+                "seconds": seconds,
+                "down_seconds": down_seconds
+            }
+        })
+
+    def close(self):
+        self.flush_rollups()
+        self.buffer.stop()
+
+    def retry_failed_writes(self):
+        self.buffer.retry = True
+
+    def pending(self):
+        return self.buffer.stats()['pending']
+
+    @timed('db.influx.store_outage')
+    def store_outage(self, outage):
+        self.buffer.add({
+            "measurement": "outages",
+            "tags": {
+                "kind": outage['kind'],
+                "target": outage['target']
+            },
+            "time": outage['start'].strftime(INFLUX_PRECISE_TIME_FORMAT),
+            "fields": {
+                "end": calendar.timegm(outage['end'].utctimetuple()) +
+                outage['end'].microsecond / 1e6,
+                "duration": float(outage['duration']),
+                "worst_status": float(outage['worst_status'])
+            }
+        })
+
+    def iter_samples(self, kind, since=None, until=None):
+        measurement, _ = MEASUREMENTS[kind]
+        # points of several samples started before may reach into it
+        statement = 'select %s from %s%s' % (
+            SAMPLE_FIELDS[kind], measurement, self._where(self._time_range(
+                since and since - timedelta(seconds=self.heartbeat), until)))
+        since = since and to_epoch(since)
+        until = until and to_epoch(until)
+        offset = 0
+        while True:
+            with timer('db.influx.iter_samples'):
+                result = self.client.query(
+                    '%s limit %d offset %d;' % (statement, SAMPLE_CHUNK_SIZE,
+                                                offset), epoch='u')
+            chunk = []
+            points = 0
+            for point in result.get_points():
+                target, start, samples, failed, _, seconds, down_seconds = \
+                    self._sample_row(kind, point)
+                step = seconds / samples
+                down = down_seconds / samples
+                # a point of several samples yields them spread over its
+                # seconds
+                chunk.extend((target, second, failed, step, down)
+                             for second in sample_times(start, samples, step,
+                                                        since, until))
+                points += 1
+            if chunk:
+                yield chunk
+            if points < SAMPLE_CHUNK_SIZE:
+                return
+            offset += SAMPLE_CHUNK_SIZE
+
+    @timed('db.influx.get_target_tags')
+    def get_target_tags(self, kind):
+        '''Cloud and region tags from the series keys of the samples.'''
+        measurement, target_tag = MEASUREMENTS[kind]
+        result = self.client.query('show series from %s;' % measurement)
+        targets = {}
+        for point in result.get_points():
+            tags = dict(tag.split('=', 1)
+                        for tag in point['key'].split(',')[1:])
+            if target_tag in tags:
+                targets[tags[target_tag]] = dict(
+                    (key, tags.get(key, '')) for key in ('cloud', 'region'))
+        return targets
+
+    @timed('db.influx.store_sketches')
+    def store_sketches(self, rows):
+        # points with the same tags and time replace each other, so the
+        # microseconds of the moment written set apart the rows of the
+        # same bucket saved by a restarted daemon
+        offset = timedelta(microseconds=datetime.utcnow().microsecond)
+        for row in rows:
+            self.buffer.add({
+                "measurement": "latency_sketches",
+                "tags": {
+                    "kind": row['kind'],
+                    "target": row['target']
+                },
+                "time": (row['start'] + offset).strftime(
+                    INFLUX_PRECISE_TIME_FORMAT),
+                "fields": {
+                    "sketch": row['sketch']
+                }
+            })
+
+    @timed('db.influx.get_sketches')
+    def get_sketches(self, since=None, until=None):
+        result = self.client.query(
+            'select sketch from latency_sketches%s group by kind, target;' %
+            self._where(self._time_range(since, until)), epoch='s')
+        return [{'kind': tags['kind'], 'target': tags['target'],
+                 'start': datetime.utcfromtimestamp(point['time']),
+                 'sketch': point['sketch']}
+                for (_, tags), points in result.items() for point in points]
+
+    @timed('db.influx.get_outages')
+    def get_outages(self, since=None, until=None):
+        '''
+        Outages overlapping [since, until). Points are stamped with the
+        outage start, so the end bound is checked here.
+        '''
+        time_range = []
+        if until is not None:
+            time_range.append("time < '%s'" %
+                              until.strftime(INFLUX_PRECISE_TIME_FORMAT))
+        result = self.client.query(
+            'select * from outages%s group by kind, target;' %
+            self._where(time_range), epoch='u')
+        outages = []
+        for (_, tags), points in result.items():
+            for point in points:
+                end = datetime.utcfromtimestamp(point['end'])
+                if since is not None and end < since:
+                    continue
+                outages.append({
+                    'kind': tags['kind'], 'target': tags['target'],
+                    'start': datetime.utcfromtimestamp(point['time'] / 1e6),
+                    'end': end,
+                    'duration': point['duration'],
+                    'worst_status': point['worst_status']})
+        return sorted(outages, key=lambda outage: outage['start'])
+
+    @timed('db.influx.save_rollups')
+    def save_rollups(self, rows):
+        for row in rows:
+            fields = dict((key, row[key]) for key in
+                          ('total', 'failed', 'lost', 'seconds',
+                           'down_seconds', 'state')
+                          if row[key] is not None)
+            if row['last_change'] is not None:
+                fields['last_change'] = row['last_change'].strftime(
+                    INFLUX_TIME_FORMAT)
+            self.buffer.add({
+                "measurement": "rollups",
+                "tags": {
+                    "kind": row['kind'],
+                    "target": row['target']
+                },
+                "fields": fields
+            })
+
+    @timed('db.influx.load_rollups')
+    def load_rollups(self):
+        rollups, = self._query_grouped([
+            'select last(total) as total, last(failed) as failed, '
+            'last(lost) as lost, last(seconds) as seconds, '
+            'last(down_seconds) as down_seconds, last(state) as state, '
+            'last(last_change) as last_change from rollups '
+            'group by kind, target'])
+        rows = []
+        for (kind, target), point in rollups.items():
+            last_change = point.get('last_change')
+            if last_change:
+                last_change = datetime.strptime(last_change,
+                                                INFLUX_TIME_FORMAT)
+            rows.append({'kind': kind,
+                         'target': target,
+                         'total': point['total'],
+                         'failed': point['failed'],
+                         'lost': point['lost'],
+                         'seconds': point.get('seconds'),
+                         'down_seconds': point.get('down_seconds'),
+                         'state': point['state'],
+                         'last_change': last_change})
+        if not rows:
+            rows = self._backfill_rollups()
+            if rows:
+                self.save_rollups(rows)
+        return rows
+
+    def _backfill_rollups(self):
+        '''
+        Builds the rollups of a database written before they existed.
+        A failed ping always loses every packet, so the failed count of an
+        address is its loss from failed pings.
+        '''
+        instances, services = self._aggregate_statuses()
+        rows = []
+        for instance in instances:
+            rows.append({'kind': INSTANCE, 'target': instance['address'],
+                         'total': instance['attempts'],
+                         'failed': int(instance['failed']),
+                         'lost': instance['lost_pkts'],
+                         'seconds': instance['duration'],
+                         'down_seconds': instance['downtime'],
+                         'state': None, 'last_change': None})
+        for service in services:
+            rows.append({'kind': SERVICE, 'target': service['service'],
+                         'total': service['total_uptime'],
+                         'failed': service['srv_downtime'],
+                         'lost': 0.0,
+                         'seconds': service['duration'],
+                         'down_seconds': service['downtime'],
+                         'state': None, 'last_change': None})
+        return rows
+
+    @timed('db.influx.get_instance_statuses')
+    def get_instance_statuses(self, since=None, until=None):
+        if since is not None or until is not None:
+            instances, _ = self._aggregate_statuses(since, until)
+            for instance in instances:
+                del instance['failed']
+            return instances
+        return [{'address': rollup['target'], 'lost_pkts': rollup['lost'],
+                 'attempts': rollup['total'], 'duration': rollup['seconds'],
+                 'downtime': rollup['down_seconds']}
+                for rollup in self._query_rollups(INSTANCE)]
+
+    @timed('db.influx.get_service_statuses')
+    def get_service_statuses(self, since=None, until=None):
+        if since is not None or until is not None:
+            return self._aggregate_statuses(since, until)[1]
+        return [{'service': rollup['target'],
+                 'srv_downtime': rollup['failed'],
+                 'total_uptime': rollup['total'],
+                 'duration': rollup['seconds'],
+                 'downtime': rollup['down_seconds']}
+                for rollup in self._query_rollups(SERVICE)]
+
+    def _query_rollups(self, kind):
+        rollups, = self._query_grouped([
+            "select last(total) as total, last(failed) as failed, "
+            "last(lost) as lost, last(seconds) as seconds, "
+            "last(down_seconds) as down_seconds from rollups "
+            "where kind = '%s' group by target" % kind])
+        return [dict(point, target=target)
+                for (target,), point in rollups.items()]
+
+    def _aggregate_statuses(self, since=None, until=None):
+        '''
+        Aggregates the raw samples of both measurements on the server,
+        optionally within [since, until). Returns the instance and the
+        service statuses; instances also carry the loss of failed pings.
+        Points written before the seconds were kept are single samples
+        probed at the base interval.
+        '''
+        time_range = self._time_range(since, until)
+        results = self._query_grouped([
+            'select %s, %s from floating_ip_pings%s group by address' %
+            (SAMPLE_COUNTS, WEIGHTS, self._where(time_range)),
+            'select sum(value) as lost from floating_ip_pings%s '
+            'group by address' % self._where(time_range),
+            # the loss of the points which carry their seconds
+            'select sum(value) as lost from floating_ip_pings%s '
+            'group by address' % self._where(['seconds > 0'] + time_range),
+            'select sum(value) as failed from floating_ip_pings%s '
+            'group by address' % self._where(['exit_code <> 0'] +
+                                             time_range),
+            'select %s, %s from service_response%s group by service_name' %
+            (SAMPLE_COUNTS, WEIGHTS, self._where(time_range)),
+            'select %s, %s from service_response%s group by service_name' %
+            (SAMPLE_COUNTS, WEIGHTS, self._where(['status_code <> 200',
+                                                  'status_code <> 300'] +
+                                                 time_range)),
+        ])
+        pings, lost, weighed_lost, failed, responses, bad_responses = results
+
+        interval = self.intervals[INSTANCE]
+        instances = []
+        for key, point in pings.items():
+            lost_pkts = lost.get(key, {}).get('lost', 0) / 100.0
+            unweighed_lost = lost_pkts - \
+                weighed_lost.get(key, {}).get('lost', 0) / 100.0
+            instances.append({
+                'address': key[0],
+                'lost_pkts': lost_pkts,
+                'attempts': self._samples(point),
+                'failed': failed.get(key, {}).get('failed', 0) / 100.0,
+                'duration': self._seconds(point, interval),
+                'downtime': (point['down_seconds'] or 0) +
+                unweighed_lost * interval})
+
+        interval = self.intervals[SERVICE]
+        services = []
+        for key, point in responses.items():
+            bad = bad_responses.get(key)
+            services.append({
+                'service': key[0],
+                'srv_downtime': self._samples(bad),
+                'total_uptime': self._samples(point),
+                'duration': self._seconds(point, interval),
+                # failed checks were down all of their seconds
+                'downtime': self._seconds(bad, interval) if bad else 0})
+
+        if since is not None or until is not None:
+            cut = self._cut_rows(since, until)
+            for kind, statuses in ((INSTANCE, instances),
+                                   (SERVICE, services)):
+                self.split_rows(kind, statuses, cut[kind],
+                                since and to_epoch(since),
+                                until and to_epoch(until))
+        return instances, services
+
+    def _cut_rows(self, since, until):
+        '''
+        Points of several samples of either kind which start less than a
+        heartbeat before a bound of the window, as split_rows() takes
+        them.
+        '''
+        statements = []
+        for kind in (INSTANCE, SERVICE):
+            for bound in (since, until):
+                if bound is not None:
+                    statements.append((kind, 'select %s from %s%s;' % (
+                        SAMPLE_FIELDS[kind], MEASUREMENTS[kind][0],
+                        self._where(['samples > 1'] + self._time_range(
+                            bound - timedelta(seconds=self.heartbeat),
+                            bound)))))
+        results = self.client.query(
+            ' '.join(statement for _, statement in statements), epoch='u')
+        if not isinstance(results, list):
+            results = [results]
+        rows = {INSTANCE: {}, SERVICE: {}}
+        for (kind, _), result in zip(statements, results):
+            for point in result.get_points():
+                row = self._sample_row(kind, point)
+                # a point cut by both bounds is read twice
+                rows[kind][row[:2]] = row
+        return dict((kind, rows[kind].values()) for kind in rows)
+
+    def _sample_row(self, kind, point):
+        '''
+        A point of SAMPLE_FIELDS as (target, epoch, samples, failed,
+        lost, seconds, down_seconds), weighed at the base interval if it
+        was written before the seconds were kept.
+        '''
+        samples = int(point.get('samples') or 1)
+        if kind == INSTANCE:
+            target = point['address']
+            failed = int(point['exit_code']) != 0
+            lost = float(point['value']) / 100.0
+        else:
+            target = point['service_name']
+            failed = point['status_code'] not in (200, 300)
+            lost = 0.0
+        seconds, down_seconds = self.weigh(kind, failed, lost, samples, None)
+        if point.get('seconds') is not None:
+            seconds = point['seconds']
+            down_seconds = point.get('down_seconds') or 0.0
+        return (target, point['time'] / 1e6, samples, failed, lost, seconds,
+                down_seconds)
+
+    @staticmethod
+    def _samples(point):
+        '''
+        Samples counted by a SAMPLE_COUNTS point: a point without the
+        samples field, written before it existed, is a single sample.
+        '''
+        if not point:
+            return 0
+        return point['points'] - (point['counted'] or 0) + \
+            (point['samples'] or 0)
+
+    @staticmethod
+    def _seconds(point, interval):
+        '''
+        Seconds counted by a SAMPLE_COUNTS and WEIGHTS point: a point
+        without the seconds field is a sample probed every `interval`.
+        '''
+        return (point['seconds'] or 0) + \
+            (point['points'] - (point['weighed'] or 0)) * interval
+
+    @staticmethod
+    def _time_range(since, until):
+        conditions = []
+        if since is not None:
+            conditions.append("time >= '%s'" %
+                              since.strftime(INFLUX_PRECISE_TIME_FORMAT))
+        if until is not None:
+            conditions.append("time < '%s'" %
+                              until.strftime(INFLUX_PRECISE_TIME_FORMAT))
+        return conditions
+
+    @staticmethod
+    def _where(conditions):
+        if not conditions:
+            return ''
+        return ' where ' + ' and '.join(conditions)
+
+    def _query_grouped(self, statements):
+        '''
+        Runs GROUP BY statements together, one request per page of
+        `series_page_size` series, and returns for every statement a dict
+        of its single point per group keyed by the group tag values.
+        A failed statement yields an empty dict.
+        '''
+        grouped = [{} for _ in statements]
+        offset = 0
+        while True:
+            query = ' '.join('%s slimit %d soffset %d;' %
+                             (statement, self.series_page_size, offset)
+                             for statement in statements)
+            results = self.client.query(query, raise_errors=False)
+            if not isinstance(results, list):
+                results = [results]
+
+            full_page = False
+            for statement, result, points in zip(statements, results,
+                                                 grouped):
+                if result.error:
+                    self.logger.warning('Query "%s" failed: %s', statement,
+                                        result.error)
+                series = result.items()
+                full_page |= len(series) >= self.series_page_size
+                for (_, tags), values in series:
+                    key = tuple(tags[tag] for tag in sorted(tags))
+                    for point in values:
+                        points[key] = point
+
+            if not full_page:
+                return grouped
+            offset += self.series_page_size
@@ -0,0 +1,195 @@
+import collections
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from scheduler import monotonic
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the duration histogram buckets in seconds
+BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Timing(object):
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+
+class Registry(object):
+    '''
+    Durations and counters of the daemon's own work by name, e.g. how
+    long ping subprocesses or database commits take. Collectors are
+    callables returning more lines of Prometheus text for rendering.
+    '''
+    def __init__(self):
+        self.timings = {}
+        self.counters = collections.Counter()
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = Timing()
+            timing.add(seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        with self.lock:
+            timings = [(name, list(timing.buckets), timing.sum)
+                       for name, timing in self.timings.items()]
+            counters = self.counters.items()
+        lines = ['# HELP downtimer_internal_duration_seconds Time spent in '
+                 'the daemon\'s own operations',
+                 '# TYPE downtimer_internal_duration_seconds histogram']
+        for name, buckets, total in timings:
+            count = 0
+            for bound, bucket in zip(BUCKETS + ('+Inf',), buckets):
+                count += bucket
+                lines.append('downtimer_internal_duration_seconds_bucket'
+                             '{op="%s",le="%s"} %d' % (name, bound, count))
+            lines.append('downtimer_internal_duration_seconds_sum{op="%s"} '
+                         '%r' % (name, total))
+            lines.append('downtimer_internal_duration_seconds_count'
+                         '{op="%s"} %d' % (name, count))
+        lines.append('# TYPE downtimer_internal_events_total counter')
+        for name, value in counters:
+            lines.append('downtimer_internal_events_total{event="%s"} %d' %
+                         (name, value))
+        lines.append('# TYPE downtimer_threads gauge')
+        lines.append('downtimer_threads %d' % threading.active_count())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''One line per operation: count, mean and max duration.'''
+        with self.lock:
+            return ['%s: %d calls, mean %.2f ms, max %.2f ms' %
+                    (name, timing.count, timing.sum / timing.count * 1e3,
+                     timing.max * 1e3)
+                    for name, timing in sorted(self.timings.items())]
+
+
+REGISTRY = Registry()
+
+
+def observe(name, seconds):
+    REGISTRY.observe(name, seconds)
+
+
+def count(name, value=1):
+    REGISTRY.count(name, value)
+
+
+class timer(object):
+    '''Context manager recording how long its block took.'''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.name, monotonic() - self.started)
+        if exc_type is not None:
+            count(self.name + '.errors')
+
+
+def timed(name):
+    '''Decorator recording how long every call of the function takes.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler(object):
+    '''
+    Samples the stacks of all other threads every `interval` seconds while
+    running. On stop, identical stacks are counted and written to a file
+    in `directory` in the folded format read by flame graph tools.
+    install() lets a signal switch it on and off in a running daemon.
+    '''
+    def __init__(self, directory, interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.thread = None
+        self.running = False
+
+    def install(self, signum=signal.SIGUSR2):
+        signal.signal(signum, lambda signum, frame: self.toggle())
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        logger.info('Sampling profiler started')
+        self.stacks = collections.Counter()
+        self.running = True
+        self.thread = threading.Thread(target=self._sample_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        path = os.path.join(self.directory, 'downtimer-%d-%d.folded' %
+                            (os.getpid(), time.time()))
+        with open(path, 'w') as f:
+            for stack, samples in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, samples))
+        logger.info('Sampling profiler stopped, %d samples written to %s',
+                    sum(self.stacks.values()), path)
+        return path
+
+    def sample(self):
+        own = threading.current_thread().ident
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (
+                    code.co_name, os.path.basename(code.co_filename),
+                    frame.f_lineno))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def _sample_loop(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
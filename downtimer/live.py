@@ -0,0 +1,203 @@
+from array import array
+import json
+import logging
+import math
+import os
+import socket
+import SocketServer
+import threading
+import time
+
+from db_adapters import AdapterWrapper, INSTANCE, SERVICE
+
+logger = logging.getLogger(__name__)
+
+# seconds of samples kept per target, the longest window a query covers
+WINDOW = 600
+FIELDS = (('times', 'd'), ('failed', 'b'), ('status', 'H'),
+          ('latency', 'f'), ('loss', 'f'), ('seconds', 'f'),
+          ('down_seconds', 'f'))
+
+
+def ring_size(window, interval):
+    '''Samples taken every `interval` seconds within `window` seconds.'''
+    return int(math.ceil(window / float(interval))) + 1
+
+
+class SampleRing(object):
+    '''
+    Last `size` samples of one target in parallel arrays: time, failed
+    flag, status (HTTP code or ping exit code), latency in milliseconds,
+    packet loss in percent and the seconds the sample stands for and was
+    down. A full ring whose oldest sample is still within `window`
+    seconds doubles, up to `max_size`, so targets probed faster than
+    usual keep the whole window.
+    '''
+    def __init__(self, size, max_size=None, window=0):
+        self.size = size
+        self.max_size = max(size, max_size or size)
+        self.window = window
+        for name, typecode in FIELDS:
+            setattr(self, name, array(typecode, [0] * size))
+        self.next = 0
+        self.count = 0
+        self.last_change = None
+
+    def _grow(self):
+        size = min(self.size * 2, self.max_size)
+        for name, typecode in FIELDS:
+            values = getattr(self, name)
+            setattr(self, name, values[self.next:] + values[:self.next] +
+                    array(typecode, [0] * (size - self.size)))
+        self.next = self.size
+        self.size = size
+
+    def add(self, timestamp, failed, status, latency, loss, seconds=0.0,
+            down_seconds=0.0):
+        if self.count and bool(self.failed[self.next - 1]) != failed:
+            self.last_change = timestamp
+        if self.count == self.size < self.max_size and \
+                timestamp - self.times[self.next] < self.window:
+            self._grow()
+        i = self.next
+        self.times[i] = timestamp
+        self.failed[i] = failed
+        self.status[i] = status
+        self.latency[i] = latency
+        self.loss[i] = loss
+        self.seconds[i] = seconds
+        self.down_seconds[i] = down_seconds
+        self.next = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def summary(self, since):
+        '''
+        State after the last sample and availability since `since`, the
+        share of the seconds the samples stand for that the target was up.
+        '''
+        last = self.next - 1
+        total = 0
+        seconds = down_seconds = 0.0
+        for i in range(self.count):
+            j = (last - i) % self.size
+            if self.times[j] < since:
+                break
+            total += 1
+            seconds += self.seconds[j]
+            down_seconds += self.down_seconds[j]
+        return {'up': not self.failed[last], 'time': self.times[last],
+                'status': self.status[last],
+                'latency': round(self.latency[last], 3),
+                'loss': round(self.loss[last], 1),
+                'availability': (100.0 * (seconds - down_seconds) / seconds
+                                 if seconds else None),
+                'samples': total, 'last_change': self.last_change}
+
+
+class LiveStatus(AdapterWrapper):
+    '''
+    Outermost adapter: keeps the recent samples of every target in a
+    SampleRing and passes them on to the wrapped adapter. Rings start
+    with `window` seconds of samples at the configured interval of their
+    kind and grow to hold them at `min_interval`, which adaptive probing
+    may go down to. Samples are weighed by their interval as the storing
+    adapters do.
+    '''
+    def __init__(self, adapter, intervals, window=WINDOW, min_interval=None):
+        self.adapter = adapter
+        self.intervals = intervals
+        self.window = window
+        self.max_size = ring_size(window, min(
+            filter(None, [min_interval] + intervals.values())))
+        self.rings = {}
+        self.lock = threading.Lock()
+
+    def record(self, kind, target, failed, status, latency, loss, interval):
+        interval = interval or self.intervals[kind]
+        if kind == INSTANCE:
+            down_seconds = loss / 100.0 * interval
+        else:
+            down_seconds = interval * failed
+        with self.lock:
+            ring = self.rings.get((kind, target))
+            if ring is None:
+                ring = self.rings[(kind, target)] = SampleRing(
+                    ring_size(self.window, self.intervals[kind]),
+                    self.max_size, self.window)
+            ring.add(time.time(), failed, status, latency, loss, interval,
+                     down_seconds)
+
+    def store_instance_status(self, address, total_time, exit_code, value,
+                              timestamp=None, rtt=None, interval=None):
+        self.adapter.store_instance_status(address, total_time, exit_code,
+                                           value, timestamp, rtt=rtt,
+                                           interval=interval)
+        # a failed ping waited for the timeout in `total_time`
+        latency = rtt if rtt is not None else float(total_time)
+        self.record(INSTANCE, address, int(exit_code) != 0, int(exit_code),
+                    latency, float(value), interval)
+
+    def store_service_status(self, endpoint, address, status_code, timeout,
+                             value, timestamp=None, interval=None):
+        self.adapter.store_service_status(endpoint, address, status_code,
+                                          timeout, value, timestamp,
+                                          interval=interval)
+        self.record(SERVICE, endpoint, status_code not in (200, 300),
+                    int(status_code), float(value) / 1e3, 0.0, interval)
+
+    def query(self, minutes=5):
+        '''Summary of every target, availability over the last minutes.'''
+        since = time.time() - minutes * 60
+        with self.lock:
+            result = []
+            for (kind, target), ring in self.rings.items():
+                summary = ring.summary(since)
+                summary['kind'] = kind
+                summary['target'] = target
+                result.append(summary)
+        return result
+
+
+class StatusHandler(SocketServer.StreamRequestHandler):
+    '''
+    Answers one line, "status [minutes]", with the JSON list of target
+    summaries followed by a newline.
+    '''
+    def handle(self):
+        words = self.rfile.readline().split()
+        try:
+            if words[:1] != ['status']:
+                raise ValueError('unknown command')
+            minutes = float(words[1]) if len(words) > 1 else 5
+            response = self.server.live.query(minutes)
+        except (ValueError, IndexError) as e:
+            response = {'error': str(e)}
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class StatusServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, live, path):
+        self.live = live
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.ThreadingUnixStreamServer.__init__(self, path,
+                                                        StatusHandler)
+
+    def start(self):
+        worker = threading.Thread(target=self.serve_forever)
+        worker.daemon = True
+        worker.start()
+
+
+def query_status(path, minutes=5):
+    '''Client side of the status socket.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall('status %g\n' % minutes)
+        response = sock.makefile().readline()
+    finally:
+        sock.close()
+    return json.loads(response)
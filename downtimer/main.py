@@ -1,109 +1,399 @@
-from urlparse import urlparse
+import functools
 import logging
+import os
+import socket
 import threading
 import time
 
-from keystoneauth1 import session
-from keystoneclient.v3 import client as keystone_client
-from keystoneauth1.identity import Password
-from neutronclient.v2_0 import client as neutron_client
+from adaptive import AdaptiveRate
+from changes import ChangeOnlyWriter
+from config import get_config
+from db_adapters import INSTANCE, SERVICE
+from instrumentation import REGISTRY, SamplingProfiler
+from live import LiveStatus, StatusServer
+from metrics import MetricsServer, ProbeMetrics
+from outages import OutageDetector
+from scheduler import monotonic, Scheduler
+from sketches import LatencySketches
+from spool import Spool, SpoolAdapter
+import icmp
+import sharding
 
-from daemonize import Daemonize
+logger = logging.getLogger(__name__)
+# database adapters by name, imported only once configured
+adapters = {'influx': 'influx_adapter.InfluxDBAdapter',
+            'sql': 'sql_adapter.SQLDBAdapter',
+            'timeline': 'timeline_adapter.TimelineDBAdapter'}
+# seconds between splitting the probe budget between targets
+REBALANCE_INTERVAL = 10
+# seconds between saving the latency sketches of finished buckets
+SKETCH_FLUSH_INTERVAL = 60
 
-from config import CONF
-from db_adapters import InfluxDBAdapter, SQLDBAdapter
-import utils
 
-logger = logging.getLogger(__name__)
-adapters = {'influx': InfluxDBAdapter, 'sql': SQLDBAdapter}
+def load_adapter(name):
+    '''The adapter class registered as `name`, importing its module.'''
+    adapter = adapters[name]
+    if isinstance(adapter, basestring):
+        module, cls = adapter.rsplit('.', 1)
+        adapter = adapters[name] = getattr(
+            __import__(module, globals(), locals(), [cls]), cls)
+    return adapter
 
 
 class Downtimer(object):
-    def __init__(self):
-        self.conf = CONF
-        self.db_adapter = adapters[self.conf.db_adapter](self.conf)
-        self.threads = []
+    def __init__(self, shard=None, ring=None, conf=None):
+        self.conf = conf or get_config()
+        self.shard = shard
+        self.ring = ring
+        self.db_adapter = load_adapter(self.conf.db_adapter)(self.conf)
+        self.changes = None
+        if self.conf.write_mode == 'changes':
+            self.changes = self.db_adapter = ChangeOnlyWriter(
+                self.db_adapter, heartbeat=self.conf.heartbeat,
+                loss_threshold=self.conf.loss_threshold)
+        if self.conf.detect_outages:
+            self.db_adapter = OutageDetector(
+                self.db_adapter,
+                down_threshold=self.conf.outage_down_threshold,
+                up_threshold=self.conf.outage_up_threshold)
+        self.sketches = None
+        if self.conf.latency_sketches:
+            self.sketches = self.db_adapter = LatencySketches(
+                self.db_adapter, bucket=self.conf.sketch_bucket,
+                accuracy=self.conf.sketch_accuracy)
+        self.spool = None
+        self.live = None
+        self.scheduler = Scheduler(workers=self.conf.scheduler_workers)
+        self.ping_prober = None
+        self.http_checker = None
+        self.ping_targets = set()
+        self.service_targets = {}
+        # name: (cloud config, service catalog, floating ip watcher)
+        self.clouds = {}
+        # name: (service endpoints, addresses) discovered in the cloud
+        self.cloud_targets = {}
+        self.targets_lock = threading.Lock()
+
+    def start_pipeline(self):
+        '''
+        Puts the spool, the live status, the metrics and the adaptive
+        probe rate in front of the adapters, which only the probing
+        daemon needs.
+        '''
+        shard = self.shard and self.shard.replace('/', '-')
+        if self.changes is not None:
+            self.scheduler.add(('changes',), self.changes.flush_finished,
+                               self.conf.heartbeat, kind='changes')
+        if self.sketches is not None:
+            self.scheduler.add(('sketches',), self.sketches.flush_finished,
+                               SKETCH_FLUSH_INTERVAL, kind='sketches')
+        if self.conf.spool_dir:
+            directory = self.conf.spool_dir
+            if shard:
+                directory = os.path.join(directory, shard)
+            self.spool = Spool(directory,
+                               segment_size=self.conf.spool_segment_size,
+                               max_size=self.conf.spool_max_size)
+            self.db_adapter = SpoolAdapter(
+                self.db_adapter, self.spool,
+                batch_size=self.conf.batch_size,
+                flush_interval=self.conf.flush_interval)
+        if self.conf.live_status:
+            self.live = LiveStatus(
+                self.db_adapter, {INSTANCE: self.conf.ping_interval,
+                                  SERVICE: self.conf.http_interval},
+                window=self.conf.live_window * 60,
+                min_interval=(self.conf.fast_interval
+                              if self.conf.adaptive else None))
+            self.db_adapter = self.live
+            if self.conf.status_socket:
+                path = self.conf.status_socket
+                if shard:
+                    path = '%s.%s' % (path, shard)
+                StatusServer(self.live, path).start()
+        if self.conf.metrics_port:
+            port = self.conf.metrics_port
+            if self.shard is not None:
+                # local shards listen on consecutive ports
+                port += int(self.shard.rsplit('/', 1)[1])
+            self.db_adapter = ProbeMetrics(self.db_adapter)
+            REGISTRY.add_collector(self.scheduler_metrics)
+            MetricsServer(self.db_adapter, self.conf.metrics_address,
+                          port).start()
+        if self.conf.adaptive:
+            budget = self.conf.probe_budget
+            if self.ring is not None:
+                budget /= float(len(self.ring.shards))
+            self.db_adapter = AdaptiveRate(
+                self.db_adapter, self.scheduler,
+                {'ping': self.conf.ping_interval,
+                 'http': self.conf.http_interval},
+                fast_interval=self.conf.fast_interval,
+                max_interval=self.conf.max_interval, budget=budget,
+                recovery=self.conf.recovery_probes)
+            self.scheduler.add(('rebalance',), self.db_adapter.rebalance,
+                               REBALANCE_INTERVAL, kind='adaptive')
 
     def run(self):
         try:
-            method_name = 'handle_' + self.conf.mode
-            getattr(self, method_name)()
+            started = monotonic()
+            try:
+                handle_mode = getattr(self, 'handle_' + self.conf.mode)
+            except AttributeError:
+                raise AttributeError(
+                    'Unrecognized mode %s specified in config file' %
+                    self.conf.mode)
+            if self.conf.profile_dir:
+                SamplingProfiler(self.conf.profile_dir,
+                                 self.conf.profile_interval).install()
+            self.start_pipeline()
+            handle_mode()
+            self.scheduler.start()
+            logger.info('Started probing %d services and %d addresses in '
+                        '%.2f seconds', len(self.service_targets),
+                        len(self.ping_targets), monotonic() - started)
 
             while True:
-                time.sleep(3)
-
-        except(AttributeError):
-            raise AttributeError(
-                'Unrecognized platform type %s specified in config file' %
-                self.conf.platform)
+                time.sleep(60)
+                self.log_stats()
+        finally:
+            self.db_adapter.close()
 
     def handle_static(self):
         for ip in self.conf.ips:
-            self.add_worker(utils.ping, (ip, self.db_adapter))
+            self.add_ping_target(ip)
 
     def handle_openstack(self):
-        auth = Password(auth_url=self.conf.auth_url,
-                        username=self.conf.user, password=self.conf.password,
-                        project_name="admin", user_domain_id="default",
-                        project_domain_id="default")
-        sess = session.Session(auth=auth)
-        keystone = keystone_client.Client(session=sess)
-        for service in keystone.services.list():
-            endpoint = keystone.endpoints.find(service_id=service.id,
-                                               interface='public')
-            url = urlparse(endpoint.url)
-            new_url = '{0}://{1}'.format(url.scheme, url.netloc)
-            self.add_worker(utils.do_check,
-                            (service.name, new_url, self.db_adapter))
-
-        neutron = neutron_client.Client(session=sess)
-        for fip in neutron.list_floatingips()['floatingips']:
-            if fip['status'] == 'ACTIVE':
-                self.add_worker(utils.ping,
-                                (fip['floating_ip_address'], self.db_adapter))
-
-    def add_worker(self, target, args):
-        worker = threading.Thread(target=target,
-                                  args=args)
-        worker.daemon = True
-        worker.start()
-        self.threads.append(worker)
-
-    def report(self):
+        # the clients take a second to import, static mode doesn't need them
+        from discovery import FloatingIPWatcher, ServiceCatalog
+        from keystoneauth1.identity import Password
+        from keystoneauth1 import session
+        from keystoneclient.v3 import client as keystone_client
+        from neutronclient.v2_0 import client as neutron_client
+
+        for cloud in self.conf.clouds:
+            auth = Password(auth_url=cloud.auth_url,
+                            username=cloud.user, password=cloud.password,
+                            project_name="admin", user_domain_id="default",
+                            project_domain_id="default")
+            sess = session.Session(auth=auth)
+            catalog = ServiceCatalog(
+                keystone_client.Client(session=sess),
+                interface=cloud.endpoint_interface,
+                region=cloud.region, ttl=self.conf.catalog_ttl)
+            fip_watcher = FloatingIPWatcher(
+                neutron_client.Client(session=sess),
+                page_size=self.conf.discovery_page_size,
+                resync_interval=self.conf.resync_interval)
+            self.clouds[cloud.name] = (cloud, catalog, fip_watcher)
+            self.cloud_targets[cloud.name] = (set(), set())
+
+        # clouds are discovered concurrently, by threads at startup and
+        # then by the scheduler workers
+        threads = [threading.Thread(target=self.discover, args=(name,))
+                   for name in self.clouds]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.conf.discovery_interval:
+            for name in self.clouds:
+                self.scheduler.add(('discovery', name),
+                                   functools.partial(self.discover, name),
+                                   self.conf.discovery_interval,
+                                   kind='discovery', blocking=True)
+
+    def discover(self, name):
+        '''Starts and stops the probes of the targets of one cloud.'''
+        cloud, catalog, fip_watcher = self.clouds[name]
+        services, addresses = self.cloud_targets[name]
+        try:
+            found = catalog.services()
+            added, removed = fip_watcher.poll()
+        except Exception as e:
+            logger.error('Failed to discover the targets of %s: %s', name, e)
+            return
+        if name != 'default':
+            found = dict(('%s/%s' % (name, service), address)
+                         for service, address in found.items())
+
+        with self.targets_lock:
+            for endpoint in services - set(found):
+                services.discard(endpoint)
+                self.remove_service_target(endpoint)
+            for endpoint, address in found.items():
+                if self.service_targets.get(endpoint) != address:
+                    services.add(endpoint)
+                    self.db_adapter.tag_target(SERVICE, endpoint, cloud.tags)
+                    self.add_service_target(endpoint, address)
+
+            for address in removed:
+                if address in addresses:
+                    addresses.discard(address)
+                    self.remove_ping_target(address)
+            for address in added:
+                if address not in self.ping_targets:
+                    addresses.add(address)
+                    self.db_adapter.tag_target(INSTANCE, address, cloud.tags)
+                    self.add_ping_target(address)
+        if added or removed:
+            logger.info('Discovered %d new and %d removed floating ips in %s',
+                        len(added), len(removed), name)
+
+    def owns(self, kind, target):
+        if self.ring is None:
+            return True
+        return self.ring.owner(sharding.target_key(kind, target)) == \
+            self.shard
+
+    def add_service_target(self, endpoint, address):
+        if not self.owns('http', endpoint):
+            return
+        if self.http_checker is None:
+            from http_checker import HTTPChecker
+
+            self.http_checker = HTTPChecker(
+                self.db_adapter, self.scheduler,
+                pool_size=self.conf.http_pool_size,
+                period=self.conf.http_interval,
+                dns_ttl=self.conf.dns_ttl)
+        self.http_checker.add_target(endpoint, address)
+        self.service_targets[endpoint] = address
+
+    def remove_service_target(self, endpoint):
+        if self.service_targets.pop(endpoint, None) is not None:
+            self.http_checker.remove_target(endpoint)
+
+    def add_ping_target(self, address):
+        if not self.owns('ping', address):
+            return
+        if self.ping_prober is None:
+            self.ping_prober = self.start_ping_prober()
+        self.ping_prober.add_target(address)
+        self.ping_targets.add(address)
+
+    def start_ping_prober(self):
+        if self.conf.ping_engine == 'native':
+            try:
+                prober = icmp.ICMPProber(self.db_adapter, self.scheduler,
+                                         period=self.conf.ping_interval)
+                prober.start()
+                return prober
+            except socket.error as e:
+                logger.warning('Failed to open ICMP socket (%s), falling '
+                               'back to ping subprocesses', e)
+                self.conf.ping_engine = 'subprocess'
+        return icmp.SubprocessProber(self.db_adapter, self.scheduler,
+                                     period=self.conf.ping_interval)
+
+    def remove_ping_target(self, address):
+        if address not in self.ping_targets:
+            return
+        self.ping_targets.discard(address)
+        self.ping_prober.remove_target(address)
+
+    def log_stats(self):
+        for kind, stats in self.scheduler.stats().items():
+            logger.info('%s probes: %d runs, lag mean %.1f ms max %.1f ms, '
+                        'run time mean %.1f ms max %.1f ms, %d missed, '
+                        '%d overrun', kind, stats['runs'],
+                        stats['mean_lag'] * 1e3, stats['max_lag'] * 1e3,
+                        stats['mean_time'] * 1e3, stats['max_time'] * 1e3,
+                        stats['missed'], stats['overrun'])
+        for line in REGISTRY.summary():
+            logger.debug(line)
+        if self.spool is not None:
+            logger.info('Spool: %(appended)d samples appended, %(committed)d '
+                        'written, %(backlog)d bytes backlog in %(segments)d '
+                        'segments, %(dropped_segments)d segments dropped',
+                        self.spool.stats())
+
+    def scheduler_metrics(self):
+        lines = ['# TYPE downtimer_scheduler_lag_seconds gauge',
+                 '# TYPE downtimer_scheduler_run_seconds gauge',
+                 '# TYPE downtimer_scheduler_skipped_total counter']
+        for kind, stats in self.scheduler.stats().items():
+            for stat in ('mean', 'max'):
+                lines.append('downtimer_scheduler_lag_seconds{kind="%s",'
+                             'stat="%s"} %r' % (kind, stat,
+                                                stats[stat + '_lag']))
+                lines.append('downtimer_scheduler_run_seconds{kind="%s",'
+                             'stat="%s"} %r' % (kind, stat,
+                                                stats[stat + '_time']))
+            for reason in ('missed', 'overrun'):
+                lines.append('downtimer_scheduler_skipped_total{kind="%s",'
+                             'reason="%s"} %d' % (kind, reason,
+                                                  stats[reason]))
+        return lines
+
+    def report(self, since=None, until=None):
         with open(self.conf.report_file, "w") as f:
-            for service in self.db_adapter.get_service_statuses():
+            for service in self.db_adapter.get_service_statuses(since,
+                                                                until):
                 f.write("Service %s was down approximately %d seconds out of "
                         "%d seconds which amounting %.1f%% of total uptime\n" %
-                        (service['service'], service['srv_downtime'],
-                         service['total_uptime'],
-                         (100.0 * service['srv_downtime']) /
-                         service['total_uptime']))
+                        (service['service'], service['downtime'],
+                         service['duration'],
+                         (100.0 * service['downtime']) /
+                         service['duration']))
 
-            for instance in self.db_adapter.get_instance_statuses():
+            for instance in self.db_adapter.get_instance_statuses(since,
+                                                                  until):
                 f.write(
                     "Address %s was unreachable approximately %.1f second of "
                     "%d seconds which amounting %.1f %% of total uptime\n" %
                     (instance['address'],
-                     instance['lost_pkts'],
-                     instance['attempts'],
-                     (instance['lost_pkts'] * 1e2) / instance['attempts']))
+                     instance['downtime'],
+                     instance['duration'],
+                     (instance['downtime'] * 1e2) / instance['duration']))
+
+            for outage in self.db_adapter.get_outages(since, until):
+                f.write(
+                    "%s %s was down from %s to %s (%.1f seconds, worst "
+                    "status %g)\n" %
+                    (outage['kind'].capitalize(), outage['target'],
+                     outage['start'], outage['end'], outage['duration'],
+                     outage['worst_status']))
 
+            for kind, stats in self.scheduler.stats().items():
+                f.write("%s probes started on average %.1f ms and at most "
+                        "%.1f ms late over %d runs\n" %
+                        (kind.capitalize(), stats['mean_lag'] * 1e3,
+                         stats['max_lag'] * 1e3, stats['runs']))
 
-def downtimer_starter():
-    downtimer_app = Downtimer()
+
+def run_shard(shard, ring):
+    logger.info('Shard %s started', shard)
+    downtimer_app = Downtimer(shard, ring)
     downtimer_app.run()
 
 
+def downtimer_starter():
+    conf = get_config()
+    if conf.shard_processes == 1 and len(conf.shard_nodes) == 1:
+        downtimer_app = Downtimer()
+        downtimer_app.run()
+        return
+
+    ring = sharding.HashRing(sharding.shard_names(conf.shard_nodes,
+                                                  conf.shard_processes))
+    sharding.run_shards(
+        sharding.shard_names([conf.shard_node], conf.shard_processes),
+        lambda shard: run_shard(shard, ring))
+
+
 def main(argv=None):
+    from daemonize import Daemonize
 
-    logger.setLevel(CONF.log_level)
-    formatter = logging.Formatter(CONF.log_format)
-    handler = logging.FileHandler(CONF.log_file)
+    conf = get_config()
+    logger.setLevel(conf.log_level)
+    formatter = logging.Formatter(conf.log_format)
+    handler = logging.FileHandler(conf.log_file)
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
     daemon = Daemonize(app="Downtimer",
-                       pid=CONF.pid_file,
+                       pid=conf.pid_file,
                        action=downtimer_starter,
                        logger=logger,
                        keep_fds=[handler.stream.fileno()])
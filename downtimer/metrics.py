@@ -0,0 +1,154 @@
+import BaseHTTPServer
+import bisect
+import logging
+import SocketServer
+import threading
+
+from db_adapters import AdapterWrapper, INSTANCE, SERVICE
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class TargetMetrics(object):
+    def __init__(self):
+        self.probes = 0
+        self.failures = 0
+        self.up = 1
+        self.loss = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def add(self, failed, latency, loss):
+        self.probes += 1
+        self.failures += failed
+        self.up = int(not failed)
+        self.loss = loss
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+
+
+class ProbeMetrics(AdapterWrapper):
+    '''
+    Keeps Prometheus metrics of every target up to date as samples pass
+    through to the wrapped adapter: whether it is up, probe and failure
+    counters, packet loss ratio and a latency histogram. Rendering them
+    walks the targets once and never touches the database.
+    '''
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.targets = {}
+        self.lock = threading.Lock()
+
+    def record(self, kind, target, failed, latency, loss):
+        with self.lock:
+            metrics = self.targets.get((kind, target))
+            if metrics is None:
+                metrics = self.targets[(kind, target)] = TargetMetrics()
+            metrics.add(failed, latency, loss)
+
+    def store_instance_status(self, address, total_time, exit_code, value,
+                              timestamp=None, rtt=None, interval=None):
+        self.adapter.store_instance_status(address, total_time, exit_code,
+                                           value, timestamp, rtt=rtt,
+                                           interval=interval)
+        # a failed ping waited for the timeout in `total_time`
+        latency = rtt if rtt is not None else float(total_time)
+        self.record(INSTANCE, address, int(exit_code) != 0, latency / 1e3,
+                    float(value) / 100.0)
+
+    def store_service_status(self, endpoint, address, status_code, timeout,
+                             value, timestamp=None, interval=None):
+        self.adapter.store_service_status(endpoint, address, status_code,
+                                          timeout, value, timestamp,
+                                          interval=interval)
+        self.record(SERVICE, endpoint, status_code not in (200, 300),
+                    float(value) / 1e6, 0.0)
+
+    def render(self):
+        '''Metrics in the Prometheus text exposition format.'''
+        with self.lock:
+            targets = [(kind, target, metrics.probes, metrics.failures,
+                        metrics.up, metrics.loss, list(metrics.buckets),
+                        metrics.latency_sum)
+                       for (kind, target), metrics in self.targets.items()]
+        lines = {'up': [], 'probes': [], 'failures': [], 'loss': [],
+                 'latency': []}
+        for kind, target, probes, failures, up, loss, buckets, total \
+                in targets:
+            labels = 'kind="%s",target="%s"' % (escape(kind), escape(target))
+            lines['up'].append('downtimer_target_up{%s} %d' % (labels, up))
+            lines['probes'].append('downtimer_probes_total{%s} %d' %
+                                   (labels, probes))
+            lines['failures'].append('downtimer_probe_failures_total{%s} %d'
+                                     % (labels, failures))
+            lines['loss'].append('downtimer_packet_loss_ratio{%s} %r' %
+                                 (labels, loss))
+            count = 0
+            for bound, bucket in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                count += bucket
+                lines['latency'].append(
+                    'downtimer_probe_latency_seconds_bucket{%s,le="%s"} %d'
+                    % (labels, bound, count))
+            lines['latency'].append(
+                'downtimer_probe_latency_seconds_sum{%s} %r' % (labels, total))
+            lines['latency'].append(
+                'downtimer_probe_latency_seconds_count{%s} %d' %
+                (labels, count))
+
+        output = []
+        for key, name, kind, description in (
+                ('up', 'downtimer_target_up', 'gauge',
+                 'Whether the last probe of the target succeeded'),
+                ('probes', 'downtimer_probes_total', 'counter',
+                 'Probes of the target'),
+                ('failures', 'downtimer_probe_failures_total', 'counter',
+                 'Failed probes of the target'),
+                ('loss', 'downtimer_packet_loss_ratio', 'gauge',
+                 'Packet loss of the last ping of the target'),
+                ('latency', 'downtimer_probe_latency_seconds', 'histogram',
+                 'Time the probes of the target took')):
+            output.append('# HELP %s %s' % (name, description))
+            output.append('# TYPE %s %s' % (name, kind))
+            output.extend(lines[key])
+        return u'\n'.join(output).encode('utf-8') + '\n'
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render() + \
+            instrumentation.REGISTRY.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metrics, address, port):
+        self.metrics = metrics
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port),
+                                           MetricsHandler)
+
+    def start(self):
+        worker = threading.Thread(target=self.serve_forever)
+        worker.daemon = True
+        worker.start()
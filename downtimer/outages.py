@@ -0,0 +1,122 @@
+import logging
+import threading
+
+from datetime import datetime
+
+from db_adapters import AdapterWrapper, INSTANCE, SERVICE
+
+logger = logging.getLogger(__name__)
+
+
+class TargetState(object):
+    '''
+    Debounced up/down state of one target. A target goes down after
+    `down_threshold` failed samples in a row and the outage is dated from
+    the first of them; it comes back up after `up_threshold` good samples
+    in a row, dated from the first good one.
+    '''
+    def __init__(self, kind, target):
+        self.kind = kind
+        self.target = target
+        self.down = False
+        self.streak = 0
+        self.streak_start = None
+        self.worst_status = None
+        self.last_seen = None
+
+    def update(self, failed, status, timestamp, down_threshold,
+               up_threshold):
+        '''
+        Feeds one sample and returns a finished outage or None.
+        '''
+        self.last_seen = timestamp
+        if failed != self.down:
+            if not self.streak:
+                self.streak_start = timestamp
+            self.streak += 1
+        else:
+            self.streak = 0
+
+        if failed:
+            if self.worst_status is None or status > self.worst_status:
+                self.worst_status = status
+
+        if not self.down:
+            if self.streak >= down_threshold:
+                self.down = True
+                self.start = self.streak_start
+                self.streak = 0
+            elif not self.streak:
+                self.worst_status = None
+        elif self.streak >= up_threshold:
+            return self.close(self.streak_start)
+        return None
+
+    def close(self, end):
+        outage = {'kind': self.kind, 'target': self.target,
+                  'start': self.start, 'end': end,
+                  'duration': (end - self.start).total_seconds(),
+                  'worst_status': self.worst_status}
+        self.down = False
+        self.streak = 0
+        self.worst_status = None
+        return outage
+
+
+class OutageDetector(AdapterWrapper):
+    '''
+    Sits between the probers and a DBAdapter: every sample is stored as
+    is and also fed to a per target state machine which turns the stream
+    into outage intervals. Finished outages are saved through
+    `store_outage` of the wrapped adapter.
+
+    The worst status of a service outage is its highest status code, of
+    an instance outage its highest packet loss.
+    '''
+    def __init__(self, adapter, down_threshold=2, up_threshold=2):
+        self.adapter = adapter
+        self.down_threshold = down_threshold
+        self.up_threshold = up_threshold
+        self.targets = {}
+        self.lock = threading.Lock()
+
+    def store_instance_status(self, address, total_time, exit_code, value,
+                              timestamp=None, rtt=None, interval=None):
+        timestamp = timestamp or datetime.utcnow()
+        self.adapter.store_instance_status(address, total_time, exit_code,
+                                           value, timestamp, rtt=rtt,
+                                           interval=interval)
+        self.feed(INSTANCE, address, int(exit_code) != 0, float(value),
+                  timestamp)
+
+    def store_service_status(self, endpoint, address, status_code, timeout,
+                             value, timestamp=None, interval=None):
+        timestamp = timestamp or datetime.utcnow()
+        self.adapter.store_service_status(endpoint, address, status_code,
+                                          timeout, value, timestamp,
+                                          interval=interval)
+        self.feed(SERVICE, endpoint, status_code not in (200, 300),
+                  status_code, timestamp)
+
+    def feed(self, kind, target, failed, status, timestamp=None):
+        timestamp = timestamp or datetime.utcnow()
+        with self.lock:
+            state = self.targets.get((kind, target))
+            if state is None:
+                state = self.targets[(kind, target)] = TargetState(kind,
+                                                                   target)
+            outage = state.update(failed, status, timestamp,
+                                  self.down_threshold, self.up_threshold)
+        if outage is not None:
+            logger.info('%(kind)s %(target)s was down from %(start)s to '
+                        '%(end)s', outage)
+            self.adapter.store_outage(outage)
+
+    def close(self):
+        '''Ends the outages still in progress at their last sample.'''
+        with self.lock:
+            outages = [state.close(state.last_seen)
+                       for state in self.targets.values() if state.down]
+        for outage in outages:
+            self.adapter.store_outage(outage)
+        self.adapter.close()
@@ -0,0 +1,221 @@
+import csv
+import json
+from datetime import datetime
+
+import numpy
+
+from db_adapters import INSTANCE, SERVICE
+
+# columns of the tables written as CSV
+COLUMNS = {
+    'targets': ('kind', 'target', 'cloud', 'region', 'samples', 'failed',
+                'availability', 'outages', 'downtime', 'mttr', 'mtbf'),
+    'kinds': ('kind', 'targets', 'samples', 'failed', 'availability'),
+    'regions': ('kind', 'cloud', 'region', 'targets', 'samples', 'failed',
+                'availability'),
+    'buckets': ('kind', 'start', 'samples', 'failed', 'availability'),
+}
+
+
+class Samples(object):
+    '''
+    Samples of one kind as columns: target ids indexing `targets`, epoch
+    times, failed flags, the seconds every sample stands for and those of
+    them down, sorted by target and then by time. `tags` holds the cloud
+    and region of the targets by name.
+    '''
+    def __init__(self, kind, targets, ids, times, failed, seconds,
+                 down_seconds, tags=None):
+        order = numpy.lexsort((times, ids))
+        self.kind = kind
+        self.targets = targets
+        self.tags = tags or {}
+        self.ids = ids[order]
+        self.times = times[order]
+        self.failed = failed[order]
+        self.seconds = seconds[order]
+        self.down_seconds = down_seconds[order]
+
+    @classmethod
+    def load(cls, adapter, kind, since=None, until=None):
+        '''Streams the samples from the adapter chunk by chunk.'''
+        index = {}
+        ids, times, failed, seconds, down_seconds = [], [], [], [], []
+        for chunk in adapter.iter_samples(kind, since, until):
+            # fromiter over generators doesn't build a tuple per row
+            ids.append(numpy.fromiter(
+                (index.setdefault(row[0], len(index)) for row in chunk),
+                numpy.int32, len(chunk)))
+            times.append(numpy.fromiter((row[1] for row in chunk),
+                                        numpy.float64, len(chunk)))
+            failed.append(numpy.fromiter((row[2] for row in chunk), bool,
+                                         len(chunk)))
+            seconds.append(numpy.fromiter((row[3] for row in chunk),
+                                          numpy.float64, len(chunk)))
+            down_seconds.append(numpy.fromiter((row[4] for row in chunk),
+                                               numpy.float64, len(chunk)))
+        targets = sorted(index, key=index.get)
+        tags = adapter.get_target_tags(kind)
+        if not ids:
+            return cls(kind, targets, numpy.zeros(0, numpy.int32),
+                       numpy.zeros(0), numpy.zeros(0, bool), numpy.zeros(0),
+                       numpy.zeros(0), tags)
+        return cls(kind, targets, numpy.concatenate(ids),
+                   numpy.concatenate(times), numpy.concatenate(failed),
+                   numpy.concatenate(seconds), numpy.concatenate(down_seconds),
+                   tags)
+
+    def outages(self):
+        '''
+        Runs of failed samples as target ids, start and end times. A run
+        ends with the next successful sample of the target, or with its
+        last sample.
+        '''
+        same_next = self.ids[1:] == self.ids[:-1]
+        failed_next = numpy.zeros(len(self.ids), bool)
+        failed_next[:-1] = self.failed[1:] & same_next
+        failed_prev = numpy.zeros(len(self.ids), bool)
+        failed_prev[1:] = self.failed[:-1] & same_next
+        starts = numpy.flatnonzero(self.failed & ~failed_prev)
+        ends = numpy.flatnonzero(self.failed & ~failed_next)
+        recovered = numpy.zeros(len(self.ids), bool)
+        recovered[:-1] = same_next
+        ends = numpy.where(recovered[ends], ends + 1, ends)
+        return self.ids[starts], self.times[starts], self.times[ends]
+
+
+def availability(seconds, down_seconds):
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(seconds > 0, 100.0 * (seconds - down_seconds) /
+                           numpy.where(seconds > 0, seconds, 1), numpy.nan)
+
+
+def number(value):
+    '''Plain float for output, None for NaN.'''
+    value = float(value)
+    return None if numpy.isnan(value) else value
+
+
+class Report(object):
+    '''
+    Availability of every target, kind, cloud region and time bucket of
+    `bucket` seconds, and the mean time to repair and between failures of
+    every target, computed over whole sample columns at once. Availability
+    is the share of the seconds the samples stand for that the target was
+    up, so samples of fast probes weigh less and a ping counts the share
+    of its packets lost.
+    '''
+    def __init__(self, samples, bucket=3600):
+        self.targets = []
+        self.kinds = []
+        self.regions = []
+        self.buckets = []
+        for columns in samples:
+            self._add(columns, bucket)
+
+    @classmethod
+    def load(cls, adapter, since=None, until=None, bucket=3600):
+        return cls([Samples.load(adapter, kind, since, until)
+                    for kind in (SERVICE, INSTANCE)], bucket)
+
+    def _add(self, columns, bucket):
+        count = len(columns.targets)
+        if not count:
+            return
+        ids, times, failed = columns.ids, columns.times, columns.failed
+        down = columns.down_seconds
+        totals = numpy.bincount(ids, minlength=count)
+        failures = numpy.bincount(ids, weights=failed, minlength=count)
+        seconds = numpy.bincount(ids, weights=columns.seconds,
+                                 minlength=count)
+        down_seconds = numpy.bincount(ids, weights=down, minlength=count)
+
+        first = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]])
+        last = numpy.r_[first[1:] - 1, len(ids) - 1]
+        span = numpy.zeros(count)
+        span[ids[first]] = times[last] - times[first]
+        outage_ids, starts, ends = columns.outages()
+        outages = numpy.bincount(outage_ids, minlength=count)
+        downtime = numpy.bincount(outage_ids, weights=ends - starts,
+                                  minlength=count)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            mttr = numpy.where(outages > 0, downtime / outages, numpy.nan)
+            mtbf = numpy.where(outages > 0, (span - downtime) / outages,
+                               numpy.nan)
+        shares = availability(seconds, down_seconds)
+
+        regions = [columns.tags.get(target, {}) for target in columns.targets]
+        regions = [(tags.get('cloud', ''), tags.get('region', ''))
+                   for tags in regions]
+        for i, target in enumerate(columns.targets):
+            self.targets.append({
+                'kind': columns.kind, 'target': target,
+                'cloud': regions[i][0], 'region': regions[i][1],
+                'samples': int(totals[i]), 'failed': int(failures[i]),
+                'availability': number(shares[i]),
+                'outages': int(outages[i]), 'downtime': float(downtime[i]),
+                'mttr': number(mttr[i]), 'mtbf': number(mtbf[i])})
+
+        self.kinds.append({
+            'kind': columns.kind, 'targets': count,
+            'samples': int(totals.sum()), 'failed': int(failures.sum()),
+            'availability': number(availability(seconds.sum(),
+                                                down_seconds.sum()))})
+
+        names = sorted(set(regions))
+        positions = dict((name, i) for i, name in enumerate(names))
+        region_ids = numpy.array([positions[region] for region in regions])
+        region_targets = numpy.bincount(region_ids, minlength=len(names))
+        region_totals = numpy.bincount(region_ids, weights=totals,
+                                       minlength=len(names))
+        region_failures = numpy.bincount(region_ids, weights=failures,
+                                         minlength=len(names))
+        shares = availability(
+            numpy.bincount(region_ids, weights=seconds, minlength=len(names)),
+            numpy.bincount(region_ids, weights=down_seconds,
+                           minlength=len(names)))
+        for i, (cloud, region) in enumerate(names):
+            self.regions.append({
+                'kind': columns.kind, 'cloud': cloud, 'region': region,
+                'targets': int(region_targets[i]),
+                'samples': int(region_totals[i]),
+                'failed': int(region_failures[i]),
+                'availability': number(shares[i])})
+
+        periods, period_ids = numpy.unique(times // bucket,
+                                           return_inverse=True)
+        period_totals = numpy.bincount(period_ids)
+        period_failures = numpy.bincount(period_ids, weights=failed)
+        shares = availability(
+            numpy.bincount(period_ids, weights=columns.seconds),
+            numpy.bincount(period_ids, weights=down))
+        for i, period in enumerate(periods):
+            self.buckets.append({
+                'kind': columns.kind,
+                'start': datetime.utcfromtimestamp(period * bucket)
+                .isoformat(),
+                'samples': int(period_totals[i]),
+                'failed': int(period_failures[i]),
+                'availability': number(shares[i])})
+
+    def worst(self, count=10):
+        '''Targets with the lowest availability first.'''
+        return sorted(self.targets,
+                      key=lambda target: target['availability'])[:count]
+
+    def as_dict(self, worst=10):
+        return {'targets': self.targets, 'kinds': self.kinds,
+                'regions': self.regions, 'buckets': self.buckets,
+                'worst': self.worst(worst)}
+
+    def write_json(self, f, worst=10):
+        json.dump(self.as_dict(worst), f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    def write_csv(self, f, table='targets'):
+        writer = csv.DictWriter(f, COLUMNS[table])
+        writer.writeheader()
+        for row in getattr(self, table):
+            writer.writerow(dict(
+                (key, value.encode('utf-8') if isinstance(value, unicode)
+                 else value) for key, value in row.items()))
@@ -0,0 +1,233 @@
+import ctypes
+import ctypes.util
+import heapq
+import itertools
+import logging
+import Queue
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _load_clock_gettime():
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        return librt.clock_gettime
+    except (OSError, AttributeError):
+        return None
+
+_clock_gettime = _load_clock_gettime()
+
+
+def monotonic():
+    '''
+    Seconds from an arbitrary point which, unlike time.time(), never jump
+    when the wall clock is adjusted. Python 2 has no time.monotonic.
+    '''
+    if _clock_gettime is None:
+        return time.time()
+    ts = _Timespec()
+    _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+def spread_offset(key, interval):
+    '''
+    Stable offset of a target within its interval, so that probes of all
+    targets are spread evenly instead of starting at the same instant.
+    '''
+    return (zlib.crc32(repr(key)) & 0xffffffff) / float(1 << 32) * interval
+
+
+class Job(object):
+    def __init__(self, key, func, interval, kind, blocking):
+        self.key = key
+        self.func = func
+        self.interval = interval
+        self.kind = kind
+        self.blocking = blocking
+        self.running = False
+        self.cancelled = False
+        # heap entries of an older generation are stale
+        self.generation = 0
+
+
+class Scheduler(object):
+    '''
+    Owns the probing cadence of every target.
+
+    Periodic jobs run on a monotonic clock at start + n * interval, so
+    they don't drift with the time the probe itself takes. A job that
+    fell behind by whole intervals skips them instead of bursting to
+    catch up. Jobs run in the dispatcher thread and must not block unless
+    added with blocking=True, in which case one of `workers` threads runs
+    them; a blocking job still running when it's due again is skipped.
+
+    How late every run started compared to its due time is recorded per
+    kind of job, which bounds the resolution of the measurements.
+    '''
+    def __init__(self, workers=32):
+        self.workers = workers
+        self.heap = []
+        self.counter = itertools.count()
+        self.jobs = {}
+        self.condition = threading.Condition()
+        self.queue = Queue.Queue()
+        self.lag = {}
+
+    def start(self):
+        threads = [self._dispatch_loop] + [self._work] * self.workers
+        for target in threads:
+            worker = threading.Thread(target=target)
+            worker.daemon = True
+            worker.start()
+
+    def add(self, key, func, interval, kind='probe', blocking=False):
+        job = Job(key, func, interval, kind, blocking)
+        with self.condition:
+            old = self.jobs.get(key)
+            if old is not None:
+                old.cancelled = True
+            self.jobs[key] = job
+            self._push(monotonic() + spread_offset(key, interval), job)
+
+    def remove(self, key):
+        with self.condition:
+            job = self.jobs.pop(key, None)
+            if job is not None:
+                job.cancelled = True
+
+    def interval(self, key):
+        with self.condition:
+            job = self.jobs.get(key)
+            return job.interval if job is not None else None
+
+    def set_interval(self, key, interval):
+        '''
+        Changes how often a job runs. A job sped up runs again `interval`
+        from now, one slowed down keeps its spread offset.
+        '''
+        with self.condition:
+            job = self.jobs.get(key)
+            if job is None or job.interval == interval:
+                return
+            delay = interval
+            if interval > job.interval:
+                delay = spread_offset(key, interval)
+            job.interval = interval
+            job.generation += 1
+            self._push(monotonic() + delay, job)
+
+    def call_later(self, delay, func, *args):
+        job = Job(None, lambda: func(*args), None, None, False)
+        with self.condition:
+            self._push(monotonic() + delay, job)
+
+    def _push(self, due, job):
+        heapq.heappush(self.heap,
+                       (due, next(self.counter), job, job.generation))
+        self.condition.notify()
+
+    def _dispatch_loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        due, _, job, generation = heapq.heappop(self.heap)
+                        break
+                    timeout = self.heap[0][0] - now if self.heap else None
+                    self.condition.wait(timeout)
+                if job.cancelled or generation != job.generation:
+                    continue
+                if job.interval is not None:
+                    self._reschedule(due, now, job)
+            self.dispatch(due, job)
+
+    def _reschedule(self, due, now, job):
+        next_due = due + job.interval
+        if next_due <= now:
+            missed = int((now - due) // job.interval)
+            self._stats(job.kind)['missed'] += missed
+            next_due = due + (missed + 1) * job.interval
+        self._push(next_due, job)
+
+    def dispatch(self, due, job):
+        if not job.blocking:
+            self._run(due, job)
+        elif job.running:
+            self.record_overrun(job.kind)
+        else:
+            job.running = True
+            self.queue.put((due, job))
+
+    def _work(self):
+        while True:
+            due, job = self.queue.get()
+            try:
+                self._run(due, job)
+            finally:
+                job.running = False
+
+    def _run(self, due, job):
+        started = monotonic()
+        if job.kind is not None:
+            self.record_lag(job.kind, started - due)
+        try:
+            job.func()
+        except Exception as e:
+            logger.exception('Scheduled job %s failed: %s', job.key, e)
+        if job.kind is not None:
+            self.record_duration(job.kind, monotonic() - started)
+
+    def _stats(self, kind):
+        stats = self.lag.get(kind)
+        if stats is None:
+            stats = self.lag[kind] = {'runs': 0, 'total_lag': 0.0,
+                                      'max_lag': 0.0, 'missed': 0,
+                                      'overrun': 0, 'total_time': 0.0,
+                                      'max_time': 0.0}
+        return stats
+
+    def record_lag(self, kind, lag):
+        with self.condition:
+            stats = self._stats(kind)
+            stats['runs'] += 1
+            stats['total_lag'] += lag
+            stats['max_lag'] = max(stats['max_lag'], lag)
+
+    def record_overrun(self, kind):
+        '''Counts a run skipped because the previous one still ran.'''
+        with self.condition:
+            self._stats(kind)['overrun'] += 1
+
+    def record_duration(self, kind, duration):
+        with self.condition:
+            stats = self._stats(kind)
+            stats['total_time'] += duration
+            stats['max_time'] = max(stats['max_time'], duration)
+
+    def stats(self):
+        '''
+        Per kind of job: runs, mean and max lag and run time in seconds,
+        skipped runs.
+        '''
+        with self.condition:
+            result = {}
+            for kind, stats in self.lag.items():
+                result[kind] = dict(stats)
+                runs = stats['runs']
+                result[kind]['mean_lag'] = (stats['total_lag'] / runs
+                                            if runs else 0.0)
+                result[kind]['mean_time'] = (stats['total_time'] / runs
+                                             if runs else 0.0)
+            return result
@@ -0,0 +1,67 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+# points every shard owns on the ring, more of them even out the split
+REPLICAS = 100
+
+
+def ring_hash(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    '''
+    Consistent hash ring of shard names. Every node computes the same ring
+    from the same list of shards, so they agree on who probes a target
+    without talking to each other, and adding or removing one of N shards
+    moves only about 1/N of the targets.
+    '''
+    def __init__(self, shards, replicas=REPLICAS):
+        self.shards = list(shards)
+        ring = sorted((ring_hash('%s-%d' % (shard, i)), shard)
+                      for shard in self.shards for i in range(replicas))
+        self.points = [point for point, _ in ring]
+        self.owners = [shard for _, shard in ring]
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, ring_hash(key))
+        return self.owners[index % len(self.points)]
+
+
+def shard_names(nodes, processes):
+    return ['%s/%d' % (node, i) for node in nodes for i in range(processes)]
+
+
+def target_key(kind, target):
+    return '%s:%s' % (kind, target)
+
+
+def run_shards(shards, action):
+    '''
+    Runs action(shard) in a separate process for every shard and waits
+    for them. Each process has its own interpreter lock, scheduler and
+    database connection; reports combine the shards from the database.
+    '''
+    processes = []
+    try:
+        for shard in shards:
+            process = multiprocessing.Process(target=action, args=(shard,),
+                                              name='downtimer-%s' % shard)
+            process.start()
+            logger.info('Started shard %s (pid %d)', shard, process.pid)
+            processes.append(process)
+        for process in processes:
+            process.join()
+            if process.exitcode:
+                logger.error('Shard process %s exited with code %d',
+                             process.name, process.exitcode)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
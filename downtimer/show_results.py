@@ -1,30 +1,113 @@
 #!/usr/bin/env python
 
+import argparse
+import sys
+
+from config import get_config
+import live
 import main
+import sketches
+import utils
+
+parser = argparse.ArgumentParser(description='Show downtime report')
+parser.add_argument('--since', type=utils.parse_time,
+                    help='only count samples taken at or after this UTC '
+                         'time, e.g. 2017-01-31T02:00')
+parser.add_argument('--until', type=utils.parse_time,
+                    help='only count samples taken before this UTC time')
+parser.add_argument('--live', metavar='SOCKET',
+                    help='show the current state of every target from the '
+                         'status socket of a running daemon instead')
+parser.add_argument('--minutes', type=float, default=5,
+                    help='availability window of --live in minutes')
+parser.add_argument('--format', choices=('text', 'json', 'csv'),
+                    default='text',
+                    help='json and csv compute availability per target, '
+                         'kind and time bucket, MTTR and MTBF from the raw '
+                         'samples (needs NumPy)')
+parser.add_argument('--table',
+                    choices=('targets', 'kinds', 'regions', 'buckets'),
+                    default='targets', help='table written as csv')
+parser.add_argument('--bucket', type=float, default=3600,
+                    help='seconds per time bucket')
+parser.add_argument('--worst', type=int, default=10,
+                    help='number of least available targets listed')
+parser.add_argument('--latency', action='store_true',
+                    help='show latency percentiles of every target merged '
+                         'from the saved sketches instead')
+args = parser.parse_args()
+
+if args.live:
+    for target in live.query_status(args.live, args.minutes):
+        availability = target['availability']
+        print(
+            "%s %s is %s, %s%% available over the last %g minutes "
+            "(status %d, latency %.1f ms, loss %.0f%%)" % (
+                target['kind'].capitalize(), target['target'],
+                'up' if target['up'] else 'DOWN',
+                '?' if availability is None else '%.1f' % availability,
+                args.minutes, target['status'], target['latency'],
+                target['loss']
+            )
+        )
+    sys.exit(0)
+
+# only the database is read, the probing pipeline is not built
+conf = get_config()
+adapter = main.load_adapter(conf.db_adapter)(conf)
+try:
+    if args.latency:
+        for target in sketches.latency_percentiles(adapter, args.since,
+                                                   args.until):
+            print(
+                "%s %s latency over %d probes: p50 %.1f ms, p95 %.1f ms, "
+                "p99 %.1f ms, max %.1f ms" % (
+                    target['kind'].capitalize(), target['target'],
+                    target['samples'], target['p50'], target['p95'],
+                    target['p99'], target['max']
+                )
+            )
+        sys.exit(0)
 
-_downtimer = main.Downtimer()
-adapter = _downtimer.db_adapter
+    if args.format != 'text':
+        import report
 
+        _report = report.Report.load(adapter, args.since, args.until,
+                                     args.bucket)
+        if args.format == 'json':
+            _report.write_json(sys.stdout, args.worst)
+        else:
+            _report.write_csv(sys.stdout, args.table)
+        sys.exit(0)
 
-for service in adapter.get_service_statuses():
-    _srv_downtime = service.get('srv_downtime', 0)
-    _total_uptime = service.get('total_uptime', 1)
-    _service_down_time = ((100.0 * _srv_downtime) / _total_uptime)
-    print(
-        "Service %s was down approximately %d seconds which are %.1f"
-        "%% of total uptime" % (
-            service['service'], service['srv_downtime'], _service_down_time
+    for service in adapter.get_service_statuses(args.since, args.until):
+        _srv_downtime = service.get('downtime', 0)
+        _total_uptime = service.get('duration') or 1
+        _service_down_time = ((100.0 * _srv_downtime) / _total_uptime)
+        print(
+            "Service %s was down approximately %d seconds which are %.1f"
+            "%% of total uptime" % (
+                service['service'], _srv_downtime, _service_down_time
+            )
         )
-    )
 
+    for address in adapter.get_instance_statuses(args.since, args.until):
+        _failed = address.get('downtime', 0)
+        _total_time = address.get('duration') or 1
+        _address_down_time = ((100.0 * _failed) / _total_time)
+        print(
+            "Address %s was unreachable approximately %.1f second which are"
+            " %.1f %% of total uptime" % (
+                address['address'], _failed, _address_down_time
+            )
+        )
 
-for address in adapter.get_instance_statuses():
-    _failed = address.get('failed', 0)
-    _total_time = address.get('total_time', 1)
-    _address_down_time = ((100.0 * _failed) / _total_time)
-    print(
-        "Address %s was unreachable approximately %.1f second which are"
-        " %.1f %% of total uptime" % (
-            address['address'], _failed, _address_down_time
+    for outage in adapter.get_outages(args.since, args.until):
+        print(
+            "%s %s was down from %s to %s (%.1f seconds, worst status %g)" % (
+                outage['kind'].capitalize(), outage['target'], outage['start'],
+                outage['end'], outage['duration'], outage['worst_status']
+            )
         )
-    )
+finally:
+    adapter.close()
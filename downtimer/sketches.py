@@ -0,0 +1,176 @@
+import json
+import logging
+import math
+import threading
+
+from datetime import datetime, timedelta
+
+from db_adapters import AdapterWrapper, INSTANCE, SERVICE
+
+logger = logging.getLogger(__name__)
+
+# latencies up to this many ms are counted as zero
+MIN_LATENCY = 0.001
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencySketch(object):
+    '''
+    Quantile sketch of latencies in ms with logarithmic buckets: every
+    quantile is within `accuracy` of the true value relative to it.
+    Sketches of the same accuracy merge by adding their bucket counts, so
+    any number of them, e.g. of consecutive time buckets or of several
+    shards, answer quantiles as one. A few hundred buckets cover
+    everything from microseconds to minutes.
+    '''
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.counts = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        if latency <= MIN_LATENCY:
+            self.zeros += 1
+        else:
+            index = int(math.ceil(math.log(latency) / self.log_gamma))
+            self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += latency
+        self.max = max(self.max, latency)
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError('Sketches of accuracy %g and %g do not merge' %
+                             (self.accuracy, other.accuracy))
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if rank < seen:
+                # the middle of the bucket, at most `accuracy` off
+                return min(2 * self.gamma ** index / (self.gamma + 1),
+                           self.max)
+        return self.max
+
+    def dumps(self):
+        return json.dumps({'accuracy': self.accuracy, 'zeros': self.zeros,
+                           'count': self.count, 'sum': self.sum,
+                           'max': self.max,
+                           'counts': sorted(self.counts.items())},
+                          separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, data):
+        fields = json.loads(data)
+        sketch = cls(fields['accuracy'])
+        sketch.counts = dict((index, count)
+                             for index, count in fields['counts'])
+        for key in ('zeros', 'count', 'sum', 'max'):
+            setattr(sketch, key, fields[key])
+        return sketch
+
+
+class LatencySketches(AdapterWrapper):
+    '''
+    Keeps a LatencySketch per target and time bucket of `bucket` seconds
+    of the latencies of successful probes as samples pass through, and
+    saves them through `store_sketches` of the wrapped adapter once the
+    bucket is over. Sketches are saved as rows of kind, target, bucket
+    start and the serialized sketch; rows are only ever added up, so a
+    bucket saved by a restarted daemon or another shard merges in too.
+    '''
+    def __init__(self, adapter, bucket=300, accuracy=0.01):
+        self.adapter = adapter
+        self.bucket = bucket
+        self.accuracy = accuracy
+        self.sketches = {}
+        self.lock = threading.Lock()
+
+    def bucket_start(self, timestamp):
+        epoch = (timestamp - datetime(1970, 1, 1)).total_seconds()
+        return datetime.utcfromtimestamp(epoch - epoch % self.bucket)
+
+    def record(self, kind, target, latency, timestamp=None):
+        start = self.bucket_start(timestamp or datetime.utcnow())
+        with self.lock:
+            sketch = self.sketches.get((kind, target, start))
+            if sketch is None:
+                sketch = self.sketches[(kind, target, start)] = \
+                    LatencySketch(self.accuracy)
+            sketch.add(latency)
+
+    def store_instance_status(self, address, total_time, exit_code, value,
+                              timestamp=None, rtt=None, interval=None):
+        self.adapter.store_instance_status(address, total_time, exit_code,
+                                           value, timestamp, rtt=rtt,
+                                           interval=interval)
+        if int(exit_code) == 0 and rtt is not None:
+            self.record(INSTANCE, address, rtt, timestamp)
+
+    def store_service_status(self, endpoint, address, status_code, timeout,
+                             value, timestamp=None, interval=None):
+        self.adapter.store_service_status(endpoint, address, status_code,
+                                          timeout, value, timestamp,
+                                          interval=interval)
+        if status_code in (200, 300):
+            self.record(SERVICE, endpoint, float(value) / 1e3, timestamp)
+
+    def flush(self, now=None):
+        '''Saves the sketches of finished buckets, or all without `now`.'''
+        with self.lock:
+            keys = [key for key in self.sketches if now is None or
+                    key[2] + timedelta(seconds=self.bucket) <= now]
+            rows = [{'kind': kind, 'target': target, 'start': start,
+                     'sketch': self.sketches.pop((kind, target, start))
+                     .dumps()}
+                    for kind, target, start in keys]
+        if rows:
+            self.adapter.store_sketches(rows)
+
+    def flush_finished(self):
+        self.flush(datetime.utcnow())
+
+    def close(self):
+        self.flush()
+        self.adapter.close()
+
+
+def latency_percentiles(adapter, since=None, until=None,
+                        quantiles=QUANTILES):
+    '''
+    Latency quantiles in ms of every target over the time buckets which
+    start within [since, until), merged from the saved sketches.
+    '''
+    merged = {}
+    for row in adapter.get_sketches(since, until):
+        sketch = LatencySketch.loads(row['sketch'])
+        key = (row['kind'], row['target'])
+        if key in merged:
+            merged[key].merge(sketch)
+        else:
+            merged[key] = sketch
+    result = []
+    for (kind, target), sketch in sorted(merged.items()):
+        row = {'kind': kind, 'target': target, 'samples': sketch.count,
+               'mean': sketch.sum / sketch.count, 'max': sketch.max}
+        for q in quantiles:
+            row['p%g' % (q * 100)] = sketch.quantile(q)
+        result.append(row)
+    return result
@@ -0,0 +1,342 @@
+import collections
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from datetime import datetime
+
+from db_adapters import AdapterWrapper, INSTANCE, SERVICE, to_epoch
+from instrumentation import timed
+
+logger = logging.getLogger(__name__)
+
+# payload length and crc32 in front of every record, a zero length ends
+# the written part of a segment
+HEADER = struct.Struct('<II')
+SEGMENT_SUFFIX = '.seg'
+CHECKPOINT_FILE = 'checkpoint'
+
+
+class Segment(object):
+    '''
+    Preallocated spool file mapped into memory. A record's payload is
+    copied before its header, so a reader never sees half of a record; a
+    torn write after a crash fails the crc and ends the segment.
+    '''
+    def __init__(self, path, segment_id, size=None):
+        self.path = path
+        self.id = segment_id
+        self.file = open(path, 'r+b' if size is None else 'w+b')
+        if size is not None:
+            self.file.truncate(size)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.offset = 0
+
+    def append(self, payload):
+        start = self.offset + HEADER.size
+        end = start + len(payload)
+        if end + HEADER.size > self.size:
+            return False
+        self.map[start:end] = payload
+        self.map[self.offset:start] = HEADER.pack(
+            len(payload), zlib.crc32(payload) & 0xffffffff)
+        self.offset = end
+        return True
+
+    def read(self, offset):
+        '''Returns the payload at offset and the offset after it.'''
+        start = offset + HEADER.size
+        if start > self.size:
+            return None, offset
+        length, crc = HEADER.unpack(self.map[offset:start])
+        payload = self.map[start:start + length]
+        if not length or zlib.crc32(payload) & 0xffffffff != crc:
+            return None, offset
+        return payload, start + length
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class Spool(object):
+    '''
+    Append-only queue of records in a local directory.
+
+    Records are appended to memory mapped segment files of `segment_size`
+    bytes, so appending costs a memory copy. The reader commits how far it
+    has got, which is kept in a checkpoint file so that a restart resumes
+    after the last committed record; fully read segments are deleted.
+    When the segments would take more than `max_size` bytes, the oldest
+    one is deleted whether it was read or not.
+    '''
+    def __init__(self, directory, segment_size=4 << 20, max_size=256 << 20):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_size // segment_size)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX))
+        self.position = self._load_checkpoint()
+        self.reader = None
+        self.appended = 0
+        self.committed = 0
+        self.dropped_segments = 0
+        # never append to a segment written before a restart
+        self.writer = self._new_segment()
+
+    def _path(self, segment_id):
+        return os.path.join(self.directory,
+                            '%020d%s' % (segment_id, SEGMENT_SUFFIX))
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                segment_id, offset = json.load(f)
+        except (IOError, ValueError):
+            segment_id, offset = 0, 0
+        if segment_id not in self.segments:
+            later = [i for i in self.segments if i > segment_id]
+            return (later[0] if later else segment_id), 0
+        return segment_id, offset
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(list(self.position), f)
+        os.rename(path + '.tmp', path)
+
+    def _new_segment(self):
+        while len(self.segments) >= self.max_segments:
+            self._drop_oldest()
+        segment_id = self.position[0]
+        if self.segments:
+            segment_id = max(segment_id, self.segments[-1] + 1)
+        self.segments.append(segment_id)
+        return Segment(self._path(segment_id), segment_id, self.segment_size)
+
+    def _drop_oldest(self):
+        segment_id = self.segments.pop(0)
+        self._close_reader(segment_id)
+        os.remove(self._path(segment_id))
+        if self.position[0] <= segment_id:
+            logger.warning('Spool is full, dropped unsent segment %d',
+                           segment_id)
+            self.dropped_segments += 1
+            self.position = (segment_id + 1, 0)
+
+    def _close_reader(self, segment_id):
+        if self.reader is not None and self.reader.id <= segment_id:
+            self.reader.close()
+            self.reader = None
+
+    def _segment(self, segment_id):
+        if segment_id == self.writer.id:
+            return self.writer
+        if self.reader is not None and self.reader.id != segment_id:
+            self.reader.close()
+            self.reader = None
+        if self.reader is None:
+            self.reader = Segment(self._path(segment_id), segment_id)
+        return self.reader
+
+    @timed('spool.append')
+    def append(self, record):
+        payload = json.dumps(record, separators=(',', ':'))
+        if len(payload) + 2 * HEADER.size > self.segment_size:
+            raise ValueError('Record of %d bytes does not fit into a spool '
+                             'segment' % len(payload))
+        with self.lock:
+            if not self.writer.append(payload):
+                self.writer.close()
+                self.writer = self._new_segment()
+                self.writer.append(payload)
+            self.appended += 1
+
+    def read(self, limit):
+        '''
+        Returns up to `limit` records after the committed position and the
+        position after them, to be committed once they are processed.
+        '''
+        entries, position = self.entries(limit)
+        return [record for record, _ in entries], position
+
+    def entries(self, limit, position=None):
+        '''
+        Returns up to `limit` records after `position`, by default the
+        committed one, each with the position after it, and the position
+        reached.
+        '''
+        entries = []
+        with self.lock:
+            if position is None or position[0] < self.position[0]:
+                # the segments were dropped since
+                position = self.position
+            segment_id, offset = position
+            while len(entries) < limit:
+                segment = self._segment(segment_id)
+                payload, offset = segment.read(offset)
+                if payload is not None:
+                    entries.append((json.loads(payload),
+                                    (segment_id, offset)))
+                elif segment_id < self.writer.id:
+                    segment_id, offset = segment_id + 1, 0
+                else:
+                    break
+        return entries, (segment_id, offset)
+
+    def commit(self, position, count):
+        with self.lock:
+            if position[0] < self.position[0]:
+                # the segments were dropped while being read
+                return
+            self.position = position
+            self.committed += count
+            while self.segments[0] < position[0]:
+                segment_id = self.segments.pop(0)
+                self._close_reader(segment_id)
+                os.remove(self._path(segment_id))
+            self._save_checkpoint()
+
+    def stats(self):
+        '''Sizes in bytes, the backlog counts the space of unread segments.'''
+        with self.lock:
+            backlog = ((self.writer.id - self.position[0]) *
+                       self.segment_size +
+                       self.writer.offset - self.position[1])
+            return {'appended': self.appended, 'committed': self.committed,
+                    'segments': len(self.segments),
+                    'size': len(self.segments) * self.segment_size,
+                    'backlog': max(backlog, 0),
+                    'dropped_segments': self.dropped_segments}
+
+    def close(self):
+        with self.lock:
+            self.writer.flush()
+            self._close_reader(self.writer.id)
+            self.writer.close()
+
+
+class SpoolAdapter(AdapterWrapper):
+    '''
+    Sits in front of the other adapters so that probes only append their
+    samples to the local spool and never wait for the database. A drainer
+    thread replays the spool in order into the wrapped adapter and commits
+    a batch only once the adapter has written it; while the database is
+    down the adapter keeps retrying the batch and the spool grows.
+    Samples keep the time they were taken at.
+
+    Samples the wrapped adapters still hold in memory, like the runs of
+    a ChangeOnlyWriter, aren't written yet: records are committed only
+    up to the first one taken at or after the oldest held sample, and
+    the rest is read on from where the replay got to. After a crash the
+    held samples are replayed again.
+    '''
+    def __init__(self, adapter, spool, batch_size=500, flush_interval=1):
+        self.adapter = adapter
+        self.spool = spool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # position after the replayed records, and their times and
+        # positions until they're committed
+        self.cursor = None
+        self.replayed = collections.deque()
+        self.adapter.retry_failed_writes()
+        self.running = True
+        self.thread = threading.Thread(target=self._drain_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def store_instance_status(self, address, total_time, exit_code, value,
+                              timestamp=None, rtt=None, interval=None):
+        self.spool.append([INSTANCE, address, total_time, exit_code, value,
+                           to_epoch(timestamp or datetime.utcnow()), rtt,
+                           interval])
+
+    def store_service_status(self, endpoint, address, status_code, timeout,
+                             value, timestamp=None, interval=None):
+        self.spool.append([SERVICE, endpoint, address, status_code, timeout,
+                           value, to_epoch(timestamp or datetime.utcnow()),
+                           interval])
+
+    @staticmethod
+    def record_time(record):
+        return record[5] if record[0] == INSTANCE else record[6]
+
+    def replay(self, record):
+        # records spooled by older versions end at the time
+        if record[0] == INSTANCE:
+            rtt, interval = (record[6:8] + [None, None])[:2]
+            self.adapter.store_instance_status(
+                *record[1:5], timestamp=datetime.utcfromtimestamp(record[5]),
+                rtt=rtt, interval=interval)
+        else:
+            interval = record[7] if len(record) > 7 else None
+            self.adapter.store_service_status(
+                *record[1:6], timestamp=datetime.utcfromtimestamp(record[6]),
+                interval=interval)
+
+    def _drain_loop(self):
+        while self.running:
+            try:
+                drained = self.drain()
+            except Exception as e:
+                logger.exception('Failed to drain the spool: %s', e)
+                drained = 0
+            if not drained:
+                time.sleep(self.flush_interval)
+
+    @timed('spool.drain')
+    def drain(self):
+        entries, self.cursor = self.spool.entries(self.batch_size,
+                                                  self.cursor)
+        if not entries and not self.replayed:
+            return 0
+        for record, position in entries:
+            self.replay(record)
+            self.replayed.append((self.record_time(record), position))
+        # asked first, so what's no longer held is counted as pending
+        held = self.adapter.held_since()
+        while self.adapter.pending() and self.running:
+            time.sleep(0.01)
+        if self.running:
+            self.commit(held)
+        return len(entries)
+
+    def commit(self, held=None):
+        '''Commits the replayed records taken before `held`.'''
+        held = held and to_epoch(held)
+        position, count = None, 0
+        while self.replayed and (held is None or
+                                 self.replayed[0][0] < held):
+            position = self.replayed.popleft()[1]
+            count += 1
+        if count:
+            self.spool.commit(position, count)
+
+    def stats(self):
+        return self.spool.stats()
+
+    def close(self):
+        '''
+        Commits the replayed samples once the adapters have written what
+        they held; unsent samples stay in the spool for the next start.
+        '''
+        self.running = False
+        self.thread.join()
+        self.adapter.close()
+        if not self.adapter.pending():
+            self.commit()
+        self.spool.close()
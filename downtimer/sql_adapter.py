@@ -0,0 +1,474 @@
+import contextlib
+import logging
+import Queue
+import threading
+import time
+
+from datetime import datetime, timedelta
+from sqlalchemy import (and_, case, create_engine, event, Float, func,
+                        literal, or_)
+from sqlalchemy.orm import sessionmaker
+
+from db.models import (Base, create_schema, Instance, Outage, Rollup,
+                       Service, Sketch)
+from db_adapters import (DBAdapter, INSTANCE, MAX_BACKOFF, RollupCounters,
+                         SAMPLE_CHUNK_SIZE, SERVICE, sample_times, to_epoch)
+from instrumentation import timed, timer
+
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    # with WAL it's enough to sync at checkpoints only
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',
+)
+
+
+class SQLWriter(object):
+    '''
+    Single thread owning all inserts. Probes only put their rows into
+    the queue; the writer drains up to `batch_size` of them and inserts
+    them with one executemany per table in a single transaction. Rows
+    that don't fit into a full queue are dropped, and so are the rows of a
+    failed transaction unless `retry` is set, in which case they are
+    written again after a pause before any newer ones.
+    '''
+    def __init__(self, engine, batch_size=500, flush_interval=1,
+                 max_size=100000, retry=False):
+        self.logger = logging.getLogger('SQLWriter')
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(max_size)
+        self.retry = retry
+        self.failed = []
+        self.running = False
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        while self.write_batch() and not self.failed:
+            pass
+        self.logger.info('Wrote %(written)d rows, dropped %(dropped)d',
+                         self.stats())
+
+    def stats(self):
+        return {'written': self.written, 'dropped': self.dropped,
+                # rows are done once written or dropped
+                'pending': self.queue.unfinished_tasks}
+
+    def add(self, table, row):
+        try:
+            self.queue.put_nowait((table, row))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        backoff = self.flush_interval
+        while self.running:
+            self.write_batch(self.flush_interval)
+            if self.failed:
+                # don't hammer a database which is failing
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+            else:
+                backoff = self.flush_interval
+
+    def write_batch(self, wait=None):
+        rows, self.failed = self.failed, []
+        try:
+            if wait and not rows:
+                rows.append(self.queue.get(timeout=wait))
+            while len(rows) < self.batch_size:
+                rows.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        if not rows:
+            return 0
+
+        tables = {}
+        for table, row in rows:
+            tables.setdefault(table, []).append(row)
+        try:
+            with timer('db.sql.commit'), self.engine.begin() as conn:
+                for table, table_rows in tables.items():
+                    conn.execute(table.insert(), table_rows)
+            self.written += len(rows)
+        except Exception as e:
+            self.logger.error('Failed to write %d rows: %s', len(rows), e)
+            if self.retry:
+                self.failed = rows
+                return len(rows)
+            self.dropped += len(rows)
+        for _ in rows:
+            self.queue.task_done()
+        return len(rows)
+
+
+class SQLDBAdapter(DBAdapter):
+    def __init__(self, config):
+        self.logger = logging.getLogger('SQLDBAdapter')
+        self.engine = create_engine(config.db_host)
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', self._set_sqlite_pragmas)
+        create_schema(self.engine)
+        Base.metadata.bind = self.engine
+        # sessions of the adapter's own engine, not the last one bound
+        self.DBSession = sessionmaker(bind=self.engine)
+        self.writer = SQLWriter(self.engine,
+                                batch_size=config.batch_size,
+                                flush_interval=config.flush_interval,
+                                max_size=config.buffer_size)
+        self.writer.start()
+        # cloud and region of the targets by kind and target
+        self.target_tags = {}
+        self.intervals = {INSTANCE: config.ping_interval,
+                          SERVICE: config.http_interval}
+        # rows of several samples span at most a heartbeat
+        self.heartbeat = config.heartbeat
+        self.start_rollups(config.rollup_interval)
+
+    @staticmethod
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @contextlib.contextmanager
+    def session(self):
+        '''
+        A session closed once done with, so that its connection goes back
+        to the pool from the thread which used it.
+        '''
+        session = self.DBSession()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    @timed('db.sql.store_instance_status')
+    def store_instance_status(self, address, total_time, exit_code,
+                              packet_loss, timestamp=None, samples=1,
+                              rtt=None, interval=None):
+        now = timestamp or datetime.utcnow()
+        failed = int(exit_code) != 0
+        lost = float(packet_loss) / 100.0
+        seconds, down_seconds = self.weigh(INSTANCE, failed, lost, samples,
+                                           interval)
+        self.rollups.add(INSTANCE, address, failed, lost, now, samples,
+                         seconds, down_seconds)
+        tags = self.get_tags(INSTANCE, address)
+        self.writer.add(Instance.__table__,
+                        {'address': address,
+                         'total_time': total_time,
+                         'exit_code': exit_code,
+                         'packet_loss': packet_loss,
+                         'timestamp': now,
+                         'cloud': tags.get('cloud'),
+                         'region': tags.get('region'),
+                         'samples': samples,
+                         'seconds': seconds,
+                         'down_seconds': down_seconds})
+
+    @timed('db.sql.store_service_status')
+    def store_service_status(self, endpoint, address, status_code, timeout,
+                             elapsed_time, timestamp=None, samples=1,
+                             interval=None):
+        now = timestamp or datetime.utcnow()
+        failed = status_code not in (200, 300)
+        seconds, down_seconds = self.weigh(SERVICE, failed, 0.0, samples,
+                                           interval)
+        self.rollups.add(SERVICE, endpoint, failed, 0.0, now, samples,
+                         seconds, down_seconds)
+        tags = self.get_tags(SERVICE, endpoint)
+        self.writer.add(Service.__table__,
+                        {'endpoint': endpoint,
+                         'address': address,
+                         'status_code': status_code,
+                         'timeout': timeout,
+                         'elapsed_time': elapsed_time,
+                         'timestamp': now,
+                         'cloud': tags.get('cloud'),
+                         'region': tags.get('region'),
+                         'samples': samples,
+                         'seconds': seconds,
+                         'down_seconds': down_seconds})
+
+    def close(self):
+        self.writer.stop()
+        self.flush_rollups()
+
+    def retry_failed_writes(self):
+        self.writer.retry = True
+
+    def pending(self):
+        return self.writer.stats()['pending']
+
+    @timed('db.sql.store_outage')
+    def store_outage(self, outage):
+        self.writer.add(Outage.__table__, dict(outage))
+
+    @timed('db.sql.get_target_tags')
+    def get_target_tags(self, kind):
+        model, target = ((Instance, Instance.address) if kind == INSTANCE
+                         else (Service, Service.endpoint))
+        with self.session() as session:
+            query = session.query(target, model.cloud, model.region).filter(
+                model.cloud.isnot(None)).distinct()
+            return dict((target, {'cloud': cloud, 'region': region or ''})
+                        for target, cloud, region in query)
+
+    @timed('db.sql.store_sketches')
+    def store_sketches(self, rows):
+        for row in rows:
+            self.writer.add(Sketch.__table__, dict(row))
+
+    @timed('db.sql.get_sketches')
+    def get_sketches(self, since=None, until=None):
+        with self.session() as session:
+            query = session.query(Sketch)
+            if since is not None:
+                query = query.filter(Sketch.start >= since)
+            if until is not None:
+                query = query.filter(Sketch.start < until)
+            return [{'kind': sketch.kind, 'target': sketch.target,
+                     'start': sketch.start, 'sketch': sketch.sketch}
+                    for sketch in query]
+
+    @timed('db.sql.get_outages')
+    def get_outages(self, since=None, until=None):
+        """Outages overlapping [since, until)."""
+        with self.session() as session:
+            query = session.query(Outage)
+            if since is not None:
+                query = query.filter(Outage.end >= since)
+            if until is not None:
+                query = query.filter(Outage.start < until)
+            return [{'kind': outage.kind, 'target': outage.target,
+                     'start': outage.start, 'end': outage.end,
+                     'duration': outage.duration,
+                     'worst_status': outage.worst_status}
+                    for outage in query.order_by(Outage.start)]
+
+    def iter_samples(self, kind, since=None, until=None):
+        with self.session() as session:
+            model, target, failed = self._sample_columns(kind)
+            query = session.query(target, model.timestamp, failed,
+                                  model.samples, self._seconds(model, kind),
+                                  self._down_seconds(model, kind))
+            if since is not None:
+                # rows of several samples started before may reach into it
+                query = query.filter(or_(
+                    model.timestamp >= since,
+                    and_(model.samples > 1, model.timestamp >= since -
+                         timedelta(seconds=self.heartbeat))))
+            query = self._in_range(query, model, None, until).order_by(
+                model.timestamp).yield_per(SAMPLE_CHUNK_SIZE)
+            since = since and to_epoch(since)
+            until = until and to_epoch(until)
+            chunk = []
+            for target, timestamp, failed, samples, seconds, down_seconds \
+                    in query:
+                samples = samples or 1
+                step = seconds / samples
+                down = down_seconds / samples
+                # a row of several samples yields them spread over its
+                # seconds
+                chunk.extend((target, second, failed, step, down)
+                             for second in sample_times(
+                                 to_epoch(timestamp), samples, step, since,
+                                 until))
+                if len(chunk) >= SAMPLE_CHUNK_SIZE:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    @timed('db.sql.save_rollups')
+    def save_rollups(self, rows):
+        table = Rollup.__table__
+        with self.engine.begin() as conn:
+            for row in rows:
+                values = dict((key, row[key]) for key in
+                              ('total', 'failed', 'lost', 'seconds',
+                               'down_seconds', 'state', 'last_change'))
+                result = conn.execute(
+                    table.update().where(
+                        (table.c.kind == row['kind']) &
+                        (table.c.target == row['target'])
+                    ).values(**values))
+                if not result.rowcount:
+                    conn.execute(table.insert().values(**row))
+
+    @timed('db.sql.load_rollups')
+    def load_rollups(self):
+        with self.session() as session:
+            rows = [dict((field, getattr(rollup, field))
+                         for field in RollupCounters.FIELDS)
+                    for rollup in session.query(Rollup)]
+        if not rows:
+            rows = self._backfill_rollups()
+            if rows:
+                self.save_rollups(rows)
+        return rows
+
+    def _backfill_rollups(self):
+        """Builds the rollups of a database written before they existed."""
+        instances, services = self._aggregate_statuses()
+        rows = []
+        for instance in instances:
+            rows.append({'kind': INSTANCE, 'target': instance['address'],
+                         'total': instance['attempts'],
+                         'failed': instance['failed'],
+                         'lost': instance['lost_pkts'],
+                         'seconds': instance['duration'],
+                         'down_seconds': instance['downtime'],
+                         'state': None, 'last_change': None})
+        for service in services:
+            rows.append({'kind': SERVICE, 'target': service['service'],
+                         'total': service['total_uptime'],
+                         'failed': service['srv_downtime'],
+                         'lost': 0.0,
+                         'seconds': service['duration'],
+                         'down_seconds': service['downtime'],
+                         'state': None, 'last_change': None})
+        return rows
+
+    def _aggregate_statuses(self, since=None, until=None):
+        '''
+        Aggregates the raw samples per target, optionally within
+        [since, until), which the timestamp indexes turn into range scans.
+        Returns the instance and the service statuses; instances also
+        carry the number of failed pings. Rows count as the number of
+        samples they stand for, those cut by the window in part.
+        '''
+        with self.session() as session:
+            samples = func.coalesce(Instance.samples, 1)
+            failed_ping = case([(Instance.exit_code == 0, 0)], else_=samples)
+            query = session.query(
+                Instance.address,
+                func.sum(samples),
+                func.sum(failed_ping),
+                func.sum(Instance.packet_loss / 100.0),
+                func.sum(self._seconds(Instance, INSTANCE)),
+                func.sum(self._down_seconds(Instance, INSTANCE))
+            )
+            instances = [{'address': address, 'lost_pkts': lost,
+                          'attempts': attempts, 'failed': failed,
+                          'duration': duration, 'downtime': downtime}
+                         for address, attempts, failed, lost, duration,
+                         downtime in self._in_range(query, Instance, since,
+                                                    until)
+                         .group_by(Instance.address)]
+
+            samples = func.coalesce(Service.samples, 1)
+            bad_response = case([(Service.status_code.in_((200, 300)), 0)],
+                                else_=samples)
+            query = session.query(
+                Service.endpoint,
+                func.sum(samples),
+                func.sum(bad_response),
+                func.sum(self._seconds(Service, SERVICE)),
+                func.sum(self._down_seconds(Service, SERVICE))
+            )
+            services = [{'service': endpoint, 'srv_downtime': srv_downtime,
+                         'total_uptime': total_uptime, 'duration': duration,
+                         'downtime': downtime}
+                        for endpoint, total_uptime, srv_downtime, duration,
+                        downtime in self._in_range(query, Service, since,
+                                                   until)
+                        .group_by(Service.endpoint)]
+
+            if since is not None or until is not None:
+                bounds = since and to_epoch(since), until and to_epoch(until)
+                for kind, statuses in ((INSTANCE, instances),
+                                       (SERVICE, services)):
+                    rows = self._cut_rows(session, kind, since, until)
+                    self.split_rows(kind, statuses, rows, *bounds)
+            return instances, services
+
+    def _cut_rows(self, session, kind, since, until):
+        '''
+        Rows of several samples which start less than a heartbeat before
+        a bound of the window, as split_rows() takes them.
+        '''
+        model, target, failed = self._sample_columns(kind)
+        lost = (model.packet_loss / 100.0 if kind == INSTANCE
+                else literal(0.0, Float))
+        ranges = [and_(model.timestamp >= bound -
+                       timedelta(seconds=self.heartbeat),
+                       model.timestamp < bound)
+                  for bound in (since, until) if bound is not None]
+        query = session.query(
+            target, model.timestamp, model.samples, failed, lost,
+            self._seconds(model, kind), self._down_seconds(model, kind)
+        ).filter(model.samples > 1).filter(or_(*ranges))
+        return [(row[0], to_epoch(row[1])) + tuple(row[2:])
+                for row in query]
+
+    @staticmethod
+    def _sample_columns(kind):
+        '''The model, target and failed flag columns of a kind.'''
+        if kind == INSTANCE:
+            return (Instance, Instance.address,
+                    case([(Instance.exit_code == 0, 0)], else_=1))
+        return (Service, Service.endpoint,
+                case([(Service.status_code.in_((200, 300)), 0)], else_=1))
+
+    def _seconds(self, model, kind):
+        # rows written before the seconds were kept were probed at the
+        # base interval
+        return func.coalesce(
+            model.seconds,
+            func.coalesce(model.samples, 1) * self.intervals[kind])
+
+    def _down_seconds(self, model, kind):
+        interval = self.intervals[kind]
+        if kind == INSTANCE:
+            down = model.packet_loss / 100.0 * interval
+        else:
+            down = case([(model.status_code.in_((200, 300)), 0.0)],
+                        else_=func.coalesce(model.samples, 1) * interval)
+        return func.coalesce(model.down_seconds, down)
+
+    @staticmethod
+    def _in_range(query, model, since, until):
+        if since is not None:
+            query = query.filter(model.timestamp >= since)
+        if until is not None:
+            query = query.filter(model.timestamp < until)
+        return query
+
+    @timed('db.sql.get_instance_statuses')
+    def get_instance_statuses(self, since=None, until=None):
+        if since is not None or until is not None:
+            instances, _ = self._aggregate_statuses(since, until)
+            for instance in instances:
+                del instance['failed']
+            return instances
+        with self.session() as session:
+            rows = session.query(Rollup).filter(Rollup.kind == INSTANCE)
+            return [{'address': rollup.target, 'lost_pkts': rollup.lost,
+                     'attempts': rollup.total, 'duration': rollup.seconds,
+                     'downtime': rollup.down_seconds}
+                    for rollup in rows]
+
+    @timed('db.sql.get_service_statuses')
+    def get_service_statuses(self, since=None, until=None):
+        if since is not None or until is not None:
+            return self._aggregate_statuses(since, until)[1]
+        with self.session() as session:
+            rows = session.query(Rollup).filter(Rollup.kind == SERVICE)
+            return [{'service': rollup.target, 'srv_downtime': rollup.failed,
+                     'total_uptime': rollup.total, 'duration': rollup.seconds,
+                     'downtime': rollup.down_seconds}
+                    for rollup in rows]
@@ -0,0 +1,66 @@
+import mock
+import unittest
+
+import adaptive
+
+
+class AdaptiveRateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        self.scheduler = mock.Mock()
+        self.scheduler.interval.return_value = 2
+        self.rate = adaptive.AdaptiveRate(self.adapter, self.scheduler,
+                                          {'ping': 2, 'http': 2},
+                                          fast_interval=0.2, budget=10,
+                                          recovery=2)
+
+    def ping(self, exit_code):
+        self.rate.store_instance_status('ip1', '20', exit_code, '0')
+
+    def test_failing_target_is_probed_fast_until_recovery(self):
+        self.ping('1')
+        self.scheduler.set_interval.assert_called_once_with(('ping', 'ip1'),
+                                                            0.2)
+        self.ping('1')
+        self.ping('0')
+        self.assertEqual(1, self.scheduler.set_interval.call_count)
+        self.ping('0')
+        self.scheduler.set_interval.assert_called_with(('ping', 'ip1'), 2)
+        self.adapter.store_instance_status.assert_called_with(
+            'ip1', '20', '0', '0', None, rtt=None, interval=2)
+
+    def test_healthy_targets_back_off_within_budget(self):
+        for i in range(40):
+            self.rate.store_service_status('srv%d' % i, 'http://srv', 200,
+                                           0, 10)
+        self.scheduler.set_interval.reset_mock()
+        self.rate.rebalance()
+        #  40 targets every 2 s would be 20 probes/s
+        self.assertEqual(2.0, self.rate.factor)
+        self.scheduler.set_interval.assert_any_call(('http', 'srv0'), 4.0)
+
+    def fail(self, count):
+        for i in range(count):
+            self.rate.store_instance_status('ip%d' % i, '1000', '1', '100')
+        self.scheduler.set_interval.reset_mock()
+        self.rate.rebalance()
+
+    def test_fast_probes_use_half_the_budget(self):
+        self.fail(4)
+        self.assertEqual(0.8, self.rate.current_fast_interval)
+        self.scheduler.set_interval.assert_any_call(('ping', 'ip0'), 0.8)
+
+    def test_fast_interval_is_capped_at_the_base_interval(self):
+        #  half the budget would probe 20 targets every 4 s
+        self.fail(20)
+        self.assertEqual(2, self.rate.failing_interval('ping'))
+        self.scheduler.set_interval.assert_any_call(('ping', 'ip0'), 2)
+        self.rate.store_instance_status('ip99', '1000', '1', '100')
+        self.scheduler.set_interval.assert_called_with(('ping', 'ip99'), 2)
+
+    def test_removed_targets_are_forgotten(self):
+        self.ping('0')
+        self.scheduler.interval.return_value = None
+        self.rate.rebalance()
+        self.assertEqual(set(), self.rate.healthy)
@@ -0,0 +1,187 @@
+import mock
+import random
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta
+
+import changes
+import db_adapters
+import influx_adapter
+import sql_adapter
+
+START = datetime(2017, 1, 1)
+
+
+def at(seconds):
+    return START + timedelta(seconds=seconds)
+
+
+class ChangeOnlyWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        self.writer = changes.ChangeOnlyWriter(self.adapter, heartbeat=60,
+                                               loss_threshold=20)
+
+    def test_same_state_is_written_once_per_heartbeat(self):
+        for second in range(0, 120, 2):
+            self.writer.store_service_status('nova', 'http://nova', 200, 0,
+                                             1000 + second, at(second))
+        self.assertEqual([mock.call('nova', 'http://nova', 200, 0, 1000,
+                                    at(0), 30, interval=None)],
+                         self.adapter.store_service_status.call_args_list)
+
+        self.writer.flush(at(120))
+        self.assertEqual(mock.call('nova', 'http://nova', 200, 0, 1060,
+                                   at(60), 30, interval=None),
+                         self.adapter.store_service_status.call_args)
+
+    def test_state_change_is_written_at_once(self):
+        self.writer.store_service_status('nova', 'http://nova', 200, 0, 1,
+                                         at(0))
+        self.writer.store_service_status('nova', 'http://nova', 200, 0, 1,
+                                         at(2))
+        self.writer.store_service_status('nova', 'http://nova', 503, 0, 1,
+                                         at(4))
+        self.writer.flush(at(59))
+
+        self.assertEqual([mock.call('nova', 'http://nova', 200, 0, 1,
+                                    at(0), 2, interval=None)],
+                         self.adapter.store_service_status.call_args_list)
+
+        self.writer.close()
+        self.assertEqual(mock.call('nova', 'http://nova', 503, 0, 1,
+                                   at(4), 1, interval=None),
+                         self.adapter.store_service_status.call_args)
+        self.adapter.close.assert_called_once_with()
+
+    def test_ping_loss_is_summed_within_a_state(self):
+        for second, loss in ((0, 0), (2, 10), (4, 50), (6, 60)):
+            self.writer.store_instance_status('ip1', 20, 0, loss, at(second))
+        self.writer.flush()
+
+        self.assertEqual([mock.call('ip1', 20, 0, 10.0, at(0), 2,
+                                    interval=None),
+                          mock.call('ip1', 20, 0, 110.0, at(4), 2,
+                                    interval=None)],
+                         self.adapter.store_instance_status.call_args_list)
+
+    def test_reads_are_forwarded(self):
+        self.writer.get_service_statuses(at(0), at(60))
+        self.adapter.get_service_statuses.assert_called_once_with(at(0),
+                                                                  at(60))
+        self.writer.pending()
+        self.adapter.pending.assert_called_once_with()
+
+
+class ChangeOnlyEquivalenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def sql_adapter(self, name):
+        return sql_adapter.SQLDBAdapter(mock.Mock(
+            db_host='sqlite:///%s/%s.db' % (self.tmp_dir, name),
+            batch_size=500, flush_interval=0.1, buffer_size=10000,
+            rollup_interval=60, ping_interval=2, http_interval=2,
+            heartbeat=60))
+
+    def assertStatusesEqual(self, expected, actual):
+        def key(status):
+            return status.get('address') or status['service']
+        expected, actual = sorted(expected, key=key), sorted(actual, key=key)
+        self.assertEqual([sorted(status) for status in expected],
+                         [sorted(status) for status in actual])
+        for want, got in zip(expected, actual):
+            for field, value in want.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(value, got[field])
+                else:
+                    self.assertEqual(value, got[field])
+
+    def test_aligned_windows_match_full_writes(self):
+        full = self.sql_adapter('full')
+        writer = changes.ChangeOnlyWriter(self.sql_adapter('changes'),
+                                          heartbeat=60)
+        rng = random.Random(1)
+        for second in range(0, 3600, 2):
+            status = 503 if 1000 <= second < 1100 else 200
+            loss = rng.choice((0, 0, 0, 10, 100))
+            for adapter in (full, writer):
+                adapter.store_service_status('nova', 'http://nova', status,
+                                             0, 1, at(second))
+                adapter.store_instance_status('ip1', 20, int(loss == 100),
+                                              loss, at(second))
+        full.close()
+        writer.close()
+
+        self.assertLess(writer.rows, writer.samples / 4)
+        for since, until in ((0, 3600), (960, 1140), (600, 1200)):
+            for method in ('get_instance_statuses', 'get_service_statuses'):
+                self.assertStatusesEqual(
+                    getattr(full, method)(at(since), at(until)),
+                    getattr(writer, method)(at(since), at(until)))
+        self.assertEqual(full.get_service_statuses(),
+                         writer.get_service_statuses())
+        self.assertEqual(
+            [row[2] for chunk in full.iter_samples(db_adapters.SERVICE)
+             for row in chunk],
+            [row[2] for chunk in writer.iter_samples(db_adapters.SERVICE)
+             for row in chunk])
+
+    def test_unaligned_windows_match_full_writes(self):
+        full = self.sql_adapter('full')
+        writer = changes.ChangeOnlyWriter(self.sql_adapter('changes'),
+                                          heartbeat=60)
+        for second in range(0, 600, 2):
+            status = 503 if 100 <= second < 250 else 200
+            lost = 100 if 130 <= second < 400 else 0
+            for adapter in (full, writer):
+                adapter.store_service_status('nova', 'http://nova', status,
+                                             0, 1, at(second))
+                adapter.store_instance_status('ip1', 20, int(lost == 100),
+                                              lost, at(second))
+        full.close()
+        writer.close()
+
+        for since, until in ((31, 89), (31, 600), (0, 131), (107, 113),
+                             (245, 401)):
+            for method in ('get_instance_statuses', 'get_service_statuses'):
+                self.assertStatusesEqual(
+                    getattr(full, method)(at(since), at(until)),
+                    getattr(writer, method)(at(since), at(until)))
+            self.assertEqual(
+                [row[1:3] for chunk in full.iter_samples(
+                    db_adapters.SERVICE, at(since), at(until))
+                 for row in chunk],
+                [row[1:3] for chunk in writer.iter_samples(
+                    db_adapters.SERVICE, at(since), at(until))
+                 for row in chunk])
+
+    @mock.patch('influx_adapter.influxdb.InfluxDBClient')
+    def test_influx_rows_of_one_second_keep_apart(self, fake_client):
+        fake_client.return_value.query.return_value = []
+        adapter = influx_adapter.InfluxDBAdapter(mock.Mock(
+            batch_size=100, flush_interval=60, buffer_size=1000,
+            use_gzip=True, rollup_interval=60, series_page_size=10,
+            ping_interval=2, http_interval=2, heartbeat=60))
+        writer = changes.ChangeOnlyWriter(adapter, heartbeat=60)
+        for offset, status in ((0, 200), (200000, 200), (400000, 503),
+                               (600000, 200)):
+            writer.store_service_status(
+                'nova', 'http://nova', status, 0, 1,
+                at(1) + timedelta(microseconds=offset), interval=0.2)
+        writer.flush()
+        points = adapter.buffer.points
+        adapter.buffer.stop()
+
+        self.assertEqual([('2017-01-01T00:00:01.000000Z', 2, 0.4),
+                          ('2017-01-01T00:00:01.400000Z', 1, 0.2),
+                          ('2017-01-01T00:00:01.600000Z', 1, 0.2)],
+                         [(point['time'], point['fields']['samples'],
+                           point['fields']['seconds']) for point in points])
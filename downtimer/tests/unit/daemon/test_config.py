@@ -0,0 +1,79 @@
+import ConfigParser
+import mock
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import config
+
+PACKAGE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                           '..', '..', '..'))
+SAMPLE = os.path.join(PACKAGE_DIR, '..', 'conf.ini.sample')
+
+
+class ConfigTest(unittest.TestCase):
+
+    @mock.patch.object(config, '_config', None)
+    def test_config_is_parsed_on_first_use(self):
+        with mock.patch.dict(os.environ, {'DOWNTIMER_CONFIG': SAMPLE}):
+            conf = config.get_config()
+        self.assertEqual('influx', conf.db_adapter)
+        self.assertIs(conf, config.get_config())
+
+    def test_observability_is_off_unless_configured(self):
+        conf = ConfigParser.SafeConfigParser()
+        conf.read(SAMPLE)
+        sample = config.Config(SAMPLE)
+        for section in ('live', 'metrics', 'profiler'):
+            conf.remove_section(section)
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'conf.ini')
+            with open(path, 'w') as f:
+                conf.write(f)
+            default = config.Config(path)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual((False, '', 0, ''),
+                         (default.live_status, default.status_socket,
+                          default.metrics_port, default.profile_dir))
+        self.assertEqual((True, '/var/run/downtimer.sock', 9318, '/tmp'),
+                         (sample.live_status, sample.status_socket,
+                          sample.metrics_port, sample.profile_dir))
+
+    def test_clouds_inherit_openstack_options(self):
+        conf = ConfigParser.SafeConfigParser()
+        conf.add_section('openstack')
+        conf.set('openstack', 'endpoint', 'http://keystone:5000')
+        conf.set('openstack', 'user', 'admin')
+        conf.add_section('openstack:east')
+        conf.set('openstack:east', 'region', 'RegionTwo')
+
+        default = config.CloudConfig(conf, 'openstack')
+        east = config.CloudConfig(conf, 'openstack:east')
+        self.assertEqual(('default', {'cloud': 'default', 'region': ''}),
+                         (default.name, default.tags))
+        self.assertEqual(('east', 'http://keystone:5000', 'admin'),
+                         (east.name, east.auth_url, east.user))
+        self.assertEqual({'cloud': 'east', 'region': 'RegionTwo'},
+                         east.tags)
+
+    def test_importing_main_has_no_side_effects(self):
+        directory = tempfile.mkdtemp()
+        try:
+            output = subprocess.check_output(
+                [sys.executable, '-c',
+                 'import sys, main; print sorted(set(sys.modules) & set(['
+                 '"keystoneclient", "neutronclient", "influxdb", '
+                 '"sqlalchemy", "requests"]))'],
+                cwd=directory,
+                env=dict(os.environ, PYTHONPATH=PACKAGE_DIR,
+                         DOWNTIMER_CONFIG=os.path.join(directory, 'none')))
+            self.assertEqual('[]', output.strip())
+            self.assertEqual([], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
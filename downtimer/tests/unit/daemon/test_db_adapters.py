@@ -0,0 +1,680 @@
+import gzip
+import json
+import mock
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+from datetime import datetime
+from influxdb.resultset import ResultSet
+import db_adapters
+import influx_adapter
+import sql_adapter
+import timeline_adapter
+
+
+def fake_point(address):
+    return {'measurement': 'floating_ip_pings',
+            'tags': {'address': address},
+            'time': '2017-01-01T00:00:00Z',
+            'fields': {'value': '0'}}
+
+
+class InfluxWriteBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock(use_udp=False, _headers={}, _host='host',
+                                udp_port=4444)
+        self.buffer = influx_adapter.InfluxWriteBuffer(self.client, 'db',
+                                                       batch_size=2,
+                                                       max_size=3)
+
+    def test_flush_writes_gzipped_batches(self):
+        for address in ('ip1', 'ip2', 'ip3'):
+            self.buffer.add(fake_point(address))
+        self.buffer.flush()
+
+        self.assertEqual(2, self.client.request.call_count)
+        kwargs = self.client.request.call_args_list[0][1]
+        self.assertEqual('gzip', kwargs['headers']['Content-Encoding'])
+        lines = gzip.GzipFile(
+            fileobj=StringIO.StringIO(kwargs['data'])).read()
+        self.assertEqual(2, len(lines.splitlines()))
+        self.assertEqual({'buffered': 3, 'flushed': 3, 'dropped': 0,
+                          'pending': 0}, self.buffer.stats())
+
+    def test_points_above_max_size_are_dropped(self):
+        for address in ('ip1', 'ip2', 'ip3', 'ip4'):
+            self.buffer.add(fake_point(address))
+        self.assertEqual(1, self.buffer.stats()['dropped'])
+
+    def test_failed_write_counts_as_dropped(self):
+        self.client.request.side_effect = Exception('down')
+        self.buffer.add(fake_point('ip1'))
+        self.buffer.flush()
+        self.assertEqual(1, self.buffer.stats()['dropped'])
+
+    def test_failed_write_is_retried_in_order(self):
+        self.buffer.retry = True
+        self.client.request.side_effect = [Exception('down'), None, None]
+        for address in ('ip1', 'ip2', 'ip3'):
+            self.buffer.add(fake_point(address))
+        self.assertFalse(self.buffer.flush())
+        self.assertEqual(3, self.buffer.stats()['pending'])
+        self.assertTrue(self.buffer.flush())
+        self.assertEqual({'buffered': 3, 'flushed': 3, 'dropped': 0,
+                          'pending': 0}, self.buffer.stats())
+
+    def test_udp_points_are_packed_into_datagrams(self):
+        self.client.use_udp = True
+        self.buffer.max_size = 50
+        for i in range(50):
+            self.buffer.add(fake_point('10.0.0.%d' % i))
+        self.buffer.batch_size = 50
+        self.buffer.flush()
+        datagrams = [call[0][0] for call in
+                     self.client.udp_socket.sendto.call_args_list]
+        self.assertTrue(len(datagrams) > 1)
+        for datagram in datagrams:
+            self.assertTrue(len(datagram) <= influx_adapter.UDP_PAYLOAD_LIMIT)
+        self.assertEqual(50, sum(len(d.splitlines()) for d in datagrams))
+
+    def test_stop_flushes_pending_points(self):
+        self.buffer.flush_interval = 60
+        self.buffer.start()
+        self.buffer.add(fake_point('ip1'))
+        self.buffer.stop()
+        self.assertEqual(1, self.buffer.stats()['flushed'])
+
+
+class RollupCountersTest(unittest.TestCase):
+
+    def test_add_tracks_totals_and_state_changes(self):
+        rollups = db_adapters.RollupCounters()
+        for failed, timestamp in ((False, 1), (True, 2), (True, 3)):
+            rollups.add('instance', 'ip1', failed, 0.5, timestamp, 1, 2.0,
+                        1.0)
+
+        self.assertEqual([{'kind': 'instance', 'target': 'ip1', 'total': 3,
+                           'failed': 2, 'lost': 1.5, 'seconds': 6.0,
+                           'down_seconds': 3.0, 'state': 1,
+                           'last_change': 2}], rollups.pop_dirty())
+        self.assertEqual([], rollups.pop_dirty())
+        self.assertEqual([], rollups.get('service'))
+
+    def test_load_continues_counting(self):
+        rollups = db_adapters.RollupCounters()
+        rollups.load([{'kind': 'service', 'target': 'nova', 'total': 10,
+                       'failed': 1, 'lost': 0.0, 'state': 0,
+                       'last_change': 1}])
+        rollups.add('service', 'nova', False, timestamp=2)
+        rollup = rollups.get('service')[0]
+        self.assertEqual((11, 1, 1), (rollup['total'], rollup['failed'],
+                                      rollup['last_change']))
+
+
+class AdapterWrapperTest(unittest.TestCase):
+
+    def test_methods_not_overridden_reach_the_wrapped_adapter(self):
+        class Wrapper(db_adapters.AdapterWrapper):
+            def __init__(self, adapter):
+                self.adapter = adapter
+
+            def pending(self):
+                return 0
+
+        adapter = mock.Mock()
+        wrapper = Wrapper(Wrapper(adapter))
+        wrapper.get_outages(1, 2)
+        wrapper.close()
+
+        adapter.get_outages.assert_called_once_with(1, 2)
+        adapter.close.assert_called_once_with()
+        self.assertEqual(0, wrapper.pending())
+        self.assertFalse(adapter.pending.called)
+
+
+class SQLDBAdapterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = mock.Mock(
+            db_host='sqlite:///%s/downtimer.db' % self.tmp_dir,
+            batch_size=100, flush_interval=0.1, buffer_size=1000,
+            rollup_interval=60, ping_interval=2, http_interval=2,
+            heartbeat=60)
+        self.adapter = sql_adapter.SQLDBAdapter(self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_samples_are_written_in_bulk(self):
+        #  stop the writer thread to drain the queue explicitly
+        self.adapter.writer.running = False
+        self.adapter.writer.thread.join()
+        for i in range(3):
+            self.adapter.store_instance_status('ip1', 1000, 1, 100)
+        self.adapter.store_service_status('nova', 'http://nova', 500, 0, 1)
+        self.assertEqual(4, self.adapter.writer.write_batch())
+        self.adapter.flush_rollups()
+
+        self.assertEqual([{'address': 'ip1', 'lost_pkts': 3.0,
+                           'attempts': 3, 'duration': 6.0,
+                           'downtime': 6.0}],
+                         self.adapter.get_instance_statuses())
+        self.assertEqual([{'service': 'nova', 'srv_downtime': 1,
+                           'total_uptime': 1, 'duration': 2.0,
+                           'downtime': 2.0}],
+                         self.adapter.get_service_statuses())
+
+    def test_samples_weigh_by_their_interval(self):
+        since = datetime(2017, 1, 1)
+        self.adapter.store_service_status('nova', 'http://nova', 200, 0, 1,
+                                          since, interval=2)
+        for i in range(10):
+            self.adapter.store_service_status('nova', 'http://nova', 503, 0,
+                                              1, since, interval=0.2)
+        self.adapter.close()
+
+        for statuses in (self.adapter.get_service_statuses(),
+                         self.adapter.get_service_statuses(since)):
+            self.assertEqual((11, 10), (statuses[0]['total_uptime'],
+                                        statuses[0]['srv_downtime']))
+            self.assertAlmostEqual(4.0, statuses[0]['duration'])
+            self.assertAlmostEqual(2.0, statuses[0]['downtime'])
+        seconds = [row[3] for chunk in self.adapter.iter_samples(
+            db_adapters.SERVICE) for row in chunk]
+        self.assertEqual([2.0] + [0.2] * 10, sorted(seconds, reverse=True))
+
+    def test_partial_loss_is_down_in_part(self):
+        self.adapter.store_instance_status('ip1', 810, 0, 20,
+                                           datetime(2017, 1, 1))
+        self.adapter.close()
+        chunk, = self.adapter.iter_samples(db_adapters.INSTANCE)
+        self.assertEqual([(False, 2.0)], [(row[2], row[3]) for row in chunk])
+        self.assertAlmostEqual(0.4, chunk[0][4])
+
+    def test_close_drains_queue(self):
+        self.adapter.store_instance_status('ip1', 200, 0, 0)
+        self.adapter.close()
+        self.assertEqual({'written': 1, 'dropped': 0, 'pending': 0},
+                         self.adapter.writer.stats())
+
+    def test_iter_samples_in_time_order(self):
+        self.adapter.store_service_status('nova', 'http://nova', 503, 0, 1,
+                                          datetime(2017, 1, 1, 0, 0, 2))
+        self.adapter.store_service_status('nova', 'http://nova', 200, 0, 1,
+                                          datetime(2017, 1, 1, 0, 0, 1))
+        self.adapter.store_instance_status('ip1', 200, 0, 0)
+        self.adapter.close()
+
+        chunks = list(self.adapter.iter_samples(
+            db_adapters.SERVICE, since=datetime(2017, 1, 1)))
+        self.assertEqual([[('nova', 1483228801.0, 0, 2.0, 0.0),
+                           ('nova', 1483228802.0, 1, 2.0, 2.0)]], chunks)
+
+    def test_sketches_of_a_bucket_add_up(self):
+        for sketch in ('a', 'b'):
+            self.adapter.store_sketches([
+                {'kind': 'instance', 'target': 'ip1',
+                 'start': datetime(2017, 1, 1), 'sketch': sketch}])
+        self.adapter.close()
+
+        self.assertEqual(['a', 'b'], sorted(
+            row['sketch'] for row in self.adapter.get_sketches(
+                since=datetime(2017, 1, 1), until=datetime(2017, 1, 2))))
+        self.assertEqual([], self.adapter.get_sketches(
+            since=datetime(2017, 1, 2)))
+
+    def test_samples_are_tagged_with_cloud_and_region(self):
+        self.adapter.tag_target(db_adapters.INSTANCE, 'ip1',
+                                {'cloud': 'east', 'region': 'RegionTwo'})
+        self.adapter.store_instance_status('ip1', 200, 0, 0)
+        self.adapter.store_instance_status('ip2', 200, 0, 0)
+        self.adapter.close()
+
+        self.assertEqual({'ip1': {'cloud': 'east', 'region': 'RegionTwo'}},
+                         self.adapter.get_target_tags(db_adapters.INSTANCE))
+
+    def test_schema_gets_new_columns(self):
+        engine = self.adapter.engine
+        engine.execute('DROP TABLE services')
+        engine.execute('CREATE TABLE services (id VARCHAR(36) PRIMARY KEY, '
+                       'endpoint VARCHAR(255))')
+        sql_adapter.create_schema(engine)
+        columns = [row[1] for row in
+                   engine.execute('PRAGMA table_info(services)')]
+        self.assertIn('region', columns)
+
+    def test_sqlite_runs_in_wal_mode(self):
+        mode = self.adapter.engine.execute('PRAGMA journal_mode').scalar()
+        self.assertEqual('wal', mode)
+
+    def test_rollups_are_backfilled_from_samples(self):
+        self.adapter.close()
+        table = sql_adapter.Instance.__table__
+        for packet_loss in (0, 20, 100):
+            self.adapter.writer.add(table, {'address': 'ip1',
+                                            'exit_code': 0,
+                                            'packet_loss': packet_loss})
+        self.adapter.writer.add(table, {'address': 'ip2', 'exit_code': 0,
+                                        'packet_loss': 0})
+        table = sql_adapter.Service.__table__
+        for status_code in (200, 300, 503, None):
+            self.adapter.writer.add(table, {'endpoint': 'nova',
+                                            'status_code': status_code})
+        self.adapter.writer.write_batch()
+
+        self.adapter = sql_adapter.SQLDBAdapter(self.config)
+        self.adapter.flush_rollups()
+        instances = sorted(self.adapter.get_instance_statuses(),
+                           key=lambda x: x['address'])
+        self.assertEqual([{'address': 'ip1', 'lost_pkts': 1.2,
+                           'attempts': 3, 'duration': 6.0, 'downtime': 2.4},
+                          {'address': 'ip2', 'lost_pkts': 0,
+                           'attempts': 1, 'duration': 2.0, 'downtime': 0}],
+                         instances)
+        self.assertEqual([{'service': 'nova', 'srv_downtime': 2,
+                           'total_uptime': 4, 'duration': 8.0,
+                           'downtime': 4.0}],
+                         self.adapter.get_service_statuses())
+
+    def test_statuses_within_time_window(self):
+        self.adapter.close()
+        table = sql_adapter.Instance.__table__
+        for hour, packet_loss in ((1, 100), (2, 100), (3, 0), (4, 100)):
+            self.adapter.writer.add(table, {
+                'address': 'ip1', 'exit_code': 0,
+                'packet_loss': packet_loss,
+                'timestamp': datetime(2017, 1, 1, hour)})
+        table = sql_adapter.Service.__table__
+        for hour, status_code in ((1, 503), (2, 200), (3, 200), (4, 503)):
+            self.adapter.writer.add(table, {
+                'endpoint': 'nova', 'status_code': status_code,
+                'timestamp': datetime(2017, 1, 1, hour)})
+        self.adapter.writer.write_batch()
+
+        since = datetime(2017, 1, 1, 2)
+        until = datetime(2017, 1, 1, 4)
+        self.assertEqual([{'address': 'ip1', 'lost_pkts': 1.0,
+                           'attempts': 2, 'duration': 4.0, 'downtime': 2.0}],
+                         self.adapter.get_instance_statuses(since, until))
+        self.assertEqual([{'service': 'nova', 'srv_downtime': 1,
+                           'total_uptime': 3, 'duration': 6.0,
+                           'downtime': 2.0}],
+                         self.adapter.get_service_statuses(since=since))
+
+    def test_read_sessions_are_closed(self):
+        sessions = []
+        make_session = self.adapter.DBSession
+
+        def tracked_session():
+            session = make_session()
+            session.close = mock.Mock(wraps=session.close)
+            sessions.append(session)
+            return session
+
+        since = datetime(2017, 1, 1)
+        with mock.patch.object(self.adapter, 'DBSession', tracked_session):
+            self.adapter.get_target_tags(db_adapters.SERVICE)
+            self.adapter.get_sketches()
+            self.adapter.get_outages()
+            self.adapter.get_instance_statuses()
+            self.adapter.get_service_statuses()
+            self.adapter.get_service_statuses(since)
+            self.adapter.load_rollups()
+            list(self.adapter.iter_samples(db_adapters.SERVICE, since))
+        # an empty rollup table is backfilled from the samples
+        self.assertEqual(9, len(sessions))
+        self.assertTrue(all(session.close.called for session in sessions))
+
+    def test_outages_overlapping_window(self):
+        self.adapter.close()
+        for start, end in ((1, 2), (3, 5), (6, 7)):
+            self.adapter.store_outage({
+                'kind': 'service', 'target': 'nova',
+                'start': datetime(2017, 1, 1, start),
+                'end': datetime(2017, 1, 1, end),
+                'duration': (end - start) * 3600.0, 'worst_status': 503})
+        self.adapter.writer.write_batch()
+
+        outages = self.adapter.get_outages(datetime(2017, 1, 1, 4),
+                                           datetime(2017, 1, 1, 6))
+        self.assertEqual([datetime(2017, 1, 1, 3)],
+                         [outage['start'] for outage in outages])
+
+
+def fake_result(name, tag, series, error=None):
+    raw = {'series': [{'name': name, 'tags': {tag: value},
+                       'columns': ['time'] + sorted(fields),
+                       'values': [[0] + [fields[k] for k in sorted(fields)]]}
+                      for value, fields in series]}
+    if error:
+        raw = {'error': error}
+    return ResultSet(raw, raise_errors=False)
+
+
+def fake_points(name, points):
+    columns = sorted(points[0]) if points else ['time']
+    return ResultSet({'series': [{
+        'name': name, 'columns': columns,
+        'values': [[point[column] for column in columns]
+                   for point in points]}]})
+
+
+class InfluxDBAdapterTest(unittest.TestCase):
+
+    @mock.patch('influx_adapter.influxdb.InfluxDBClient')
+    def setUp(self, fake_client):
+        self.client = fake_client.return_value
+        self.client.query.return_value = []
+        config = mock.Mock(batch_size=100, flush_interval=60,
+                           buffer_size=1000, use_gzip=True,
+                           rollup_interval=60, series_page_size=2,
+                           ping_interval=2, http_interval=2, heartbeat=60)
+        self.adapter = influx_adapter.InfluxDBAdapter(config)
+        self.client.query.reset_mock()
+
+    def tearDown(self):
+        self.adapter.buffer.stop()
+
+    def test_aggregate_statuses_in_one_request(self):
+        self.client.query.side_effect = [[
+            # two of the points of ip1 stand for 7 samples
+            fake_result('floating_ip_pings', 'address',
+                        [('ip1', {'points': 4, 'counted': 2,
+                                  'samples': 7, 'seconds': 10.0,
+                                  'down_seconds': 3.0, 'weighed': 2})]),
+            fake_result('floating_ip_pings', 'address',
+                        [('ip1', {'lost': 150})]),
+            # two points lost 50% before the seconds were kept
+            fake_result('floating_ip_pings', 'address',
+                        [('ip1', {'lost': 100})]),
+            fake_result(None, None, [], error='unsupported sum type'),
+            # points written before the samples field existed
+            fake_result('service_response', 'service_name',
+                        [('nova', {'points': 10, 'counted': 0,
+                                   'samples': None, 'seconds': None,
+                                   'down_seconds': None, 'weighed': 0})]),
+            fake_result('service_response', 'service_name',
+                        [('nova', {'points': 3, 'counted': 3,
+                                   'samples': 5, 'seconds': 4.0,
+                                   'down_seconds': 4.0, 'weighed': 2})]),
+        ], [fake_points('floating_ip_pings', []),
+            fake_points('service_response', [])]]
+        instances, services = self.adapter._aggregate_statuses(
+            since=datetime(2017, 1, 1))
+
+        # and one for the points cut by the window
+        self.assertEqual(2, self.client.query.call_count)
+        query = self.client.query.call_args_list[0][0][0]
+        self.assertEqual(
+            6, query.count("time >= '2017-01-01T00:00:00.000000Z'"))
+        self.assertEqual([{'address': 'ip1', 'lost_pkts': 1.5,
+                           'attempts': 9, 'failed': 0, 'duration': 14.0,
+                           'downtime': 4.0}], instances)
+        self.assertEqual([{'service': 'nova', 'srv_downtime': 5,
+                           'total_uptime': 10, 'duration': 20.0,
+                           'downtime': 6.0}], services)
+
+    def test_samples_of_the_same_second_keep_their_own_time(self):
+        for microsecond in (100000, 600000):
+            self.adapter.store_service_status(
+                'nova', 'http://nova', 200, 0, 10,
+                datetime(2017, 1, 1, 0, 0, 1, microsecond))
+            self.adapter.store_instance_status(
+                'ip1', 20, 0, 0, datetime(2017, 1, 1, 0, 0, 1, microsecond))
+        points = self.adapter.buffer.points
+        self.assertEqual(['2017-01-01T00:00:01.100000Z'] * 2 +
+                         ['2017-01-01T00:00:01.600000Z'] * 2,
+                         [point['time'] for point in points])
+
+    def test_points_cut_by_the_window_count_in_part(self):
+        # 30 samples 2 seconds apart from second 0 and from second 60 on
+        first, second = [{'time': start * 1000000, 'service_name': 'nova',
+                          'status_code': 200, 'samples': 30,
+                          'seconds': 60.0, 'down_seconds': 0.0}
+                         for start in (1483228800, 1483228860)]
+        self.client.query.side_effect = [[
+            fake_result(None, None, []), fake_result(None, None, []),
+            fake_result(None, None, []), fake_result(None, None, []),
+            fake_result('service_response', 'service_name',
+                        [('nova', {'points': 1, 'counted': 1,
+                                   'samples': 30, 'seconds': 60.0,
+                                   'down_seconds': 0.0, 'weighed': 1})]),
+            fake_result(None, None, []),
+        ], [fake_points('floating_ip_pings', []),
+            fake_points('floating_ip_pings', []),
+            fake_points('service_response', [first]),
+            fake_points('service_response', [second])]]
+
+        services = self.adapter.get_service_statuses(
+            datetime(2017, 1, 1, 0, 0, 31), datetime(2017, 1, 1, 0, 1, 29))
+
+        # seconds 32 to 58 of the first point and 60 to 88 of the second
+        self.assertEqual([{'service': 'nova', 'srv_downtime': 0,
+                           'total_uptime': 29, 'duration': 58.0,
+                           'downtime': 0.0}], services)
+        query = self.client.query.call_args[0][0]
+        self.assertIn("samples > 1 and time >= '2017-01-01T00:00:29.000000Z'"
+                      " and time < '2017-01-01T00:01:29.000000Z'", query)
+
+    def test_query_grouped_pages_through_series(self):
+        self.client.query.side_effect = [
+            fake_result('rollups', 'target',
+                        [('ip1', {'total': 1}), ('ip2', {'total': 2})]),
+            fake_result('rollups', 'target', [('ip3', {'total': 3})]),
+        ]
+        rollups, = self.adapter._query_grouped(['select * from rollups'])
+
+        self.assertEqual({('ip1',): 1, ('ip2',): 2, ('ip3',): 3},
+                         dict((k, v['total']) for k, v in rollups.items()))
+        offsets = [call[0][0] for call in self.client.query.call_args_list]
+        self.assertEqual(['select * from rollups slimit 2 soffset 0;',
+                          'select * from rollups slimit 2 soffset 2;'],
+                         offsets)
+
+
+class TimelineDBAdapterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = mock.Mock(db_host=self.directory, flush_interval=3600,
+                                ping_interval=2, http_interval=2)
+        self.adapter = timeline_adapter.TimelineDBAdapter(self.config)
+
+    def tearDown(self):
+        self.adapter.close()
+        shutil.rmtree(self.directory)
+
+    def ping(self, second, exit_code=0, loss=0, adapter=None, rtt=3.0):
+        (adapter or self.adapter).store_instance_status(
+            'ip1', 10, exit_code, loss, datetime(2017, 1, 1, 0, 0, second),
+            rtt=None if exit_code else rtt)
+
+    def test_samples_with_the_same_state_share_a_run(self):
+        for second in range(0, 10, 2):
+            self.ping(second)
+        self.ping(10, exit_code=1, loss=100)
+        self.ping(12, exit_code=1, loss=100)
+        self.ping(14)
+
+        timeline = self.adapter.timelines[(db_adapters.INSTANCE, 'ip1')]
+        base = timeline.runs[0][0]
+        self.assertEqual([[0, 8, 0, 5, 0.0, 10, 0.0],
+                          [10, 12, 1, 2, 2.0, 4, 4.0],
+                          [14, 14, 0, 1, 0.0, 2, 0.0]],
+                         [[start - base, end - base] + run
+                          for start, end, run in
+                          [(r[0], r[1], r[2:]) for r in timeline.runs]])
+        self.assertEqual([{'address': 'ip1', 'lost_pkts': 2.0,
+                           'attempts': 8, 'duration': 16.0,
+                           'downtime': 4.0}],
+                         self.adapter.get_instance_statuses())
+
+    def test_window_counts_the_overlapping_part_of_runs(self):
+        for second in range(0, 22, 2):
+            self.ping(second, exit_code=1, loss=100)
+
+        statuses = self.adapter.get_instance_statuses(
+            since=datetime(2017, 1, 1, 0, 0, 5),
+            until=datetime(2017, 1, 1, 0, 0, 15))
+        self.assertEqual(5.5, statuses[0]['attempts'])
+        self.assertEqual(5.5, statuses[0]['lost_pkts'])
+        self.assertEqual((11.0, 11.0), (statuses[0]['duration'],
+                                        statuses[0]['downtime']))
+        self.assertEqual([], self.adapter.get_instance_statuses(
+            since=datetime(2017, 1, 1, 0, 1)))
+
+    def test_flush_writes_only_changed_timelines(self):
+        self.ping(0)
+        self.adapter.store_service_status('nova', 'http://nova/', 200, 0,
+                                          20000, datetime(2017, 1, 1))
+        self.adapter.flush()
+        self.ping(2)
+
+        with mock.patch.object(timeline_adapter.TargetTimeline,
+                               'write') as write:
+            self.adapter.flush()
+            self.adapter.flush()
+        self.assertFalse(write.called)
+        with open(self.adapter.journal) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(3, len(entries))
+        kind, target, runs, latency = entries[-1]
+        self.assertEqual(('ip1', 0, 1), (target, runs[0], len(runs[1])))
+
+    def test_samples_added_while_writing_are_saved_next(self):
+        timeline = self.adapter._timeline(db_adapters.INSTANCE, 'ip1')
+        append = self.adapter._append
+
+        def slow_append(entries):
+            self.ping(4, exit_code=1, loss=100)
+            return append(entries)
+
+        self.ping(0)
+        with mock.patch.object(self.adapter, '_append', slow_append):
+            self.adapter.flush()
+        self.adapter.close()
+
+        reloaded = timeline_adapter.TargetTimeline(timeline.path)
+        self.assertEqual([0, 1], [run[2] for run in reloaded.runs])
+
+    def test_journal_is_replayed_after_a_crash(self):
+        self.ping(0)
+        self.ping(2, exit_code=1, loss=100)
+        self.adapter.flush()
+        self.ping(4, exit_code=1, loss=100)
+        self.adapter.flush()
+        timeline = self.adapter.timelines[(db_adapters.INSTANCE, 'ip1')]
+        self.assertFalse(os.path.exists(
+            timeline.path + timeline_adapter.RUNS_SUFFIX))
+        with open(self.adapter.journal, 'a') as f:
+            f.write('["instance", "ip1", [0, [')
+
+        reader = timeline_adapter.TimelineDBAdapter(self.config)
+        reader.close()
+        self.assertEqual(2, len(reader.timelines[(db_adapters.INSTANCE,
+                                                  'ip1')].runs))
+        self.assertFalse(os.path.exists(
+            timeline.path + timeline_adapter.RUNS_SUFFIX))
+
+        adapter = timeline_adapter.TimelineDBAdapter(self.config)
+        self.ping(6, exit_code=1, loss=100, adapter=adapter)
+        adapter.close()
+        reloaded = timeline_adapter.TargetTimeline(timeline.path)
+        self.assertEqual([[0, 1], [1, 3]],
+                         [[run[2], run[3]] for run in reloaded.runs])
+        self.assertEqual(0, os.path.getsize(adapter.journal))
+
+    def test_journal_is_merged_once_it_outgrows_the_limit(self):
+        self.ping(0)
+        with mock.patch.object(timeline_adapter, 'JOURNAL_LIMIT', 0):
+            self.adapter.flush()
+        timeline = self.adapter.timelines[(db_adapters.INSTANCE, 'ip1')]
+        self.assertEqual(1, len(timeline_adapter.TargetTimeline(
+            timeline.path).runs))
+        self.assertEqual(0, os.path.getsize(self.adapter.journal))
+
+    def test_tags_are_written_once_per_flush(self):
+        with mock.patch.object(self.adapter, '_write_tags') as write_tags:
+            for target in ('ip1', 'ip2', 'ip3'):
+                self.adapter.tag_target(db_adapters.INSTANCE, target,
+                                        {'cloud': 'east'})
+            self.assertFalse(write_tags.called)
+            self.adapter.flush()
+            self.adapter.flush()
+        self.assertEqual(1, write_tags.call_count)
+        self.assertEqual(3, len(write_tags.call_args[0][0]))
+
+    def test_timelines_are_reloaded_and_appended(self):
+        self.ping(0)
+        self.ping(2)
+        self.adapter.store_service_status('nova', 'http://nova/', 503, 1,
+                                          20000, datetime(2017, 1, 1))
+        self.adapter.close()
+        self.ping(4)
+        self.adapter.flush()
+
+        adapter = timeline_adapter.TimelineDBAdapter(self.config)
+        self.ping(6, adapter=adapter)
+        adapter.close()
+        adapter = timeline_adapter.TimelineDBAdapter(self.config)
+        adapter.close()
+        timeline = adapter.timelines[(db_adapters.INSTANCE, 'ip1')]
+        self.assertEqual(1, len(timeline.runs))
+        self.assertEqual(4, timeline.runs[0][3])
+        self.assertEqual([{'service': 'nova', 'srv_downtime': 1,
+                           'total_uptime': 1, 'duration': 2.0,
+                           'downtime': 2.0}],
+                         adapter.get_service_statuses())
+        self.assertEqual([[1483228800, 4, 3.0, 3.0]],
+                         adapter.latency(db_adapters.INSTANCE, 'ip1'))
+
+    def test_latency_is_the_round_trip_of_answered_samples(self):
+        self.ping(0, rtt=2.0)
+        self.ping(2, rtt=6.0)
+        self.ping(4, exit_code=1, loss=100)
+        self.adapter.store_instance_status('ip1', 810, 0, 0,
+                                           datetime(2017, 1, 1, 1), rtt=1.5)
+        for status, value in ((200, 20000), (503, 1000000)):
+            self.adapter.store_service_status('nova', 'http://nova/', status,
+                                              0, value, datetime(2017, 1, 1))
+
+        self.assertEqual([[1483228800, 2, 4.0, 6.0],
+                          [1483232400, 1, 1.5, 1.5]],
+                         self.adapter.latency(db_adapters.INSTANCE, 'ip1'))
+        self.assertEqual([[1483228800, 1, 20.0, 20.0]],
+                         self.adapter.latency(db_adapters.SERVICE, 'nova'))
+
+    def test_runs_are_expanded_to_samples(self):
+        for second in range(0, 10, 2):
+            self.ping(second, exit_code=int(second >= 6))
+
+        chunk, = self.adapter.iter_samples(
+            db_adapters.INSTANCE, since=datetime(2017, 1, 1, 0, 0, 1))
+        self.assertEqual([(2, False), (4, False), (6, True), (8, True)],
+                         [(second - 1483228800, failed)
+                          for target, second, failed, _, _ in chunk])
+
+    def test_gap_starts_a_new_run(self):
+        self.ping(0)
+        self.adapter.store_instance_status('ip1', 10, 0, 0,
+                                           datetime(2017, 1, 1, 0, 5))
+        timeline = self.adapter.timelines[(db_adapters.INSTANCE, 'ip1')]
+        self.assertEqual(2, len(timeline.runs))
+
+    def test_outages_are_filtered_by_window(self):
+        self.adapter.store_outage({
+            'kind': db_adapters.SERVICE, 'target': 'nova',
+            'start': datetime(2017, 1, 1, 0, 0),
+            'end': datetime(2017, 1, 1, 0, 5), 'duration': 300.0,
+            'worst_status': 503})
+
+        outages = self.adapter.get_outages(since=datetime(2017, 1, 1, 0, 1))
+        self.assertEqual(['nova'], [o['target'] for o in outages])
+        self.assertEqual(datetime(2017, 1, 1, 0, 5), outages[0]['end'])
+        self.assertEqual([], self.adapter.get_outages(
+            since=datetime(2017, 1, 1, 1)))
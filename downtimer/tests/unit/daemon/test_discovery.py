@@ -0,0 +1,94 @@
+import mock
+import unittest
+
+import discovery
+
+
+def fips(*statuses):
+    return {'floatingips': [{'floating_ip_address': address,
+                             'status': status}
+                            for address, status in statuses]}
+
+
+class ServiceCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.keystone = mock.Mock()
+        self.keystone.services.list.return_value = [
+            mock.Mock(id='s1'), mock.Mock(id='s2')]
+        self.keystone.services.list.return_value[0].name = 'nova'
+        self.keystone.services.list.return_value[1].name = 'glance'
+        self.keystone.endpoints.list.return_value = [
+            mock.Mock(service_id='s1', url='http://1.2.3.4:8774/v2.1/x'),
+            mock.Mock(service_id='s2', url='https://1.2.3.5:9292'),
+            mock.Mock(service_id='s3', url='http://1.2.3.6:80')]
+        self.catalog = discovery.ServiceCatalog(self.keystone,
+                                                region='RegionOne')
+
+    def test_services_are_joined_locally(self):
+        self.assertEqual({'nova': 'http://1.2.3.4:8774',
+                          'glance': 'https://1.2.3.5:9292'},
+                         self.catalog.services())
+        self.keystone.endpoints.list.assert_called_once_with(
+            interface='public', region_id='RegionOne')
+        self.keystone.endpoints.find.assert_not_called()
+
+    @mock.patch('discovery.monotonic')
+    def test_catalog_is_cached(self, fake_monotonic):
+        fake_monotonic.return_value = 0
+        self.catalog.services()
+        fake_monotonic.return_value = 899
+        self.catalog.services()
+        self.assertEqual(1, self.keystone.endpoints.list.call_count)
+        fake_monotonic.return_value = 1000
+        self.catalog.services()
+        self.assertEqual(2, self.keystone.endpoints.list.call_count)
+
+
+class FloatingIPWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.neutron = mock.Mock()
+        self.watcher = discovery.FloatingIPWatcher(self.neutron,
+                                                   page_size=2)
+
+    def test_first_poll_lists_active(self):
+        self.neutron.list_floatingips.return_value = fips(
+            ('ip1', 'ACTIVE'), ('ip2', 'ACTIVE'))
+        self.assertEqual(({'ip1', 'ip2'}, set()), self.watcher.poll())
+        self.neutron.list_floatingips.assert_called_once_with(
+            limit=2, fields=['floating_ip_address', 'status'],
+            status='ACTIVE')
+
+    def test_incremental_poll_applies_changes(self):
+        self.neutron.list_floatingips.return_value = fips(
+            ('ip1', 'ACTIVE'), ('ip2', 'ACTIVE'))
+        self.watcher.poll()
+        self.neutron.list_floatingips.return_value = fips(
+            ('ip2', 'DOWN'), ('ip3', 'ACTIVE'))
+        self.assertEqual(({'ip3'}, {'ip2'}), self.watcher.poll())
+        self.assertIn('changed_since',
+                      self.neutron.list_floatingips.call_args[1])
+        self.assertEqual({'ip1', 'ip3'}, self.watcher.active)
+
+    @mock.patch('discovery.monotonic')
+    def test_resync_notices_deleted(self, fake_monotonic):
+        fake_monotonic.return_value = 0
+        self.neutron.list_floatingips.return_value = fips(
+            ('ip1', 'ACTIVE'), ('ip2', 'ACTIVE'))
+        self.watcher.poll()
+        fake_monotonic.return_value = 3600
+        self.neutron.list_floatingips.return_value = fips(('ip1', 'ACTIVE'))
+        self.assertEqual((set(), {'ip2'}), self.watcher.poll())
+        self.assertEqual('ACTIVE',
+                         self.neutron.list_floatingips.call_args[1]['status'])
+
+    def test_full_listing_without_timestamps(self):
+        self.neutron.show_extension.side_effect = \
+            discovery.neutron_exc.NotFound()
+        watcher = discovery.FloatingIPWatcher(self.neutron)
+        self.neutron.list_floatingips.return_value = fips(('ip1', 'ACTIVE'))
+        watcher.poll()
+        watcher.poll()
+        for call in self.neutron.list_floatingips.call_args_list:
+            self.assertEqual('ACTIVE', call[1]['status'])
@@ -0,0 +1,91 @@
+import BaseHTTPServer
+import mock
+import requests
+import socket
+import threading
+import unittest
+
+from datetime import timedelta
+
+import http_checker
+
+
+class HTTPCheckerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        self.scheduler = mock.Mock()
+        self.checker = http_checker.HTTPChecker(self.adapter, self.scheduler,
+                                                dns_ttl=0)
+        self.checker.add_target('nova', 'http://1.2.3.4:8774/')
+
+    def test_check_uses_shared_session(self):
+        elapsed = timedelta(seconds=2, microseconds=500000)
+        response = mock.Mock(status_code=200, elapsed=elapsed)
+        with mock.patch.object(self.checker.session, 'head',
+                               return_value=response) as fake_head:
+            self.checker.check('nova')
+        fake_head.assert_called_once_with('http://1.2.3.4:8774/',
+                                          timeout=mock.ANY, verify=False)
+        self.adapter.store_service_status.assert_called_once_with(
+            'nova', 'http://1.2.3.4:8774/', 200, 0, 2500000)
+
+    def test_check_timeout(self):
+        with mock.patch.object(self.checker.session, 'head',
+                               side_effect=requests.exceptions.Timeout):
+            self.checker.check('nova')
+        self.adapter.store_service_status.assert_called_once_with(
+            'nova', 'http://1.2.3.4:8774/', 408, 1,
+            http_checker.utils.SERVICE_TIMEOUT * 1e6)
+
+    def test_check_remembers_healthcheck_address(self):
+        elapsed = timedelta(microseconds=1000)
+        with mock.patch.object(self.checker.session, 'head',
+                               return_value=mock.Mock(status_code=404)), \
+                mock.patch.object(self.checker.session, 'get',
+                                  return_value=mock.Mock(status_code=200,
+                                                         elapsed=elapsed)):
+            self.checker.check('nova')
+        self.assertEqual('http://1.2.3.4:8774/healthcheck',
+                         self.checker.targets['nova'])
+
+    def test_targets_are_blocking_jobs(self):
+        self.scheduler.add.assert_called_once_with(
+            ('http', 'nova'), mock.ANY, 2, kind='http', blocking=True)
+        self.checker.remove_target('nova')
+        self.scheduler.remove.assert_called_once_with(('http', 'nova'))
+        self.assertEqual({}, self.checker.targets)
+
+
+class DNSCacheTest(unittest.TestCase):
+
+    def test_getaddrinfo_is_cached(self):
+        cache = http_checker.DNSCache(ttl=60)
+        cache._getaddrinfo = mock.Mock(return_value=['addr'])
+        self.assertEqual(['addr'], cache.getaddrinfo('host', 80))
+        self.assertEqual(['addr'], cache.getaddrinfo('host', 80))
+        cache._getaddrinfo.assert_called_once_with('host', 80)
+
+    def test_only_the_checker_session_uses_the_cache(self):
+        server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), BaseHTTPServer.BaseHTTPRequestHandler)
+        worker = threading.Thread(target=server.handle_request)
+        worker.start()
+        getaddrinfo = socket.getaddrinfo
+        checker = http_checker.HTTPChecker(mock.Mock(), mock.Mock(),
+                                           dns_ttl=60)
+        adapter = checker.session.get_adapter('http://')
+        cache = adapter.pool_classes['http'].ConnectionCls.dns_cache
+        cache._getaddrinfo = mock.Mock(return_value=getaddrinfo(
+            '127.0.0.1', server.server_port, 0, socket.SOCK_STREAM))
+
+        url = 'http://nova.invalid:%d/' % server.server_port
+        response = checker.session.head(url, timeout=5)
+        worker.join()
+        server.server_close()
+
+        # the server doesn't implement HEAD, but it was reached
+        self.assertEqual(501, response.status_code)
+        cache._getaddrinfo.assert_called_once_with(
+            'nova.invalid', server.server_port, 0, socket.SOCK_STREAM)
+        self.assertIs(getaddrinfo, socket.getaddrinfo)
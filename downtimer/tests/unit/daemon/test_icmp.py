@@ -0,0 +1,169 @@
+import mock
+import struct
+import unittest
+
+import icmp
+
+
+class ICMPPacketTest(unittest.TestCase):
+
+    def test_echo_request_checksum(self):
+        packet = icmp.build_echo_request(0x1234, 7)
+        #  checksum over a packet with a valid checksum field is zero
+        self.assertEqual(0, icmp.checksum(packet))
+        icmp_type, code, _, ident, seq = struct.unpack('!BBHHH', packet[:8])
+        self.assertEqual((8, 0, 0x1234, 7), (icmp_type, code, ident, seq))
+
+    def test_parse_echo_reply_datagram(self):
+        packet = struct.pack('!BBHHH', icmp.ICMP_ECHO_REPLY, 0, 0, 5, 9)
+        self.assertEqual((5, 9), icmp.parse_echo_reply(packet, False))
+
+    def test_parse_echo_reply_raw_skips_ip_header(self):
+        ip_header = b'\x45' + b'\x00' * 19
+        packet = ip_header + struct.pack('!BBHHH', icmp.ICMP_ECHO_REPLY,
+                                         0, 0, 5, 9)
+        self.assertEqual((5, 9), icmp.parse_echo_reply(packet, True))
+
+    def test_parse_ignores_other_types(self):
+        packet = struct.pack('!BBHHH', icmp.ICMP_ECHO_REQUEST, 0, 0, 5, 9)
+        self.assertIsNone(icmp.parse_echo_reply(packet, False))
+
+
+class ICMPProberTest(unittest.TestCase):
+
+    @mock.patch('icmp.open_socket')
+    def setUp(self, fake_open_socket):
+        self.sock = mock.Mock()
+        fake_open_socket.return_value = (self.sock, False)
+        self.adapter = mock.Mock()
+        self.scheduler = mock.Mock()
+        self.prober = icmp.ICMPProber(self.adapter, self.scheduler)
+
+    def test_summarize_all_lost(self):
+        self.assertEqual(('1000', '1', '100', None),
+                         self.prober.summarize([]))
+
+    def test_summarize_partial_loss(self):
+        total_time, exit_code, packet_loss, rtt = self.prober.summarize(
+            [0.01, 0.02, 0.03, 0.04])
+        self.assertEqual('0', exit_code)
+        self.assertEqual('20', packet_loss)
+        self.assertEqual('840', total_time)
+        self.assertAlmostEqual(40.0, rtt)
+
+    def test_add_target_schedules_probe(self):
+        self.prober.add_target('ip1')
+        key, func, period = self.scheduler.add.call_args[0]
+        self.assertEqual((('ping', 'ip1'), 2), (key, period))
+
+    def run_probe(self, address):
+        #  run the follow up sends and the final check right away
+        self.scheduler.call_later.side_effect = (
+            lambda delay, func, *args: func(*args))
+        self.prober.probe(address)
+
+    def test_probe_matches_replies(self):
+        def reply_to_first(packet, dest):
+            seq = struct.unpack('!BBHHH', packet[:8])[4]
+            if dest[0] == 'ip1':
+                self.prober.replies[(dest[0], seq)] = 0.001
+
+        self.sock.sendto.side_effect = reply_to_first
+        self.run_probe('ip1')
+        self.run_probe('ip2')
+
+        self.assertEqual(10, self.sock.sendto.call_count)
+        self.adapter.store_instance_status.assert_any_call(
+            'ip1', '801', '0', '0', rtt=1.0)
+        self.adapter.store_instance_status.assert_any_call(
+            'ip2', '1000', '1', '100', rtt=None)
+        self.assertEqual({}, self.prober.sent)
+        self.assertEqual({}, self.prober.replies)
+        self.assertEqual(set(), self.prober.probing)
+
+    def test_probe_in_flight_is_not_overlapped(self):
+        self.prober.probe('ip1')
+        self.prober.probe('ip1')
+
+        self.assertEqual(1, self.sock.sendto.call_count)
+        self.scheduler.record_overrun.assert_called_once_with('ping')
+        #  once the first probe is done the address is probed again
+        args = self.scheduler.call_later.call_args[0]
+        self.scheduler.call_later.side_effect = (
+            lambda delay, func, *args: func(*args))
+        args[1](*args[2:])
+        self.run_probe('ip1')
+        self.assertEqual(10, self.sock.sendto.call_count)
+        self.assertEqual(2, self.adapter.store_instance_status.call_count)
+        self.assertEqual(1, self.scheduler.record_overrun.call_count)
+
+
+PING_OUTPUT = '''PING 10.0.0.1 (10.0.0.1) 56(84) bytes of data.
+
+--- 10.0.0.1 ping statistics ---
+5 packets transmitted, 4 received, 20% packet loss, time 812ms
+rtt min/avg/max/mdev = 0.041/0.052/0.071/0.011 ms
+'''
+
+
+class SubprocessProberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        self.scheduler = mock.Mock()
+        self.prober = icmp.SubprocessProber(self.adapter, self.scheduler)
+
+    def fake_process(self, returncode=0, output=PING_OUTPUT):
+        process = mock.Mock(returncode=returncode)
+        process.poll.side_effect = [None, returncode]
+        process.stdout.read.return_value = output
+        return process
+
+    def reap_pending(self):
+        while self.scheduler.call_later.call_args is not None:
+            args = self.scheduler.call_later.call_args[0]
+            self.scheduler.call_later.reset_mock()
+            args[1](*args[2:])
+
+    @mock.patch('icmp.subprocess.Popen')
+    def test_ping_is_reaped_without_blocking(self, fake_popen):
+        fake_popen.return_value = self.fake_process()
+        self.prober.probe('10.0.0.1')
+
+        self.assertEqual(['ping', '-i', '0.2', '-c', '5', '-W', '1',
+                          '10.0.0.1'], fake_popen.call_args[0][0])
+        self.assertAlmostEqual(0.8, self.scheduler.call_later.call_args[0][0])
+        self.assertFalse(self.adapter.store_instance_status.called)
+
+        self.reap_pending()
+        self.adapter.store_instance_status.assert_called_once_with(
+            '10.0.0.1', '812', '0', '20', rtt=0.071)
+        self.assertEqual(set(), self.prober.running)
+
+    @mock.patch('icmp.subprocess.Popen')
+    def test_probe_of_a_running_ping_is_skipped(self, fake_popen):
+        fake_popen.return_value = self.fake_process(returncode=1, output='')
+        self.prober.probe('10.0.0.1')
+        self.prober.probe('10.0.0.1')
+
+        self.assertEqual(1, fake_popen.call_count)
+        self.scheduler.record_overrun.assert_called_once_with('ping')
+        self.reap_pending()
+        self.adapter.store_instance_status.assert_called_once_with(
+            '10.0.0.1', '1000', '1', '100', rtt=None)
+
+    @mock.patch('icmp.time.time')
+    @mock.patch('icmp.subprocess.Popen')
+    def test_hung_ping_is_killed(self, fake_popen, fake_time):
+        process = fake_popen.return_value
+        process.poll.return_value = None
+        process.returncode = -9
+        process.stdout.read.return_value = ''
+        fake_time.return_value = 0
+        self.prober.probe('10.0.0.1')
+        fake_time.return_value = 60
+        self.reap_pending()
+
+        process.kill.assert_called_once_with()
+        self.adapter.store_instance_status.assert_called_once_with(
+            '10.0.0.1', '1000', '1', '100', rtt=None)
@@ -0,0 +1,60 @@
+import mock
+import shutil
+import tempfile
+import threading
+import unittest
+
+import instrumentation
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = instrumentation.Registry()
+
+    def test_render_histogram_and_counters(self):
+        self.registry.observe('db.sql.commit', 0.003)
+        self.registry.observe('db.sql.commit', 2)
+        self.registry.count('icmp.echo_sent', 5)
+        self.registry.add_collector(lambda: ['extra 1'])
+        lines = self.registry.render().splitlines()
+        for line in (
+                'downtimer_internal_duration_seconds_bucket'
+                '{op="db.sql.commit",le="0.005"} 1',
+                'downtimer_internal_duration_seconds_bucket'
+                '{op="db.sql.commit",le="+Inf"} 2',
+                'downtimer_internal_duration_seconds_count'
+                '{op="db.sql.commit"} 2',
+                'downtimer_internal_events_total{event="icmp.echo_sent"} 5',
+                'extra 1'):
+            self.assertIn(line, lines)
+
+    @mock.patch('instrumentation.REGISTRY')
+    def test_timed_counts_errors(self, fake_registry):
+        @instrumentation.timed('op')
+        def fail():
+            raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        fake_registry.observe.assert_called_once_with('op', mock.ANY)
+        fake_registry.count.assert_called_once_with('op.errors', 1)
+
+
+class SamplingProfilerTest(unittest.TestCase):
+
+    def test_samples_other_threads(self):
+        directory = tempfile.mkdtemp()
+        try:
+            profiler = instrumentation.SamplingProfiler(directory)
+            event = threading.Event()
+            worker = threading.Thread(target=event.wait)
+            worker.start()
+            profiler.sample()
+            event.set()
+            worker.join()
+            profiler.thread = mock.Mock()
+            with open(profiler.stop()) as f:
+                stacks = f.read()
+        finally:
+            shutil.rmtree(directory)
+        self.assertIn('wait (threading.py:', stacks)
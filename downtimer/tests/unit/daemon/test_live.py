@@ -0,0 +1,98 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import live
+
+
+class SampleRingTest(unittest.TestCase):
+
+    def test_ring_keeps_last_samples(self):
+        ring = live.SampleRing(size=4)
+        for second in range(6):
+            ring.add(second, second >= 4, 503 if second >= 4 else 200,
+                     10.0, 0.0, 1.0, float(second >= 4))
+        summary = ring.summary(since=0)
+        self.assertEqual(4, summary['samples'])
+        self.assertEqual(50.0, summary['availability'])
+        self.assertEqual((False, 503, 4),
+                         (summary['up'], summary['status'],
+                          summary['last_change']))
+
+    def test_availability_window(self):
+        ring = live.SampleRing(size=10)
+        for second, failed in ((0, True), (2, False), (4, False)):
+            ring.add(second, failed, 0, 1.0, 0.0, 2.0, 2.0 * failed)
+        summary = ring.summary(since=1)
+        self.assertEqual((2, 100.0), (summary['samples'],
+                                      summary['availability']))
+
+    def test_ring_grows_to_keep_the_window(self):
+        ring = live.SampleRing(size=3, max_size=8, window=10)
+        for second in range(0, 20, 2):
+            ring.add(second, False, 0, 1.0, 0.0, 2.0)
+        self.assertEqual(6, ring.size)
+        for second in range(20, 30):
+            ring.add(second, second >= 25, 0, 1.0, 0.0, 1.0,
+                     float(second >= 25))
+        summary = ring.summary(since=20)
+        self.assertEqual((8, 8), (ring.size, ring.count))
+        self.assertEqual((8, 37.5), (summary['samples'],
+                                     summary['availability']))
+
+
+class LiveStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        self.live = live.LiveStatus(self.adapter, {live.INSTANCE: 2.0,
+                                                   live.SERVICE: 2.0},
+                                    window=20, min_interval=0.5)
+
+    def test_samples_are_passed_on_and_kept(self):
+        self.live.store_instance_status('ip1', '1000', '1', '100')
+        self.live.store_service_status('nova', 'http://nova', 200, 0, 1500)
+        self.adapter.store_instance_status.assert_called_once_with(
+            'ip1', '1000', '1', '100', None, rtt=None, interval=None)
+        states = dict((state['target'], state)
+                      for state in self.live.query())
+        self.assertEqual((False, 100.0), (states['ip1']['up'],
+                                          states['ip1']['loss']))
+        self.assertEqual((True, 1.5, 100.0),
+                         (states['nova']['up'], states['nova']['latency'],
+                          states['nova']['availability']))
+
+    def test_availability_is_weighed_by_interval_and_loss(self):
+        self.live.store_instance_status('ip1', '820', '0', '20', rtt=20.0)
+        self.live.store_instance_status('ip1', '1000', '1', '100',
+                                        interval=0.5)
+        self.live.store_service_status('nova', 'http://nova', 200, 0, 1500,
+                                       interval=6.0)
+        self.live.store_service_status('nova', 'http://nova', 503, 0, 1500)
+        states = dict((state['target'], state)
+                      for state in self.live.query())
+        self.assertAlmostEqual(64.0, states['ip1']['availability'], places=4)
+        self.assertEqual(75.0, states['nova']['availability'])
+        self.assertEqual((11, 41), (self.live.rings[(live.INSTANCE,
+                                                     'ip1')].size,
+                                    self.live.max_size))
+
+    def test_ping_latency_is_the_round_trip(self):
+        self.live.store_instance_status('ip1', '820', '0', '0', rtt=20.0)
+        self.assertEqual(20.0, self.live.query()[0]['latency'])
+
+    def test_status_socket(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'status.sock')
+            server = live.StatusServer(self.live, path)
+            server.start()
+            self.live.store_instance_status('ip1', '20', '0', '0')
+            states = live.query_status(path, minutes=1)
+            server.shutdown()
+            server.server_close()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(['ip1'], [state['target'] for state in states])
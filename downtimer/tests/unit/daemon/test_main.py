@@ -0,0 +1,85 @@
+import mock
+import unittest
+
+from db_adapters import INSTANCE, SERVICE
+import main
+
+
+class DiscoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        conf = mock.Mock(db_adapter='mock', detect_outages=False,
+                         latency_sketches=False, scheduler_workers=1)
+        with mock.patch.dict(main.adapters, mock=lambda conf: self.adapter):
+            self.downtimer = main.Downtimer(conf=conf)
+        self.downtimer.add_service_target = mock.Mock()
+        self.downtimer.remove_service_target = mock.Mock()
+        self.downtimer.add_ping_target = mock.Mock(
+            side_effect=self.downtimer.ping_targets.add)
+        self.downtimer.remove_ping_target = mock.Mock()
+        for name, region in (('default', 'RegionOne'), ('east', 'RegionTwo')):
+            catalog = mock.Mock()
+            catalog.services.return_value = {'nova': 'http://nova-' + region}
+            watcher = mock.Mock()
+            watcher.poll.return_value = (['10.0.0.1'], [])
+            cloud = mock.Mock(tags={'cloud': name, 'region': region})
+            self.downtimer.clouds[name] = (cloud, catalog, watcher)
+            self.downtimer.cloud_targets[name] = (set(), set())
+
+    def test_services_of_other_clouds_are_prefixed(self):
+        self.downtimer.discover('default')
+        self.downtimer.discover('east')
+
+        self.assertEqual(
+            [mock.call('nova', 'http://nova-RegionOne'),
+             mock.call('east/nova', 'http://nova-RegionTwo')],
+            self.downtimer.add_service_target.call_args_list)
+        self.adapter.tag_target.assert_any_call(
+            SERVICE, 'east/nova', {'cloud': 'east', 'region': 'RegionTwo'})
+
+    def test_address_is_probed_once_and_removed_by_its_cloud(self):
+        self.downtimer.discover('default')
+        self.downtimer.discover('east')
+        self.downtimer.add_ping_target.assert_called_once_with('10.0.0.1')
+        self.adapter.tag_target.assert_any_call(
+            INSTANCE, '10.0.0.1', {'cloud': 'default', 'region': 'RegionOne'})
+
+        cloud, catalog, watcher = self.downtimer.clouds['east']
+        watcher.poll.return_value = ([], ['10.0.0.1'])
+        self.downtimer.discover('east')
+        self.downtimer.remove_ping_target.assert_not_called()
+
+    def test_failing_cloud_is_skipped(self):
+        cloud, catalog, watcher = self.downtimer.clouds['east']
+        catalog.services.side_effect = Exception('keystone is down')
+        self.downtimer.discover('east')
+        self.downtimer.add_service_target.assert_not_called()
+
+
+class RunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        conf = mock.Mock(db_adapter='mock', detect_outages=False,
+                         latency_sketches=False, scheduler_workers=1,
+                         profile_dir=None, mode='cloudless')
+        with mock.patch.dict(main.adapters, mock=lambda conf: self.adapter):
+            self.downtimer = main.Downtimer(conf=conf)
+        self.downtimer.start_pipeline = mock.Mock()
+
+    def test_unknown_mode_is_reported(self):
+        with self.assertRaises(AttributeError) as raised:
+            self.downtimer.run()
+        self.assertIn('mode cloudless', str(raised.exception))
+        self.downtimer.start_pipeline.assert_not_called()
+        self.adapter.close.assert_called_once_with()
+
+    def test_errors_of_the_mode_are_not_masked(self):
+        self.downtimer.conf.mode = 'static'
+        self.downtimer.handle_static = mock.Mock(
+            side_effect=AttributeError('no ips'))
+        with self.assertRaises(AttributeError) as raised:
+            self.downtimer.run()
+        self.assertEqual('no ips', str(raised.exception))
+        self.adapter.close.assert_called_once_with()
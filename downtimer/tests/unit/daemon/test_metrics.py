@@ -0,0 +1,55 @@
+import mock
+import unittest
+import urllib2
+
+import metrics
+
+
+class ProbeMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        self.metrics = metrics.ProbeMetrics(self.adapter)
+
+    def test_samples_are_passed_on(self):
+        self.metrics.store_service_status('nova', 'http://nova', 200, 0, 1000)
+        self.adapter.store_service_status.assert_called_once_with(
+            'nova', 'http://nova', 200, 0, 1000, None, interval=None)
+
+    def test_render(self):
+        self.metrics.store_instance_status('ip1', '820', '0', '0', rtt=20.0)
+        self.metrics.store_instance_status('ip1', '1000', '1', '100')
+        self.metrics.store_service_status('nova', 'http://nova', 503, 0,
+                                          30000)
+        lines = self.metrics.render().splitlines()
+        for line in (
+                '# TYPE downtimer_target_up gauge',
+                'downtimer_target_up{kind="instance",target="ip1"} 0',
+                'downtimer_probes_total{kind="instance",target="ip1"} 2',
+                'downtimer_probe_failures_total{kind="service",'
+                'target="nova"} 1',
+                'downtimer_packet_loss_ratio{kind="instance",'
+                'target="ip1"} 1.0',
+                'downtimer_probe_latency_seconds_bucket{kind="instance",'
+                'target="ip1",le="0.025"} 1',
+                'downtimer_probe_latency_seconds_bucket{kind="instance",'
+                'target="ip1",le="+Inf"} 2',
+                'downtimer_probe_latency_seconds_count{kind="service",'
+                'target="nova"} 1'):
+            self.assertIn(line, lines)
+
+    def test_label_values_are_escaped(self):
+        self.assertEqual('a\\"b\\\\c', metrics.escape('a"b\\c'))
+
+    def test_http_endpoint(self):
+        self.metrics.store_instance_status('ip1', '20', '0', '0')
+        server = metrics.MetricsServer(self.metrics, '127.0.0.1', 0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % server.server_address[1]
+            body = urllib2.urlopen(url).read()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('downtimer_target_up{kind="instance",target="ip1"} 1',
+                      body)
@@ -0,0 +1,51 @@
+import mock
+import unittest
+
+from datetime import datetime
+
+import outages
+
+
+def at(second):
+    return datetime(2017, 1, 1, 0, 0, second)
+
+
+class OutageDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        self.detector = outages.OutageDetector(self.adapter,
+                                               down_threshold=2,
+                                               up_threshold=2)
+
+    def feed(self, samples):
+        for second, status in samples:
+            self.detector.feed('service', 'nova', status != 200, status,
+                               at(second))
+
+    def test_outage_is_debounced(self):
+        self.feed([(0, 200), (2, 503), (4, 200), (6, 200)])
+        self.adapter.store_outage.assert_not_called()
+
+    def test_outage_interval(self):
+        self.feed([(0, 200), (2, 503), (4, 408), (6, 503), (8, 200),
+                   (10, 503), (12, 200), (14, 200)])
+        self.adapter.store_outage.assert_called_once_with({
+            'kind': 'service', 'target': 'nova', 'start': at(2),
+            'end': at(12), 'duration': 10.0, 'worst_status': 503})
+
+    def test_close_ends_ongoing_outage(self):
+        self.feed([(0, 503), (2, 503), (4, 503)])
+        self.detector.close()
+        self.adapter.store_outage.assert_called_once_with({
+            'kind': 'service', 'target': 'nova', 'start': at(0),
+            'end': at(4), 'duration': 4.0, 'worst_status': 503})
+        self.adapter.close.assert_called_once_with()
+
+    def test_samples_are_stored(self):
+        self.detector.store_instance_status('ip1', '1000', '1', '100', at(0))
+        self.adapter.store_instance_status.assert_called_once_with(
+            'ip1', '1000', '1', '100', at(0), rtt=None,
+            interval=None)
+        state = self.detector.targets[('instance', 'ip1')]
+        self.assertEqual((1, 100.0), (state.streak, state.worst_status))
@@ -0,0 +1,114 @@
+import json
+import mock
+import StringIO
+import unittest
+
+from db_adapters import INSTANCE, SERVICE
+import report
+
+
+def fake_adapter(samples, tags=None):
+    '''
+    samples: {kind: [(target, second, failed[, seconds[, down]]), ...]}
+    in two chunks, of 10 seconds each and down all of them if failed
+    unless given
+    '''
+    adapter = mock.Mock()
+    adapter.get_target_tags.side_effect = lambda kind: (tags or {}).get(
+        kind, {})
+
+    def iter_samples(kind, since=None, until=None):
+        rows = [row + (10.0,)[len(row) - 3:] for row in samples.get(kind, [])]
+        rows = [row + (row[3] * row[2],)[len(row) - 4:] for row in rows]
+        return iter([chunk for chunk in (rows[:3], rows[3:]) if chunk])
+    adapter.iter_samples.side_effect = iter_samples
+    return adapter
+
+
+class ReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = fake_adapter({
+            SERVICE: [('nova', 0, False), ('glance', 0, False),
+                      ('nova', 10, True), ('nova', 20, True),
+                      ('glance', 10, False), ('nova', 30, False),
+                      ('nova', 3600, True), ('nova', 3610, False)],
+            INSTANCE: [('ip1', 0, True)],
+        }, tags={SERVICE: {
+            'nova': {'cloud': 'east', 'region': 'RegionOne'},
+            'glance': {'cloud': 'east', 'region': 'RegionOne'}}})
+        self.report = report.Report.load(self.adapter)
+
+    def target(self, name):
+        return [target for target in self.report.targets
+                if target['target'] == name][0]
+
+    def test_availability_and_repair_times(self):
+        nova = self.target('nova')
+        self.assertEqual(6, nova['samples'])
+        self.assertEqual(3, nova['failed'])
+        self.assertEqual(50.0, nova['availability'])
+        self.assertEqual(2, nova['outages'])
+        self.assertEqual(30.0, nova['downtime'])
+        self.assertEqual(15.0, nova['mttr'])
+        self.assertEqual((3610 - 30) / 2.0, nova['mtbf'])
+        self.assertIsNone(self.target('glance')['mttr'])
+
+    def test_outage_of_last_sample_ends_with_it(self):
+        ip1 = self.target('ip1')
+        self.assertEqual(1, ip1['outages'])
+        self.assertEqual(0.0, ip1['downtime'])
+        self.assertEqual(0.0, ip1['availability'])
+
+    def test_kinds_buckets_and_worst(self):
+        self.assertEqual({'kind': SERVICE, 'targets': 2, 'samples': 8,
+                          'failed': 3, 'availability': 62.5},
+                         self.report.kinds[0])
+        self.assertEqual([('1970-01-01T00:00:00', 6, 2),
+                          ('1970-01-01T01:00:00', 2, 1)],
+                         [(bucket['start'], bucket['samples'],
+                           bucket['failed']) for bucket in
+                          self.report.buckets if bucket['kind'] == SERVICE])
+        self.assertEqual(['ip1', 'nova'],
+                         [target['target'] for target in
+                          self.report.worst(2)])
+
+    def test_regions(self):
+        self.assertEqual([('service', 'east', 'RegionOne', 2, 62.5),
+                          ('instance', '', '', 1, 0.0)],
+                         [(row['kind'], row['cloud'], row['region'],
+                           row['targets'], row['availability'])
+                          for row in self.report.regions])
+        self.assertEqual('RegionOne', self.target('nova')['region'])
+
+    def test_export(self):
+        output = StringIO.StringIO()
+        self.report.write_csv(output, 'kinds')
+        self.assertEqual(['kind,targets,samples,failed,availability',
+                          'service,2,8,3,62.5', 'instance,1,1,1,0.0'],
+                         output.getvalue().splitlines())
+
+        output = StringIO.StringIO()
+        self.report.write_json(output, worst=1)
+        self.assertEqual(['ip1'], [target['target'] for target in
+                                   json.loads(output.getvalue())['worst']])
+
+    def test_fast_samples_weigh_less(self):
+        weighed = report.Report.load(fake_adapter({SERVICE: [
+            ('nova', 0, False, 10.0), ('nova', 10, True, 1.0),
+            ('nova', 11, True, 1.0), ('nova', 12, False, 8.0)]}))
+        self.assertEqual(2, weighed.targets[0]['failed'])
+        self.assertEqual(90.0, weighed.targets[0]['availability'])
+        self.assertEqual(90.0, weighed.kinds[0]['availability'])
+
+    def test_partial_loss_counts_in_part(self):
+        lossy = report.Report.load(fake_adapter({INSTANCE: [
+            ('ip1', 0, False, 10.0, 2.0), ('ip1', 10, False, 10.0, 0.0)]}))
+        self.assertEqual(0, lossy.targets[0]['failed'])
+        self.assertEqual(90.0, lossy.targets[0]['availability'])
+        self.assertEqual(90.0, lossy.buckets[0]['availability'])
+
+    def test_no_samples(self):
+        empty = report.Report.load(fake_adapter({}))
+        self.assertEqual([], empty.targets)
+        self.assertEqual([], empty.kinds)
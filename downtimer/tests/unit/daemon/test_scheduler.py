@@ -0,0 +1,74 @@
+import mock
+import unittest
+
+import scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = scheduler.Scheduler(workers=1)
+
+    def test_monotonic_moves_forward(self):
+        self.assertTrue(scheduler.monotonic() <= scheduler.monotonic())
+
+    def test_spread_offset_within_interval(self):
+        offsets = [scheduler.spread_offset(('ping', 'ip%d' % i), 2)
+                   for i in range(100)]
+        self.assertTrue(all(0 <= offset < 2 for offset in offsets))
+        #  targets don't all start in the same instant
+        self.assertTrue(max(offsets) - min(offsets) > 1)
+        self.assertEqual(offsets[0],
+                         scheduler.spread_offset(('ping', 'ip0'), 2))
+
+    @mock.patch('scheduler.monotonic')
+    def test_reschedule_does_not_drift(self, fake_monotonic):
+        job = scheduler.Job('ip1', None, 2, 'ping', False)
+        fake_monotonic.return_value = 10.5
+        with self.scheduler.condition:
+            self.scheduler._reschedule(10, 10.5, job)
+        self.assertEqual(12, self.scheduler.heap[0][0])
+
+    def test_reschedule_skips_missed_runs(self):
+        job = scheduler.Job('ip1', None, 2, 'ping', False)
+        with self.scheduler.condition:
+            self.scheduler._reschedule(10, 15, job)
+        self.assertEqual(16, self.scheduler.heap[0][0])
+        self.assertEqual(2, self.scheduler.stats()['ping']['missed'])
+
+    @mock.patch('scheduler.monotonic')
+    def test_run_records_lag(self, fake_monotonic):
+        func = mock.Mock()
+        fake_monotonic.return_value = 10.25
+        self.scheduler.dispatch(10, scheduler.Job('ip1', func, 2, 'ping',
+                                                  False))
+        func.assert_called_once_with()
+        stats = self.scheduler.stats()['ping']
+        self.assertEqual((1, 0.25, 0.25),
+                         (stats['runs'], stats['mean_lag'],
+                          stats['max_lag']))
+
+    def test_running_blocking_job_is_skipped(self):
+        job = scheduler.Job('nova', mock.Mock(), 2, 'http', True)
+        self.scheduler.dispatch(10, job)
+        self.scheduler.dispatch(12, job)
+        self.assertEqual(1, self.scheduler.queue.qsize())
+        self.assertEqual(1, self.scheduler.stats()['http']['overrun'])
+
+    @mock.patch('scheduler.monotonic')
+    def test_set_interval_reschedules(self, fake_monotonic):
+        fake_monotonic.return_value = 100
+        self.scheduler.add('ip1', mock.Mock(), 2)
+        self.scheduler.set_interval('ip1', 0.2)
+        self.assertEqual(0.2, self.scheduler.interval('ip1'))
+        due, _, job, generation = min(self.scheduler.heap)
+        self.assertEqual((100.2, 1), (due, generation))
+        #  the entry pushed by add() is now stale
+        self.assertEqual([0, 1], sorted(entry[3] for entry in
+                                        self.scheduler.heap))
+
+    def test_removed_job_is_not_run(self):
+        func = mock.Mock()
+        self.scheduler.add('ip1', func, 0.01)
+        self.scheduler.remove('ip1')
+        self.assertTrue(self.scheduler.heap[0][2].cancelled)
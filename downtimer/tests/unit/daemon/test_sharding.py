@@ -0,0 +1,45 @@
+import mock
+import unittest
+
+import sharding
+
+
+class HashRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.targets = [sharding.target_key('ping', '10.0.%d.%d' % (i, j))
+                        for i in range(10) for j in range(100)]
+
+    def split(self, shards):
+        ring = sharding.HashRing(shards)
+        return dict((target, ring.owner(target)) for target in self.targets)
+
+    def test_targets_are_spread(self):
+        owners = self.split(sharding.shard_names(['node1'], 4)).values()
+        for shard in sharding.shard_names(['node1'], 4):
+            #  an even split would be 250 targets each
+            self.assertTrue(150 < owners.count(shard) < 350)
+
+    def test_adding_shard_moves_few_targets(self):
+        before = self.split(sharding.shard_names(['node1'], 4))
+        after = self.split(sharding.shard_names(['node1', 'node2'], 4)[:5])
+        moved = [target for target in self.targets
+                 if before[target] != after[target]]
+        self.assertTrue(all(after[target] == 'node2/0' for target in moved))
+        self.assertTrue(len(moved) < 350)
+
+    def test_empty_ring(self):
+        self.assertIsNone(sharding.HashRing([]).owner('ping:ip1'))
+
+
+class RunShardsTest(unittest.TestCase):
+
+    @mock.patch('sharding.multiprocessing.Process')
+    def test_process_per_shard(self, fake_process):
+        fake_process.return_value.exitcode = 0
+        fake_process.return_value.is_alive.return_value = False
+        action = mock.Mock()
+        sharding.run_shards(['node1/0', 'node1/1'], action)
+        fake_process.assert_any_call(target=action, args=('node1/1',),
+                                     name='downtimer-node1/1')
+        self.assertEqual(2, fake_process.return_value.join.call_count)
@@ -0,0 +1,99 @@
+import mock
+import random
+import unittest
+
+from datetime import datetime
+
+import sketches
+
+
+class LatencySketchTest(unittest.TestCase):
+
+    def test_quantiles_within_accuracy(self):
+        rng = random.Random(1)
+        latencies = [rng.lognormvariate(3, 1) for _ in range(10000)]
+        sketch = sketches.LatencySketch(0.01)
+        for latency in latencies:
+            sketch.add(latency)
+
+        latencies.sort()
+        for q in (0.5, 0.95, 0.99):
+            exact = latencies[int(q * (len(latencies) - 1))]
+            self.assertAlmostEqual(exact, sketch.quantile(q),
+                                   delta=exact * 0.01)
+        self.assertEqual(latencies[-1], sketch.quantile(1))
+
+    def test_merged_sketches_equal_one_sketch(self):
+        whole = sketches.LatencySketch()
+        parts = [sketches.LatencySketch() for _ in range(3)]
+        for i in range(300):
+            whole.add(i * 0.7)
+            parts[i % 3].add(i * 0.7)
+        merged = sketches.LatencySketch.loads(parts[0].dumps())
+        merged.merge(parts[1])
+        merged.merge(parts[2])
+
+        self.assertEqual(whole.counts, merged.counts)
+        self.assertEqual((1, 300), (merged.zeros, merged.count))
+        self.assertEqual(whole.quantile(0.9), merged.quantile(0.9))
+
+    def test_different_accuracies_do_not_merge(self):
+        self.assertRaises(ValueError, sketches.LatencySketch(0.01).merge,
+                          sketches.LatencySketch(0.02))
+
+    def test_empty_sketch(self):
+        self.assertIsNone(sketches.LatencySketch().quantile(0.5))
+
+
+class LatencySketchesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = mock.Mock()
+        self.sketches = sketches.LatencySketches(self.adapter, bucket=60)
+
+    def test_successful_probes_are_sketched_per_bucket(self):
+        self.sketches.store_service_status(
+            'nova', 'http://nova', 200, 1, 20000,
+            datetime(2017, 1, 1, 0, 0, 30))
+        self.sketches.store_service_status(
+            'nova', 'http://nova', 503, 1, 900000,
+            datetime(2017, 1, 1, 0, 0, 40))
+        self.sketches.store_instance_status(
+            'ip1', '803', 0, 0, datetime(2017, 1, 1, 0, 1, 10), rtt=3.0)
+        self.adapter.store_service_status.assert_called_with(
+            'nova', 'http://nova', 503, 1, 900000,
+            datetime(2017, 1, 1, 0, 0, 40), interval=None)
+
+        self.sketches.flush(datetime(2017, 1, 1, 0, 1, 30))
+        rows, = self.adapter.store_sketches.call_args[0]
+        self.assertEqual([('service', 'nova', datetime(2017, 1, 1))],
+                         [(row['kind'], row['target'], row['start'])
+                          for row in rows])
+        sketch = sketches.LatencySketch.loads(rows[0]['sketch'])
+        self.assertEqual((1, 20.0), (sketch.count, sketch.max))
+
+        self.sketches.close()
+        rows, = self.adapter.store_sketches.call_args[0]
+        self.assertEqual(['ip1'], [row['target'] for row in rows])
+        self.assertEqual(3.0, sketches.LatencySketch.loads(
+            rows[0]['sketch']).max)
+        self.adapter.close.assert_called_once_with()
+
+    def test_percentiles_merge_buckets_and_shards(self):
+        rows = []
+        for start, latencies in ((0, [10.0, 20.0]), (60, [30.0]),
+                                 (0, [40.0])):
+            sketch = sketches.LatencySketch()
+            for latency in latencies:
+                sketch.add(latency)
+            rows.append({'kind': 'instance', 'target': 'ip1',
+                         'start': datetime.utcfromtimestamp(start),
+                         'sketch': sketch.dumps()})
+        self.adapter.get_sketches.return_value = rows
+
+        ip1, = sketches.latency_percentiles(self.adapter)
+        self.assertEqual(4, ip1['samples'])
+        self.assertEqual(25.0, ip1['mean'])
+        self.assertEqual(40.0, ip1['max'])
+        self.assertAlmostEqual(20.0, ip1['p50'], delta=0.2)
+        self.assertAlmostEqual(30.0, ip1['p99'], delta=0.3)
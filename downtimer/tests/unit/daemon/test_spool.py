@@ -0,0 +1,151 @@
+import mock
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime
+
+import changes
+import spool
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = spool.Spool(self.directory, segment_size=64,
+                                 max_size=256)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records_are_read_in_order(self):
+        for i in range(10):
+            self.spool.append(['r', i])
+        #  records of 8 bytes, a few per segment
+        self.assertTrue(self.spool.stats()['segments'] > 1)
+        records, position = self.spool.read(100)
+        self.assertEqual([['r', i] for i in range(10)], records)
+
+    def test_uncommitted_records_are_read_again(self):
+        self.spool.append(['r', 1])
+        self.spool.read(10)
+        records, position = self.spool.read(10)
+        self.assertEqual([['r', 1]], records)
+        self.spool.commit(position, len(records))
+        self.assertEqual(([], position), self.spool.read(10))
+
+    def test_restart_resumes_after_commit(self):
+        for i in range(6):
+            self.spool.append(['r', i])
+        records, position = self.spool.read(3)
+        self.spool.commit(position, len(records))
+        self.spool.close()
+
+        reopened = spool.Spool(self.directory, segment_size=64, max_size=256)
+        reopened.append(['r', 6])
+        records, _ = reopened.read(100)
+        self.assertEqual([['r', i] for i in range(3, 7)], records)
+
+    def test_oldest_segment_is_dropped_when_full(self):
+        for i in range(40):
+            self.spool.append(['r', i])
+        stats = self.spool.stats()
+        self.assertEqual(4, stats['segments'])
+        self.assertTrue(stats['dropped_segments'] > 0)
+        records, _ = self.spool.read(100)
+        self.assertEqual(['r', 39], records[-1])
+        self.assertNotEqual(['r', 0], records[0])
+
+    def test_torn_record_ends_segment(self):
+        segment = self.spool.writer
+        segment.append('{"a":1}')
+        segment.map[segment.offset + spool.HEADER.size] = 'x'
+        segment.map[segment.offset:segment.offset + spool.HEADER.size] = \
+            spool.HEADER.pack(3, 0)
+        self.assertEqual((None, segment.offset),
+                         segment.read(segment.offset))
+
+
+class SpoolAdapterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.adapter = mock.Mock()
+        self.adapter.pending.return_value = 0
+        self.adapter.held_since.return_value = None
+        with mock.patch('spool.threading.Thread'):
+            self.spooled = spool.SpoolAdapter(
+                self.adapter, spool.Spool(self.directory))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_samples_are_replayed_with_their_time(self):
+        taken = datetime(2017, 1, 1, 0, 0, 1, 500000)
+        self.spooled.store_instance_status('ip1', '1000', '1', '100', taken)
+        self.spooled.store_instance_status('ip1', '820', '0', '0', taken,
+                                           rtt=20.0, interval=2)
+        self.spooled.store_service_status('nova', 'http://nova', 200, 0, 10,
+                                          taken)
+        self.adapter.store_instance_status.assert_not_called()
+        self.assertEqual(3, self.spooled.drain())
+        self.assertEqual(
+            [mock.call('ip1', '1000', '1', '100', timestamp=taken, rtt=None,
+                       interval=None),
+             mock.call('ip1', '820', '0', '0', timestamp=taken, rtt=20.0,
+                       interval=2)],
+            self.adapter.store_instance_status.call_args_list)
+        self.adapter.store_service_status.assert_called_once_with(
+            'nova', 'http://nova', 200, 0, 10, timestamp=taken,
+            interval=None)
+        self.assertEqual(0, self.spooled.drain())
+        self.adapter.retry_failed_writes.assert_called_once_with()
+
+    def test_records_without_round_trip_are_replayed(self):
+        self.spooled.spool.append(['instance', 'ip1', '20', '0', '0',
+                                   1483228800])
+        self.spooled.drain()
+        self.adapter.store_instance_status.assert_called_once_with(
+            'ip1', '20', '0', '0', timestamp=datetime(2017, 1, 1), rtt=None,
+            interval=None)
+
+    def test_batch_is_committed_once_written(self):
+        self.spooled.store_instance_status('ip1', '1000', '1', '100')
+        self.adapter.pending.side_effect = [1, 0]
+        with mock.patch('spool.time.sleep') as fake_sleep:
+            self.spooled.drain()
+        fake_sleep.assert_called_once_with(0.01)
+        self.assertEqual(1, self.spooled.stats()['committed'])
+
+    def test_held_samples_are_committed_once_written(self):
+        writer = changes.ChangeOnlyWriter(self.adapter, heartbeat=60)
+        with mock.patch('spool.threading.Thread'):
+            spooled = spool.SpoolAdapter(writer, spool.Spool(self.directory))
+        for second, status in ((0, 200), (2, 200), (4, 503)):
+            spooled.store_service_status('nova', 'http://nova', status, 0,
+                                         10, datetime(2017, 1, 1, 0, 0,
+                                                      second))
+        self.assertEqual(3, spooled.drain())
+        self.assertEqual(1, self.adapter.store_service_status.call_count)
+        self.assertEqual(2, spooled.stats()['committed'])
+        # the held sample is replayed after a crash
+        records, _ = spool.Spool(self.directory).read(10)
+        self.assertEqual([503], [record[3] for record in records])
+
+        writer.flush()
+        self.assertEqual(0, spooled.drain())
+        self.assertEqual(3, spooled.stats()['committed'])
+
+    def test_close_commits_what_the_adapters_wrote(self):
+        writer = changes.ChangeOnlyWriter(self.adapter, heartbeat=60)
+        with mock.patch('spool.threading.Thread'):
+            spooled = spool.SpoolAdapter(writer, spool.Spool(self.directory))
+        spooled.store_instance_status('ip1', '20', '0', '0')
+        spooled.drain()
+        self.assertEqual(0, spooled.stats()['committed'])
+        spooled.close()
+        self.adapter.store_instance_status.assert_called_once_with(
+            'ip1', '20', '0', 0.0, mock.ANY, 1, interval=None)
+        self.assertEqual(([], mock.ANY),
+                         spool.Spool(self.directory).read(10))
@@ -0,0 +1,519 @@
+import bisect
+import calendar
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import urllib
+
+from datetime import datetime
+
+from db_adapters import (DBAdapter, INFLUX_PRECISE_TIME_FORMAT, INSTANCE,
+                         SAMPLE_CHUNK_SIZE, SERVICE)
+from instrumentation import timed
+
+# run: start, end, failed, samples, lost packets, seconds, down seconds
+RUN_RECORD = struct.Struct('<IIBIfff')
+# latency: period start, samples, sum and max in ms
+LATENCY_RECORD = struct.Struct('<IIff')
+RUNS_SUFFIX = '.runs'
+LATENCY_SUFFIX = '.latency'
+OUTAGES_FILE = 'outages.json'
+SKETCHES_FILE = 'sketches.json'
+TAGS_FILE = 'tags.json'
+JOURNAL_FILE = 'journal'
+# bytes of journal after which it is merged into the files of the targets
+JOURNAL_LIMIT = 4 << 20
+# seconds without samples after which a timeline starts a new run
+MAX_GAP = 60
+
+
+class TargetTimeline(object):
+    '''
+    Run-length encoded availability of one target: every run is a stretch
+    of consecutive samples with the same state, [start, end, failed,
+    samples, lost, seconds, down seconds] with times in epoch seconds and
+    the seconds the samples stand for, and latency is summed per
+    `resolution` seconds as [period, samples, sum, max] over the samples
+    which got an answer. The last run and period are still open;
+    everything before them is final.
+    '''
+    def __init__(self, path, resolution=3600):
+        self.path = path
+        self.resolution = resolution
+        self.runs = self._load(path + RUNS_SUFFIX, RUN_RECORD)
+        self.ends = [run[1] for run in self.runs]
+        self.latency = self._load(path + LATENCY_SUFFIX, LATENCY_RECORD)
+        # records from these indexes on still have to be written, which
+        # only matters once samples were added since the last snapshot
+        self.saved_runs = max(len(self.runs) - 1, 0)
+        self.saved_latency = max(len(self.latency) - 1, 0)
+        self.dirty = False
+        # indexes of the first runs and periods only written to the journal
+        self.unmerged = None
+
+    @staticmethod
+    def _load(path, record):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return []
+        return [list(record.unpack_from(data, offset)) for offset in
+                range(0, len(data) - record.size + 1, record.size)]
+
+    def add(self, second, failed, lost, latency, max_gap, samples=1,
+            seconds=0.0, down_seconds=0.0):
+        self.dirty = True
+        run = self.runs[-1] if self.runs else None
+        if run is None or run[2] != failed or second - run[1] > max_gap:
+            self.runs.append([second, second, failed, samples, lost, seconds,
+                              down_seconds])
+            self.ends.append(second)
+        else:
+            run[1] = self.ends[-1] = second
+            run[3] += samples
+            run[4] += lost
+            run[5] += seconds
+            run[6] += down_seconds
+
+        if latency is None:
+            return
+        period = second - second % self.resolution
+        latencies = self.latency[-1] if self.latency else None
+        if latencies is None or latencies[0] != period:
+            self.latency.append([period, samples, latency * samples,
+                                 latency])
+        else:
+            latencies[1] += samples
+            latencies[2] += latency * samples
+            latencies[3] = max(latencies[3], latency)
+
+    def totals(self, since=None, until=None):
+        '''
+        Samples, failed samples, lost packets, the seconds the samples
+        stand for and those down within [since, until). Runs cut by the
+        window count in proportion to their overlap.
+        '''
+        samples = failed = lost = seconds = down_seconds = 0.0
+        first = 0 if since is None else bisect.bisect_left(self.ends, since)
+        for start, end, run_failed, run_samples, run_lost, run_seconds, \
+                run_down_seconds in self.runs[first:]:
+            if until is not None and start >= until:
+                break
+            share = 1.0
+            if end > start:
+                low = start if since is None else max(start, since)
+                high = end if until is None else min(end, until)
+                share = (high - low) / float(end - start)
+            samples += run_samples * share
+            failed += run_samples * share * run_failed
+            lost += run_lost * share
+            seconds += run_seconds * share
+            down_seconds += run_down_seconds * share
+        return samples, failed, lost, seconds, down_seconds
+
+    def snapshot(self):
+        '''
+        Copies of the records changed since the last snapshot, with the
+        index of the first of them, for write(). The last run and period
+        are still open, so they are part of the next snapshot again.
+        '''
+        runs = (self.saved_runs,
+                [tuple(run) for run in self.runs[self.saved_runs:]])
+        latency = (self.saved_latency,
+                   [tuple(row) for row in self.latency[self.saved_latency:]])
+        self.saved_runs = max(len(self.runs) - 1, 0)
+        self.saved_latency = max(len(self.latency) - 1, 0)
+        self.dirty = False
+        return runs, latency
+
+    def restore(self, runs, latency):
+        '''Marks the records of a snapshot which failed to be written.'''
+        self.saved_runs = min(self.saved_runs, runs[0])
+        self.saved_latency = min(self.saved_latency, latency[0])
+        self.dirty = True
+
+    def journaled(self, runs, latency):
+        '''Marks the records of a snapshot written to the journal.'''
+        first = (runs[0], latency[0])
+        self.unmerged = first if self.unmerged is None else \
+            (min(self.unmerged[0], first[0]), min(self.unmerged[1], first[1]))
+
+    def replay(self, runs, latency):
+        '''Applies a snapshot read back from the journal.'''
+        first, rows = runs
+        self.runs[first:] = [list(row) for row in rows]
+        del self.ends[first:]
+        self.ends.extend(row[1] for row in rows)
+        first, rows = latency
+        self.latency[first:] = [list(row) for row in rows]
+        self.saved_runs = max(len(self.runs) - 1, 0)
+        self.saved_latency = max(len(self.latency) - 1, 0)
+        self.journaled(runs, latency)
+
+    def merge_snapshot(self):
+        '''Copies of the records only in the journal, for write().'''
+        runs_first, latency_first = self.unmerged
+        self.unmerged = None
+        return ((runs_first, [tuple(run) for run in self.runs[runs_first:]]),
+                (latency_first,
+                 [tuple(row) for row in self.latency[latency_first:]]))
+
+    def write(self, runs, latency):
+        self._write(self.path + RUNS_SUFFIX, RUN_RECORD, *runs)
+        self._write(self.path + LATENCY_SUFFIX, LATENCY_RECORD, *latency)
+
+    @staticmethod
+    def _write(path, record, first, rows):
+        if not rows:
+            return
+        mode = 'r+b' if os.path.exists(path) else 'wb'
+        with open(path, mode) as f:
+            f.seek(first * record.size)
+            f.write(''.join(record.pack(*row) for row in rows))
+            f.truncate()
+
+
+class TimelineDBAdapter(DBAdapter):
+    '''
+    Stores availability as run-length encoded timelines instead of a row
+    per sample: a 25 byte record per run of up or down samples and a 16
+    byte latency summary per hour, in two files per target under the
+    directory given as the database host. A month of a healthy target
+    takes about 12 KB, and windowed statuses only walk the runs which
+    overlap the window, found by bisecting their end times.
+
+    Samples are added in memory. Every `flush_interval` seconds the changed
+    records of all targets are appended to one journal, which is merged
+    into the files of the targets once it outgrows JOURNAL_LIMIT bytes and
+    on close, and replayed on start after a crash. Only an adapter which
+    appended to the journal merges it, so reading the timelines next to
+    a running daemon writes nothing. A gap of more than
+    MAX_GAP seconds between samples starts a new run, so downtimer's own
+    downtime isn't counted.
+    '''
+    def __init__(self, config):
+        self.logger = logging.getLogger('TimelineDBAdapter')
+        self.directory = config.db_host
+        self.flush_interval = config.flush_interval
+        self.intervals = {INSTANCE: config.ping_interval,
+                          SERVICE: config.http_interval}
+        self.timelines = {}
+        self.lock = threading.Lock()
+        # one flush writes the files at a time
+        self.flush_lock = threading.Lock()
+        self.journal = os.path.join(self.directory, JOURNAL_FILE)
+        # offset of an entry cut short by a crash, dropped on first append
+        self.torn = None
+        self.appended = False
+        for kind in (INSTANCE, SERVICE):
+            directory = os.path.join(self.directory, kind)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for name in os.listdir(directory):
+                if name.endswith(RUNS_SUFFIX):
+                    target = urllib.unquote(name[:-len(RUNS_SUFFIX)])
+                    self._timeline(kind, target)
+        self.target_tags = {}
+        try:
+            with open(os.path.join(self.directory, TAGS_FILE)) as f:
+                for kind, target, tags in json.load(f):
+                    self.target_tags[(kind, target)] = tags
+        except IOError:
+            pass
+        self.tags_dirty = False
+        self._replay()
+        self.running = True
+        self.thread = threading.Thread(target=self._flush_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tag_target(self, kind, target, tags):
+        with self.lock:
+            if self.target_tags.get((kind, target)) == tags:
+                return
+            self.target_tags[(kind, target)] = dict(tags)
+            self.tags_dirty = True
+
+    def _write_tags(self, rows):
+        path = os.path.join(self.directory, TAGS_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(rows, f)
+        os.rename(path + '.tmp', path)
+
+    def _replay(self):
+        '''Applies the snapshots journaled since the last merge.'''
+        offset = 0
+        try:
+            with open(self.journal, 'rb') as f:
+                for line in f:
+                    try:
+                        kind, target, runs, latency = json.loads(line)
+                    except ValueError:
+                        # the last entry may be cut short by a crash
+                        self.torn = offset
+                        break
+                    self._timeline(kind, target).replay(runs, latency)
+                    offset += len(line)
+        except IOError:
+            pass
+
+    def _append(self, entries):
+        '''Appends to the journal and returns its size.'''
+        with open(self.journal, 'ab') as f:
+            if self.torn is not None:
+                f.truncate(self.torn)
+                self.torn = None
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            try:
+                f.write(entries)
+                f.flush()
+            except (IOError, OSError):
+                # later entries would be appended to a partial one
+                f.truncate(size)
+                raise
+        return size + len(entries)
+
+    def _merge(self):
+        '''
+        Writes the journaled records to the files of their targets and
+        empties the journal. Called with the flush lock held.
+        '''
+        with self.lock:
+            merging = [(timeline, timeline.merge_snapshot())
+                       for timeline in self.timelines.values()
+                       if timeline.unmerged is not None]
+        failed = 0
+        for timeline, records in merging:
+            try:
+                timeline.write(*records)
+            except (IOError, OSError) as e:
+                failed += 1
+                self.logger.debug('Failed to save %s: %s', timeline.path, e)
+                with self.lock:
+                    timeline.journaled(*records)
+        if failed:
+            raise IOError('Failed to save %d of %d timelines' %
+                          (failed, len(merging)))
+        open(self.journal, 'wb').close()
+
+    def _timeline(self, kind, target):
+        timeline = self.timelines.get((kind, target))
+        if timeline is None:
+            path = os.path.join(self.directory, kind,
+                                urllib.quote(target, safe=''))
+            timeline = self.timelines[(kind, target)] = TargetTimeline(path)
+        return timeline
+
+    def _add(self, kind, target, timestamp, failed, lost, latency,
+             samples=1, interval=None):
+        second = calendar.timegm((timestamp or datetime.utcnow()).timetuple())
+        seconds, down_seconds = self.weigh(kind, failed, lost, samples,
+                                           interval)
+        with self.lock:
+            self._timeline(kind, target).add(second, int(failed), lost,
+                                             latency, MAX_GAP, samples,
+                                             seconds, down_seconds)
+
+    @timed('db.timeline.store_instance_status')
+    def store_instance_status(self, address, total_time, exit_code, value,
+                              timestamp=None, samples=1, rtt=None,
+                              interval=None):
+        failed = int(exit_code) != 0
+        # total_time also counts the spacing of the echo requests
+        latency = None if failed or rtt is None else float(rtt)
+        self._add(INSTANCE, address, timestamp, failed, float(value) / 100.0,
+                  latency, samples, interval)
+
+    @timed('db.timeline.store_service_status')
+    def store_service_status(self, endpoint, address, status_code, timeout,
+                             value, timestamp=None, samples=1,
+                             interval=None):
+        failed = status_code not in (200, 300)
+        # a failed check takes as long as the timeout
+        latency = None if failed else float(value) / 1e3
+        self._add(SERVICE, endpoint, timestamp, failed, 0.0, latency, samples,
+                  interval)
+
+    def _flush_loop(self):
+        while self.running:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error('Failed to save timelines: %s', e)
+
+    @timed('db.timeline.flush')
+    def flush(self):
+        '''
+        Journals the timelines which got samples since the last flush in a
+        single append and writes the tags if they changed. The changed
+        records are copied under the lock and written outside of it, so
+        the files never hold up storing samples.
+        '''
+        with self.flush_lock:
+            with self.lock:
+                changed = [(key, timeline, timeline.snapshot())
+                           for key, timeline in self.timelines.items()
+                           if timeline.dirty]
+                tags = None
+                if self.tags_dirty:
+                    tags = [list(key) + [value]
+                            for key, value in self.target_tags.items()]
+                    self.tags_dirty = False
+            size = 0
+            if changed:
+                entries = ''.join(json.dumps([kind, target, runs, latency]) +
+                                  '\n' for (kind, target), _, (runs, latency)
+                                  in changed)
+                try:
+                    size = self._append(entries)
+                except (IOError, OSError):
+                    with self.lock:
+                        for _, timeline, records in changed:
+                            timeline.restore(*records)
+                        self.tags_dirty = self.tags_dirty or tags is not None
+                    raise
+                with self.lock:
+                    for _, timeline, records in changed:
+                        timeline.journaled(*records)
+                self.appended = True
+            if tags is not None:
+                try:
+                    self._write_tags(tags)
+                except (IOError, OSError):
+                    with self.lock:
+                        self.tags_dirty = True
+                    raise
+            if size > JOURNAL_LIMIT:
+                self._merge()
+
+    def close(self):
+        self.running = False
+        self.flush()
+        with self.flush_lock:
+            if self.appended:
+                self._merge()
+
+    def _totals(self, kind, since, until):
+        since = since and calendar.timegm(since.timetuple())
+        until = until and calendar.timegm(until.timetuple())
+        with self.lock:
+            return [(target, timeline.totals(since, until))
+                    for (timeline_kind, target), timeline
+                    in self.timelines.items() if timeline_kind == kind]
+
+    @timed('db.timeline.get_instance_statuses')
+    def get_instance_statuses(self, since=None, until=None):
+        return [{'address': target, 'lost_pkts': lost, 'attempts': samples,
+                 'duration': seconds, 'downtime': down_seconds}
+                for target, (samples, failed, lost, seconds, down_seconds)
+                in self._totals(INSTANCE, since, until) if samples]
+
+    @timed('db.timeline.get_service_statuses')
+    def get_service_statuses(self, since=None, until=None):
+        return [{'service': target, 'srv_downtime': failed,
+                 'total_uptime': samples, 'duration': seconds,
+                 'downtime': down_seconds}
+                for target, (samples, failed, lost, seconds, down_seconds)
+                in self._totals(SERVICE, since, until) if samples]
+
+    def iter_samples(self, kind, since=None, until=None):
+        '''
+        Samples spread evenly over the runs they were counted in; not in
+        time order across targets.
+        '''
+        since = since and calendar.timegm(since.timetuple())
+        until = until and calendar.timegm(until.timetuple())
+        with self.lock:
+            runs = [(target, [list(run) for run in timeline.runs])
+                    for (timeline_kind, target), timeline
+                    in self.timelines.items() if timeline_kind == kind]
+        chunk = []
+        for target, target_runs in runs:
+            for start, end, failed, samples, lost, seconds, down_seconds \
+                    in target_runs:
+                step = float(end - start) / max(samples - 1, 1)
+                for i in range(samples):
+                    second = start + i * step
+                    if (since is None or second >= since) and \
+                            (until is None or second < until):
+                        chunk.append((target, second, bool(failed),
+                                      seconds / samples,
+                                      down_seconds / samples))
+                if len(chunk) >= SAMPLE_CHUNK_SIZE:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def latency(self, kind, target, since=None, until=None):
+        '''Hourly [period, samples, mean, max] latencies in ms.'''
+        since = since and calendar.timegm(since.timetuple())
+        until = until and calendar.timegm(until.timetuple())
+        with self.lock:
+            timeline = self.timelines.get((kind, target))
+            rows = list(timeline.latency) if timeline else []
+        return [[period, samples, total / samples, highest]
+                for period, samples, total, highest in rows
+                if (since is None or period >= since) and
+                (until is None or period < until)]
+
+    @timed('db.timeline.store_outage')
+    def store_outage(self, outage):
+        row = dict(outage, start=outage['start'].strftime(
+            INFLUX_PRECISE_TIME_FORMAT), end=outage['end'].strftime(
+            INFLUX_PRECISE_TIME_FORMAT))
+        with self.lock:
+            with open(os.path.join(self.directory, OUTAGES_FILE), 'a') as f:
+                f.write(json.dumps(row) + '\n')
+
+    @timed('db.timeline.store_sketches')
+    def store_sketches(self, rows):
+        with self.lock:
+            with open(os.path.join(self.directory, SKETCHES_FILE), 'a') as f:
+                for row in rows:
+                    f.write(json.dumps(dict(row, start=row['start'].strftime(
+                        INFLUX_PRECISE_TIME_FORMAT))) + '\n')
+
+    @timed('db.timeline.get_sketches')
+    def get_sketches(self, since=None, until=None):
+        try:
+            with open(os.path.join(self.directory, SKETCHES_FILE)) as f:
+                lines = f.readlines()
+        except IOError:
+            return []
+        rows = []
+        for line in lines:
+            row = json.loads(line)
+            row['start'] = datetime.strptime(row['start'],
+                                             INFLUX_PRECISE_TIME_FORMAT)
+            if (since is None or row['start'] >= since) and \
+                    (until is None or row['start'] < until):
+                rows.append(row)
+        return rows
+
+    @timed('db.timeline.get_outages')
+    def get_outages(self, since=None, until=None):
+        """Outages overlapping [since, until)."""
+        try:
+            with open(os.path.join(self.directory, OUTAGES_FILE)) as f:
+                lines = f.readlines()
+        except IOError:
+            return []
+        outages = []
+        for line in lines:
+            outage = json.loads(line)
+            for key in ('start', 'end'):
+                outage[key] = datetime.strptime(outage[key],
+                                                INFLUX_PRECISE_TIME_FORMAT)
+            if since is not None and outage['end'] < since:
+                continue
+            if until is not None and outage['start'] >= until:
+                continue
+            outages.append(outage)
+        return sorted(outages, key=lambda outage: outage['start'])
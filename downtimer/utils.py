@@ -1,87 +1,83 @@
 from datetime import datetime
 import re
-import requests
-import subprocess
-import time
+
+from instrumentation import timed
 
 SERVICE_TIMEOUT = 0.9
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M',
+                '%Y-%m-%d %H:%M', '%Y-%m-%d')
 
 
-def do_check(endpoint, address, db_adapter):
-    while True:
-        start_time = time.time()
+def parse_time(value):
+    '''
+    Parses a UTC time given on the command line, e.g. 2017-01-31T02:00.
+    '''
+    for time_format in TIME_FORMATS:
         try:
-            timeout = 0
-            r = requests.head(address, timeout=SERVICE_TIMEOUT, verify=False)
-            status_msg = 'FAIL'
-            if r.status_code >= 400:
-                # In the event that the endpoint URL returns a status code
-                #  >=400, test again using the "healcheck" URL, IE:
-                #  "http://<service_endpoint>/<service_port>/healthcheck"
-                #  before marking the endpoint as down.
-                _address = address + 'healthcheck'
-                r = requests.get(_address, timeout=SERVICE_TIMEOUT,
-                                 verify=False)
-                if r.status_code < 300:
-                    address = _address
-                    status_msg = 'OK'
-            else:
-                status_msg = 'OK'
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized time %s, expected YYYY-MM-DD[THH:MM[:SS]]'
+                     % value)
 
-            print(endpoint + " " + address + ": " + str(r.status_code) + " "
-                  + status_msg + " " + str(datetime.now()) + "\n")
 
-            elapsed = r.elapsed.microseconds
-            status_code = r.status_code
-        except requests.exceptions.RequestException as e:
-            timeout = 1
-            elapsed = SERVICE_TIMEOUT * 1e6
-            status_code = 408
-            print e
-        except Exception as e:
-            print("This situation should\'t have occured. Failed to check "
-                  "address {} with exception {}".format(address, e.message))
-            raise e
+@timed('probe.http')
+def check_endpoint(endpoint, address, http=None):
+    '''
+    Probes the endpoint once and returns (address, status_code, timeout,
+    elapsed). The returned address differs from the passed one when the
+    endpoint only answers on its healthcheck URL. `http` may be a shared
+    requests.Session to reuse keep-alive connections.
+    '''
+    import requests
 
-        db_adapter.store_service_status(endpoint, address, status_code,
-                                        timeout, elapsed)
+    http = http or requests
+    try:
+        timeout = 0
+        r = http.head(address, timeout=SERVICE_TIMEOUT, verify=False)
+        status_msg = 'FAIL'
+        if r.status_code >= 400:
+            # In the event that the endpoint URL returns a status code
+            #  >=400, test again using the "healcheck" URL, IE:
+            #  "http://<service_endpoint>/<service_port>/healthcheck"
+            #  before marking the endpoint as down.
+            _address = address + 'healthcheck'
+            r = http.get(_address, timeout=SERVICE_TIMEOUT, verify=False)
+            if r.status_code < 300:
+                address = _address
+                status_msg = 'OK'
+        else:
+            status_msg = 'OK'
 
-        finish_time = time.time()
-        '''
-        Counting time spent on all this code execution in seconds
-        to make all the time gaps between consecutive measurements equal
-        '''
-        time_spent = finish_time - start_time
-        if time_spent < 2:
-            time.sleep(2 - time_spent)
+        print(endpoint + " " + address + ": " + str(r.status_code) + " "
+              + status_msg + " " + str(datetime.now()) + "\n")
 
+        elapsed = r.elapsed.total_seconds() * 1e6
+        status_code = r.status_code
+    except requests.exceptions.RequestException as e:
+        timeout = 1
+        elapsed = SERVICE_TIMEOUT * 1e6
+        status_code = 408
+        print e
+    except Exception as e:
+        print("This situation should\'t have occured. Failed to check "
+              "address {} with exception {}".format(address, e.message))
+        raise e
+
+    return address, status_code, timeout, elapsed
 
-def ping(address, db_adapter):
-    while True:
-        start_time = time.time()
-        try:
-            response = subprocess.check_output(
-                ['ping', '-i', '0.2', '-c', '5', '-W', '1', address],
-                stderr=subprocess.STDOUT,  # get all output
-                universal_newlines=True  # return string not bytes
-            )
-            lost = re.search('\d+(?=\% packet loss,)', response)
-            packet_loss = lost.group(0)
-            total = re.search('(?<=loss, time )\d+', response)
-            total_time = total.group(0)
-            exit_code = '0'
-        except:
-            exit_code = '1'
-            packet_loss = '100'
-            total_time = '1000'
 
-        db_adapter.store_instance_status(address, total_time,
-                                         exit_code, packet_loss)
-        finish_time = time.time()
-        '''
-        Counting time spent on all this code execution in seconds
-        to make all the time gaps between consecutive measurements equal
-        '''
-        time_spent = finish_time - start_time
-        if time_spent < 2:
-            time.sleep(2 - time_spent)
+def parse_ping(output, exit_code):
+    '''
+    Extracts the elapsed time in ms, the packet loss percentage and the
+    slowest round trip in ms from the output of `ping`. Returns the first
+    two with the exit code as strings and the round trip as a float; a
+    ping which failed or printed no summary lost everything.
+    '''
+    lost = re.search('\d+(?=\% packet loss,)', output)
+    total = re.search('(?<=loss, time )\d+', output)
+    if exit_code != 0 or lost is None or total is None:
+        return '1000', '1', '100', None
+    rtt = re.search('= [\d.]+/[\d.]+/([\d.]+)/', output)
+    return (total.group(0), '0', lost.group(0),
+            float(rtt.group(1)) if rtt else None)